@@ -0,0 +1,378 @@
+#!/bin/env python3
+
+# batch.py
+#
+# This script processes a batch of music album (or Hearts of Space program)
+# ZIP archives on the local machine, running several archives at once.  It
+# does the same work as the queue jobs of qmus/qhos -- music.py/hos.py
+# reading the archive, organize.py, clean up -- without a queue and without
+# prompting.
+#
+# Each archive goes through three stages: staging (copying the archive to
+# local scratch, with --stage), encoding, and organizing.  The stages of
+# different archives overlap, so the next archive is being copied in and
+# the previous one organized while the current one is encoding.
+#
+# A record of each archive (what it was, how long it took, where, and with
+# which tools) is appended to a JSON lines results file, for report.py.
+
+import argparse
+import os
+import re
+import sys
+import json
+import time
+import fcntl
+import socket
+import shutil
+import zipfile
+import tempfile
+import datetime
+import subprocess
+import mutagen
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from pathlib import Path
+
+# Define terminal colors
+class bcolors:
+  HEADER = '\033[95m'
+  OKBLUE = '\033[94m'
+  OKGREEN = '\033[92m'
+  WARNING = '\033[93m'
+  FAIL = '\033[91m'
+  ENDC = '\033[0m'
+  BOLD = '\033[1m'
+  UNDERLINE = '\033[4m'
+
+# Scratch space needed per byte of uncompressed archive: the archive is
+# read in place, so this is the decoded WAV data (FLAC expands roughly 1.7x)
+scratch_factor = 2
+
+# The other scripts live next to this one
+scripts = os.path.dirname(os.path.realpath(__file__))
+def script(name):
+  if Path(scripts,name).is_file():
+    return os.path.join(scripts,name)
+  return name
+
+# Parse arguments
+parser = argparse.ArgumentParser(description='Process a batch of music or HoS archives on this machine.')
+parser.add_argument('archives',metavar='archive.zip',nargs='+',
+                    help='One or more album (or, with --hos, program) ZIP archives.')
+parser.add_argument('destination',metavar='destination',
+                    help='Directory where the final mp3/m4a files should land.')
+parser.add_argument('--hos',action='store_true',dest='hos',
+                    help='The archives are Hearts of Space programs (use hos.py instead of music.py).')
+parser.add_argument('-c','--codec',metavar='CODEC',dest='codec',choices={'mp3','aac'},
+                    help='Output codec; passed through to music.py/hos.py.')
+parser.add_argument('-b','--bitrate',metavar='BITRATE',dest='bitrate',
+                    help='Encoding bitrate; passed through to music.py/hos.py.')
+parser.add_argument('-e','--edition',metavar='ALBUM_EDITION',dest='edition',
+                    choices={'default','original','optimized','all'},
+                    help='Album edition; passed through to music.py.')
+parser.add_argument('-g','--gapless',action='store_true',dest='gapless',
+                    help='Encode each disc in one lame session (MP3 only); passed through to music.py.')
+parser.add_argument('-v','--voiceover',metavar='SETTING',dest='voiceover',default='intro',
+                    choices={'intro','on','off','all'},
+                    help='Voiceover setting, or all; passed through to hos.py. (Default: intro)')
+parser.add_argument('-t','--tmpdir',metavar='DIR',dest='tmpdir',default=tempfile.gettempdir(),
+                    help='Directory for temporary files. (Default: {})'.format(tempfile.gettempdir()))
+parser.add_argument('-l','--logdir',metavar='DIR',dest='logdir',default='.',
+                    help='Directory for the per-archive logs. (Default: current directory)')
+parser.add_argument('-p','--cpus',metavar='N',type=int,dest='cpus',default=None,
+                    help='CPUs given to each archive (music.py -j). (Default: 1 for HoS, otherwise 2)')
+parser.add_argument('-j','--jobs',metavar='N',type=int,dest='jobs',default=None,
+                    help='Archives to encode at once. (Default: available CPUs / CPUs per archive)')
+parser.add_argument('-s','--stage',action='store_true',dest='stage',
+                    help='Copy each archive to the temporary directory before encoding it.')
+parser.add_argument('--prefetch',metavar='N',type=int,dest='prefetch',default=1,
+                    help='Archives to stage ahead of the encoders. (Default: 1)')
+parser.add_argument('-w','--worker',metavar='SOCKET',dest='worker',
+                    help='Run the scripts on a warm worker.py listening on this socket.')
+parser.add_argument('--shard',metavar='I/N',dest='shard',
+                    help='Encode only shard I of N of each album; passed through to music.py.')
+parser.add_argument('--collect',metavar='DIR',dest='collect',
+                    help='Move the encoded files into this directory instead of organizing them (for shards, '
+                         'organized together once all of them are done).')
+parser.add_argument('-r','--results',metavar='FILE',dest='results',default=None,
+                    help='Results file to append a record of each archive to. (Default: results.jsonl in the log directory)')
+args=parser.parse_args()
+
+if args.cpus == None:
+  args.cpus = 1 if args.hos else 2
+if args.jobs == None:
+  args.jobs = max(1,len(os.sched_getaffinity(0)) // args.cpus)
+if args.cpus < 1 or args.jobs < 1 or args.prefetch < 1:
+  parser.error('--cpus, --jobs and --prefetch must be at least 1.')
+if (args.shard != None or args.collect != None) and args.hos:
+  parser.error('--shard and --collect are only for music archives.')
+if args.gapless and args.codec == 'aac' and not args.hos:
+  parser.error('--gapless is only supported for MP3, not AAC.')
+
+if args.collect != None:
+  os.makedirs(args.collect,exist_ok=True)
+for d in (args.destination,args.tmpdir,args.logdir):
+  if not Path(d).is_dir():
+    raise Exception(f"{bcolors.FAIL}ERROR: Directory '{d}' does not exist!{bcolors.ENDC}")
+destination = os.path.realpath(args.destination)
+logdir = os.path.realpath(args.logdir)
+results = args.results or os.path.join(logdir,'results.jsonl')
+
+# What an archive holds, for the results: the album(s) in a music archive,
+# or the program in a HoS archive
+def describe(zf):
+  names = zf.namelist()
+  try:
+    if args.hos:
+      program = [x for x in names if re.match(r'^(.*/)?api\.hos\.com/api/v1/programs/\d+$',x)][0]
+      return 'HoS {:04}: {}'.format(int(program.split('/')[-1]),json.loads(zf.read(program))['title'])
+    meta = [x for x in ('metadata.json','audio/metadata.json') if x in names][0]
+    albums = ['{} - {}'.format(m['artist'],m['title']) for m in json.loads(zf.read(meta)) if m['index'] != -1]
+    return '; '.join(sorted(set(albums)))
+  except (IndexError,KeyError,TypeError,ValueError):
+    return None
+
+# Collect the archives, largest first so the long jobs do not end up
+# running on their own at the end of the batch
+archives = []
+for z in args.archives:
+  if not zipfile.is_zipfile(z):
+    raise Exception(f"{bcolors.FAIL}ERROR: {z} is not a valid ZIP file!{bcolors.ENDC}")
+  with zipfile.ZipFile(z) as zf:
+    size = sum([x.file_size for x in zf.infolist()])
+    title = describe(zf)
+  name = Path(z).stem
+  if args.shard != None:
+    name = '{}_shard{}'.format(name,args.shard.replace('/','of'))
+  scratch = size*scratch_factor
+  if args.stage:
+    scratch = scratch + Path(z).stat().st_size
+  archives.extend([{'zip':os.path.realpath(z),'name':name,'title':title,'scratch':scratch,
+                    'log':os.path.join(logdir,'{}.log'.format(name)),
+                    'status':'pending','time':{},'cpu':0,'rss':0,'tracks':0,'audio':0,'bytes_out':0}])
+archives.sort(key=lambda x: Path(x['zip']).stat().st_size,reverse=True)
+
+if args.hos:
+  if args.voiceover == 'all':
+    vo_loop = ['intro','off','on']
+  else:
+    vo_loop = [args.voiceover]
+
+opts = []
+if args.codec != None:
+  opts.extend(['-c',args.codec])
+if args.bitrate != None:
+  opts.extend(['-b',args.bitrate])
+if args.edition != None and not args.hos:
+  opts.extend(['-e',args.edition])
+if args.gapless and not args.hos:
+  opts.extend(['-g'])
+if args.shard != None:
+  opts.extend(['--shard',args.shard])
+
+# The codec profile, with the defaults of music.py/hos.py filled in
+codec = args.codec or 'mp3'
+profile = '{} {}'.format(codec,args.bitrate or {'mp3':'V2','aac':'256'}[codec])
+
+# Versions of the tools doing the work, and the environment modules that
+# provided them, so that results can be compared across toolchain upgrades
+def version(cmd):
+  try:
+    out = subprocess.run(cmd,capture_output=True,text=True,errors='replace').stdout.strip()
+  except OSError:
+    return None
+  return out.split('\n')[0] if out else None
+tools = {'lame':version(['lame','--version']),'flac':version(['flac','--version']),
+         'ffmpeg':version(['ffmpeg','-version'])}
+modules = os.environ.get('LOADEDMODULES')
+node = socket.gethostname()
+job = os.environ.get('SLURM_JOB_ID') or os.environ.get('PBS_JOBID')
+if os.environ.get('SLURM_ARRAY_JOB_ID') != None:
+  job = '{}_{}'.format(os.environ['SLURM_ARRAY_JOB_ID'],os.environ.get('SLURM_ARRAY_TASK_ID'))
+
+# With --worker, the scripts run on the worker instead of each starting a
+# new interpreter (the worker's environment applies, not ours)
+if args.worker != None:
+  import worker
+
+# Run a command for an archive, with its output going to the archive's log.
+# The CPU time of the command and everything it waited for is added to the
+# archive's total, and the largest process among them is kept (estimate.py
+# sizes memory requests by it).
+def run(a,cmd,cwd):
+  with open(a['log'],'a') as log:
+    log.write('{}\n'.format(cmd))
+    log.flush()
+    if args.worker != None and os.path.basename(cmd[0]) in worker.script_names:
+      result = worker.submit(os.path.basename(cmd[0]),cmd[1:],cwd,args.worker,log.fileno(),log.fileno())
+      a['cpu'] = a['cpu'] + result['cpu']
+      if result['status'] != 0:
+        raise subprocess.CalledProcessError(result['status'],cmd)
+      return
+    p = subprocess.Popen(cmd,cwd=cwd,stdout=log,stderr=subprocess.STDOUT)
+    _, status, usage = os.wait4(p.pid,0)
+    p.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+    a['cpu'] = a['cpu'] + usage.ru_utime + usage.ru_stime
+    a['rss'] = max(a['rss'],usage.ru_maxrss)
+    if p.returncode != 0:
+      raise subprocess.CalledProcessError(p.returncode,cmd)
+
+# Count and measure the encoded files waiting in an archive's temporary
+# directory, before organize.py moves them away
+def measure(a):
+  dirs = [os.path.join(a['temp'],vo) for vo in vo_loop] if args.hos else [a['temp']]
+  files = [os.path.join(d,x) for d in dirs for x in os.listdir(d)
+           if x[-4:] in ('.mp3','.m4a') and x[:5] in ('index','track')]
+  a['tracks'] = len(files)
+  a['bytes_out'] = sum([Path(f).stat().st_size for f in files])
+  for f in files:
+    try:
+      a['audio'] = a['audio'] + mutagen.File(f).info.length
+    except Exception:
+      pass
+
+# Append an archive's record to the results file.  Jobs on other nodes may
+# be appending to the same file, so it is locked while writing.  A shard is
+# charged its share of the archive's bytes.
+def record(a):
+  rec = {'time':datetime.datetime.now().astimezone().isoformat(timespec='seconds'),
+         'archive':a['zip'],'name':a['name'],'title':a['title'],
+         'kind':'hos' if args.hos else 'music','profile':profile,
+         'edition':None if args.hos else args.edition,'shard':args.shard,
+         'voiceover':args.voiceover if args.hos else None,
+         'status':a['status'],'failed_stage':a.get('failed'),
+         'tracks':a['tracks'],'audio_seconds':round(a['audio'],3),
+         'wall_seconds':{k:round(v,3) for k,v in a['time'].items()},
+         'cpu_seconds':round(a['cpu'],3),'cpus':args.cpus,
+         'max_rss_mb':round(a['rss']/1024,1) if a['rss'] > 0 else None,
+         'bytes_in':Path(a['zip']).stat().st_size // (int(args.shard.split('/')[1]) if args.shard else 1),
+         'bytes_out':a['bytes_out'],
+         'node':node,'job':job,'tools':tools,'modules':modules}
+  with open(results,'a') as f:
+    fcntl.flock(f,fcntl.LOCK_EX)
+    f.write(json.dumps(rec)+'\n')
+
+# Stage 1: set up the archive's temporary directory, and copy the archive
+# into it if asked to
+def stage(a):
+  a['temp'] = tempfile.mkdtemp(dir=args.tmpdir)
+  a['source'] = a['zip']
+  with open(a['log'],'w') as log:
+    if args.stage:
+      a['source'] = os.path.join(a['temp'],os.path.basename(a['zip']))
+      log.write('Staging {} to {}\n'.format(a['zip'],a['source']))
+      shutil.copyfile(a['zip'],a['source'])
+
+# Stage 2: encode.  Each HoS voiceover setting gets its own directory, as
+# hos.py names its output files the same way for all of them.
+def encode(a):
+  if args.hos:
+    for vo in vo_loop:
+      os.mkdir(os.path.join(a['temp'],vo))
+      run(a,[script('hos.py')]+opts+['-v',vo,'-r',a['source']],os.path.join(a['temp'],vo))
+  else:
+    run(a,[script('music.py'),'-j',str(args.cpus)]+opts+['-r',a['source']],a['temp'])
+  measure(a)
+
+# Stage 3: organize the encoded files into the destination.  organize.py
+# cleans up only the directories it touched, under a lock on the
+# destination, so it is safe alongside other jobs organizing there.
+def organize(a):
+  if args.collect != None:
+    for x in sorted([x for x in os.listdir(a['temp']) if x[:5] == 'index']):
+      with open(a['log'],'a') as log:
+        log.write('Collecting {} into {}\n'.format(x,args.collect))
+      shutil.move(os.path.join(a['temp'],x),os.path.join(args.collect,x))
+  elif args.hos:
+    for vo in vo_loop:
+      run(a,[script('organize.py'),'-a','-m','-c','-r',destination],os.path.join(a['temp'],vo))
+  else:
+    outputs = sorted([x for x in os.listdir(a['temp']) if x[:5] == 'index'])
+    run(a,[script('organize.py'),'-m','-c','-r']+outputs+[destination],a['temp'])
+
+# Run one stage of an archive, timing it.  An archive that fails at any
+# stage is dropped, and its temporary directory is removed along with it.
+stages = {'staging':(stage,'staged'),'encoding':(encode,'encoded'),'organizing':(organize,'ok')}
+def step(a):
+  fn,after = stages[a['status']]
+  start = time.monotonic()
+  try:
+    fn(a)
+    a['status'] = after
+  except BaseException as e:
+    a['failed'] = fn.__name__
+    a['status'] = 'FAILED'
+    with open(a['log'],'a') as log:
+      log.write('** An error was detected, archive aborted: {}\n'.format(e))
+  finally:
+    a['time'].update({fn.__name__:time.monotonic()-start})
+    if a['status'] in ('ok','FAILED'):
+      if 'temp' in a.keys():
+        shutil.rmtree(a['temp'],ignore_errors=True)
+      a['time'].update({'total':sum([v for k,v in a['time'].items() if k != 'total'])})
+      try:
+        record(a)
+      except OSError as e:
+        print(f"{bcolors.WARNING}WARNING: Could not write the results of {a['name']} to {results}: {e}{bcolors.ENDC}")
+  return a
+
+print('Processing {} archive(s), {} at a time with {} CPU(s) each.'.format(len(archives),args.jobs,args.cpus))
+
+# Keep every stage busy.  Up to --jobs archives encode at once, one is
+# organized at a time, and up to --prefetch archives are staged ahead of the
+# encoders.  An archive is only staged when its scratch space fits next to
+# that of the archives in flight; one that does not fit waits for another
+# to finish (unless nothing is in flight, in which case it goes anyway).
+pending = list(archives)
+inflight = []
+running = {}
+def count(*status):
+  return len([x for x in inflight if x['status'] in status])
+try:
+  with ThreadPoolExecutor(max_workers=args.jobs+args.prefetch+1) as pool:
+    while pending or inflight:
+      for a in [x for x in inflight if x['status'] == 'encoded'][:1-count('organizing')]:
+        a['status'] = 'organizing'
+        running.update({pool.submit(step,a):a})
+      for a in [x for x in inflight if x['status'] == 'staged'][:max(0,args.jobs-count('encoding'))]:
+        a['status'] = 'encoding'
+        print('Encoding {} (log: {})'.format(a['name'],a['log']))
+        running.update({pool.submit(step,a):a})
+      while pending and count('staging','staged') < args.prefetch:
+        free = shutil.disk_usage(args.tmpdir).free - sum([x['scratch'] for x in inflight])
+        fits = [x for x in pending if x['scratch'] <= free]
+        if len(fits) == 0 and len(inflight) == 0:
+          print(f"{bcolors.WARNING}WARNING: {pending[0]['name']} may not fit in {args.tmpdir}.{bcolors.ENDC}")
+          fits = [pending[0]]
+        if len(fits) == 0:
+          break
+        a = fits[0]
+        pending.remove(a)
+        inflight.extend([a])
+        a['status'] = 'staging'
+        running.update({pool.submit(step,a):a})
+      done, _ = wait(running,return_when=FIRST_COMPLETED)
+      for f in done:
+        a = running.pop(f)
+        if a['status'] in ('ok','FAILED'):
+          inflight.remove(a)
+          color = bcolors.OKGREEN if a['status'] == 'ok' else bcolors.FAIL
+          print('{}Finished {}: {}{}'.format(color,a['name'],a['status'],bcolors.ENDC))
+except KeyboardInterrupt:
+  print(f"{bcolors.FAIL}\n** Trapped CTRL-C{bcolors.ENDC}")
+  for a in pending:
+    a['status'] = 'cancelled'
+
+# Summary table
+def hms(a,name):
+  return str(datetime.timedelta(seconds=round(a['time'].get(name,0))))
+width = max([len(a['name']) for a in archives]+[7])
+print()
+print('{:{}}  {:9}  {:>8}  {:>8}  {:>8}  {}'.format('Archive',width,'Status','Stage','Encode','Organize','Log'))
+print('-'*(width+60))
+for a in archives:
+  print('{:{}}  {:9}  {:>8}  {:>8}  {:>8}  {}'.format(a['name'],width,a['status'],
+        hms(a,'stage'),hms(a,'encode'),hms(a,'organize'),a['log']))
+
+if any([a['status'] != 'ok' for a in archives]):
+  sys.exit(4)
@@ -7,7 +7,15 @@
 import argparse
 import csv
 import json
+import os
+import mmap
+import zlib
+import hashlib
+import datetime
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+import verify as headers
 
 
 # Parse arguments
@@ -16,6 +24,16 @@ parser.add_argument('albumdata',metavar='albumdata',nargs='*',default='',
                     help='CSV file(s) with album metadata.')
 parser.add_argument('-u','--unicode',action='store_true',dest='unicode',
                     help='Assume the input CSV file is encoded with UTF-8.')
+parser.add_argument('-j','--jobs',metavar='N',type=int,dest='jobs',default=16,
+                    help='Number of directories to list (and files to probe) concurrently. (Default: 16)')
+parser.add_argument('--cache',metavar='FILE',dest='cache',
+                    default=os.path.join(os.environ.get('XDG_CACHE_HOME',os.path.expanduser('~/.cache')),'audio-scripts','probe.json'),
+                    help='Cache of audio properties, keyed by file fingerprint. (Default: ~/.cache/audio-scripts/probe.json)')
+parser.add_argument('--no-verify',action='store_false',dest='verify',
+                    help='Do not verify the integrity of the audio files.')
+parser.add_argument('--verify-cache',metavar='FILE',dest='verify_cache',
+                    default=os.path.join(os.environ.get('XDG_CACHE_HOME',os.path.expanduser('~/.cache')),'audio-scripts','verify.json'),
+                    help='Cache of verification results, keyed by file hash. (Default: ~/.cache/audio-scripts/verify.json)')
 args=parser.parse_args()
 
 print('#'*34)
@@ -100,69 +118,68 @@ for infile in args.albumdata:
 
 
 # QC Checks
-for j in metadata:
-  if j['index'] >= 0:
-    if j['edition'] == None:
-      print('{}'.format(j['title']))
+
+# List the regular files in a directory with a single scandir call
+def listdir(d):
+  try:
+    with os.scandir(d) as it:
+      return {e.name for e in it if e.is_file()}
+  except (FileNotFoundError,NotADirectoryError):
+    return set()
+
+# Collect the files to check for each album, as (message, path) pairs
+def qcfiles(j):
+  def path(f):
+    if j['prefix'] == None:
+      return f
     else:
-      print('{} [{}]'.format(j['title'],j['edition']))
+      return '/'.join([j['prefix'],f])
+  checks = []
 
-    # Log files
-    if j['logs'] != None:
-      for log in j['logs']:
-        if j['prefix'] == None:
-          f = log['file']
-        else:
-          f = '/'.join([j['prefix'],log['file']])
-        if Path(f).is_file():
-          print('  Found log file {}'.format(f))
-        else:
-          raise Exception('Could not find {}'.format(f))
+  # Log files
+  if j['logs'] != None:
+    for log in j['logs']:
+      checks.extend([('  Found log file {}',path(log['file']))])
 
-    # Cue sheets
-    if j['cuesheets'] != None:
-      for cue in j['cuesheets']:
-        if j['prefix'] == None:
-          f = cue['file']
-        else:
-          f = '/'.join([j['prefix'],cue['file']])
-        if Path(f).is_file():
-          print('  Found cue sheet {}'.format(f))
-        else:
-          raise Exception('Could not find {}'.format(f))
+  # Cue sheets
+  if j['cuesheets'] != None:
+    for cue in j['cuesheets']:
+      checks.extend([('  Found cue sheet {}',path(cue['file']))])
 
-    # Torrent file
-    if j['torrent'] != None:
-      if j['prefix'] == None:
-        f = j['torrent']
-      else:
-        f = '/'.join([j['prefix'],j['torrent']])
-      if Path(f).is_file():
-        print('  Found torrent file {}'.format(f))
-      else:
-        raise Exception('Could not find {}'.format(f))
+  # Torrent file
+  if j['torrent'] != None:
+    checks.extend([('  Found torrent file {}',path(j['torrent']))])
 
-    # Cover art
-    if j['coverart'] != None:
-      if j['prefix'] == None:
-        f = j['coverart']
-      else:
-        f = '/'.join([j['prefix'],j['coverart']])
-      if Path(f).is_file():
-        print('  Found cover art image {}'.format(f))
-      else:
-        raise Exception('Could not find {}'.format(f))
+  # Cover art
+  if j['coverart'] != None:
+    checks.extend([('  Found cover art image {}',path(j['coverart']))])
 
-    # Audio tracks
-    for tt in j['tracks']:
-      if j['prefix'] == None:
-        f = tt['file']
-      else:
-        f = '/'.join([j['prefix'],tt['file']])
-      if Path(f).is_file():
-        print('  TRACK {:2d} {}'.format(tt['track'],f))
-      else:
-        raise Exception('Could not find {}'.format(f))
+  # Audio tracks
+  for tt in j['tracks']:
+    checks.extend([('  TRACK {:2d} {{}}'.format(tt['track']),path(tt['file']))])
+  return checks
+
+# Rather than one stat per file (a round trip each on NFS), list every
+# directory involved once, all of them concurrently, then check against
+# the listings
+albums = [j for j in metadata if j['index'] >= 0]
+checks = [qcfiles(j) for j in albums]
+dirs = sorted({os.path.dirname(f) or '.' for c in checks for m,f in c})
+with ThreadPoolExecutor(max_workers=args.jobs) as pool:
+  listing = dict(zip(dirs,pool.map(listdir,dirs)))
+
+missing = []
+for j,c in zip(albums,checks):
+  if j['edition'] == None:
+    print('{}'.format(j['title']))
+  else:
+    print('{} [{}]'.format(j['title'],j['edition']))
+  for m,f in c:
+    if os.path.basename(f) in listing[os.path.dirname(f) or '.']:
+      print(m.format(f))
+    else:
+      print('  Could not find {}'.format(f))
+      missing.extend([f])
 
     # Nullify cuesheets and logs lists if there are none
     #if len(j['cuesheets']) == 0:
@@ -170,6 +187,351 @@ for j in metadata:
     #if len(j['logs']) == 0:
     #  j['logs'] = None
 
+if len(missing) > 0:
+  raise Exception('Could not find {} file(s):\n  {}'.format(len(missing),'\n  '.join(missing)))
+
+# Audio properties
+
+# Fingerprint a file by hashing its size and its first and last 64 KiB,
+# which is enough to tell rips apart without reading them in full
+def fingerprint(f):
+  h = hashlib.sha256()
+  with open(f,'rb') as fh:
+    size = os.fstat(fh.fileno()).st_size
+    h.update(str(size).encode())
+    h.update(fh.read(65536))
+    if size > 131072:
+      fh.seek(size-65536)
+    h.update(fh.read(65536))
+  return h.hexdigest()
+
+# Size of the ID3v2 tag at the front of a file, if there is one
+def id3_size(head):
+  if head[:3] != b'ID3':
+    return 0
+  size = 10 + ((head[6]&0x7f)<<21 | (head[7]&0x7f)<<14 | (head[8]&0x7f)<<7 | (head[9]&0x7f))
+  if head[5] & 0x10:
+    size = size + 10
+  return size
+
+# FLAC: everything comes from the STREAMINFO block
+def probe_flac(m):
+  pos = id3_size(m[:10])
+  if m[pos:pos+4] != b'fLaC' or m[pos+4] & 0x7f != 0:
+    raise Exception('No FLAC STREAMINFO block')
+  si = int.from_bytes(m[pos+18:pos+26],'big')
+  rate = si >> 44
+  channels = ((si >> 41) & 0x7) + 1
+  bits = ((si >> 36) & 0x1f) + 1
+  samples = si & 0xfffffffff
+  return {'duration':round(samples/rate,3),'sample_rate':rate,'bits':bits,'channels':channels}
+
+mp3_bitrates = {1:[0,32,40,48,56,64,80,96,112,128,160,192,224,256,320],
+                2:[0,8,16,24,32,40,48,56,64,80,96,112,128,144,160]}
+mp3_rates = {3:[44100,48000,32000],2:[22050,24000,16000],0:[11025,12000,8000]}
+
+# A file found to be damaged, as opposed to one that could not be checked
+class Damaged(Exception):
+  pass
+
+# Parse the MPEG audio layer III frame header at pos into its version,
+# sample rate, bitrate and frame length; None if there is no valid header
+# there.  Free-format (bitrate index 0) and reserved indices are not valid,
+# as in verify.py.
+def mp3_header(m,pos):
+  if pos+4 > len(m) or m[pos] != 0xff or m[pos+1] & 0xe0 != 0xe0:
+    return None
+  version = (m[pos+1] >> 3) & 0x3
+  if version not in mp3_rates or (m[pos+1] >> 1) & 0x3 != 1 or (m[pos+2] >> 2) & 0x3 == 3 or m[pos+2] >> 4 in (0,15):
+    return None
+  kbps = mp3_bitrates[1 if version == 3 else 2][m[pos+2] >> 4]
+  rate = mp3_rates[version][(m[pos+2] >> 2) & 0x3]
+  length = (144000 if version == 3 else 72000)*kbps//rate + ((m[pos+2] >> 1) & 0x1)
+  return version,rate,kbps,length
+
+# Find the first MP3 frame after the ID3v2 tag.  A header only counts when
+# the next frame (or the end of the audio) starts where its frame ends, so
+# that stray sync bytes in junk before the audio are passed over.
+def mp3_start(m):
+  pos = id3_size(m[:10])
+  while pos+4 <= len(m):
+    h = mp3_header(m,pos)
+    if h != None:
+      nxt = pos+h[3]
+      if mp3_header(m,nxt) != None or nxt+4 > len(m) or bytes(m[nxt:nxt+3]) == b'TAG' or bytes(m[nxt:nxt+8]) == b'APETAGEX':
+        return pos
+    pos = pos+1
+  raise Damaged('No MPEG layer III frame found')
+
+# MP3: the first frame header, plus its Xing/Info or VBRI header for the
+# frame count; without one the stream is taken to be CBR
+def probe_mp3(m):
+  pos = mp3_start(m)
+  version,rate,kbps,_ = mp3_header(m,pos)
+  channels = 1 if m[pos+3] >> 6 == 3 else 2
+  spf = 1152 if version == 3 else 576
+  side = {(3,2):32,(3,1):17}.get((version,channels),17 if channels == 2 else 9)
+  frames = None
+  x = pos+4+side
+  if m[x:x+4] in (b'Xing',b'Info') and m[x+7] & 0x1:
+    frames = int.from_bytes(m[x+8:x+12],'big')
+  elif m[pos+36:pos+40] == b'VBRI':
+    frames = int.from_bytes(m[pos+50:pos+54],'big')
+  if frames != None:
+    duration = frames*spf/rate
+  else:
+    end = len(m)
+    if end-pos > 128 and m[end-128:end-125] == b'TAG':
+      end = end-128
+    duration = (end-pos)*8/(kbps*1000)
+  return {'duration':round(duration,3),'sample_rate':rate,'bits':None,'channels':channels}
+
+# MP4: duration from mvhd, format from the sample description of the
+# audio track
+def probe_mp4(m):
+  moov = headers.mp4_boxes(m,*headers.mp4_boxes(m)[b'moov'])
+  pos = moov[b'mvhd'][0]
+  if m[pos] == 1:
+    timescale = int.from_bytes(m[pos+20:pos+24],'big')
+    length = int.from_bytes(m[pos+24:pos+32],'big')
+  else:
+    timescale = int.from_bytes(m[pos+12:pos+16],'big')
+    length = int.from_bytes(m[pos+16:pos+20],'big')
+  props = {'duration':round(length/timescale,3),'sample_rate':None,'bits':None,'channels':None}
+  mdia = headers.mp4_track(m,*headers.mp4_boxes(m)[b'moov'])
+  if mdia == None:
+    raise Exception('No audio track')
+  stbl = headers.mp4_boxes(m,*headers.mp4_boxes(m,*mdia[b'minf'])[b'stbl'])
+  entry = stbl[b'stsd'][0]+8
+  codec = bytes(m[entry+4:entry+8])
+  props['channels'] = int.from_bytes(m[entry+24:entry+26],'big')
+  props['sample_rate'] = int.from_bytes(m[entry+32:entry+34],'big')
+  if codec == b'alac':
+    props['bits'] = int.from_bytes(m[entry+26:entry+28],'big')
+  return props
+
+# Probe the audio properties of one file from its headers alone
+def probe(f):
+  with open(f,'rb') as fh:
+    size = os.fstat(fh.fileno()).st_size
+    m = mmap.mmap(fh.fileno(),0,access=mmap.ACCESS_READ)
+    try:
+      if f[-5:] == '.flac':
+        props = probe_flac(m)
+      elif f[-4:] == '.mp3':
+        props = probe_mp3(m)
+      elif f[-4:] == '.m4a':
+        props = probe_mp4(m)
+      else:
+        raise Exception('Unknown file type extension for {}'.format(f))
+    finally:
+      m.close()
+  props['size'] = size
+  return props
+
+# Probe a file unless the cache already knows it
+def probe_cached(f):
+  key = fingerprint(f)
+  if key not in cache:
+    try:
+      cache[key] = probe(f)
+    except Exception as e:
+      raise Exception('Could not read the audio properties of {}: {}'.format(f,e))
+  return cache[key]
+
+try:
+  with open(args.cache,'r') as f:
+    cache = json.load(f)
+except (FileNotFoundError,ValueError):
+  cache = {}
+
+tracks = [(j,tt) for j in albums for tt in j['tracks']]
+with ThreadPoolExecutor(max_workers=args.jobs) as pool:
+  results = pool.map(probe_cached,['/'.join([j['prefix'],tt['file']]) if j['prefix'] != None else tt['file'] for j,tt in tracks])
+  for (j,tt),props in zip(tracks,results):
+    tt.update(props)
+
+for j in albums:
+  print('{}: {} tracks, {}'.format(j['title'],len(j['tracks']),
+        datetime.timedelta(seconds=round(sum([tt['duration'] for tt in j['tracks']])))))
+
+# Write a cache file out in one piece
+def save_cache(path,data):
+  Path(path).parent.mkdir(parents=True,exist_ok=True)
+  with open(path+'.tmp','w') as f:
+    json.dump(data,f)
+  os.replace(path+'.tmp',path)
+
+save_cache(args.cache,cache)
+
+# Integrity
+
+# Hash a whole file
+def file_hash(f):
+  h = hashlib.sha256()
+  with open(f,'rb') as fh:
+    for buf in iter(lambda: fh.read(1<<20),b''):
+      h.update(buf)
+  return h.hexdigest()
+
+# FLAC: decode to PCM and check it against the MD5 in STREAMINFO.  The
+# MD5 is of the samples as signed little-endian integers, which is what
+# flac writes as raw output.  The CRC32 of the PCM is kept for checking
+# against the rip log.
+def verify_flac(f):
+  with open(f,'rb') as fh:
+    m = mmap.mmap(fh.fileno(),0,access=mmap.ACCESS_READ)
+    try:
+      pos = id3_size(m[:10])
+      expected = bytes(m[pos+26:pos+42]).hex()
+    finally:
+      m.close()
+  md5 = hashlib.md5()
+  crc = 0
+  p = subprocess.Popen(['flac','-d','-c','-s','--force-raw-format','--endian=little','--sign=signed',f],
+                       stdout=subprocess.PIPE,stderr=subprocess.PIPE)
+  for buf in iter(lambda: p.stdout.read(1<<20),b''):
+    md5.update(buf)
+    crc = zlib.crc32(buf,crc)
+  err = p.stderr.read().decode(errors='replace').strip()
+  if p.wait() < 0:
+    raise Exception('flac was killed by signal {}'.format(-p.returncode))
+  if p.returncode != 0:
+    raise Damaged('flac could not decode it: {}'.format(err.splitlines()[-1] if err else 'exit status {}'.format(p.returncode)))
+  if expected == '0'*32:
+    return {'crc32':'{:08X}'.format(crc),'note':'no MD5 in STREAMINFO to check against'}
+  if md5.hexdigest() != expected:
+    raise Damaged('decoded audio does not match the STREAMINFO MD5')
+  return {'crc32':'{:08X}'.format(crc)}
+
+# MP3: walk every frame from the first to the last, checking that each
+# header is valid and follows on from the one before, that the last frame
+# is whole, and that the count agrees with the Xing/Info header
+def verify_mp3(m):
+  pos = mp3_start(m)
+  declared = None
+  frames = 0
+  while pos+4 <= len(m):
+    if m[pos] != 0xff or m[pos+1] & 0xe0 != 0xe0:
+      if bytes(m[pos:pos+3]) == b'TAG' or bytes(m[pos:pos+8]) in (b'APETAGEX',b'LYRICS20'):
+        break
+      raise Damaged('lost frame sync at byte {:,} after {} frames'.format(pos,frames))
+    h = mp3_header(m,pos)
+    if h == None:
+      raise Damaged('bad frame header at byte {:,}'.format(pos))
+    version,rate,kbps,length = h
+    if pos+length > len(m):
+      raise Damaged('last frame cut short at byte {:,}'.format(pos))
+    if frames == 0 and declared == None:
+      side = (32 if m[pos+3] >> 6 != 3 else 17) if version == 3 else (17 if m[pos+3] >> 6 != 3 else 9)
+      x = pos+4+side
+      if m[x:x+4] in (b'Xing',b'Info'):
+        declared = int.from_bytes(m[x+8:x+12],'big') if m[x+7] & 0x1 else -1
+        pos = pos+length
+        continue
+    frames = frames+1
+    pos = pos+length
+  if frames == 0:
+    raise Damaged('no MPEG audio frames')
+  if declared != None and declared >= 0 and declared != frames:
+    raise Damaged('{} frames, but the Xing/Info header says {}'.format(frames,declared))
+  return {}
+
+# MP4: verify.py's check of the audio track's sample tables, which also
+# makes sure that every chunk of samples lies within the file
+def verify_mp4(f):
+  try:
+    headers.m4a_info(f)
+  except OSError:
+    raise
+  except Exception as e:
+    raise Damaged(str(e))
+  return {}
+
+# Verify one file
+def verify(f):
+  if f[-5:] == '.flac':
+    return verify_flac(f)
+  if f[-4:] == '.m4a':
+    return verify_mp4(f)
+  with open(f,'rb') as fh:
+    m = mmap.mmap(fh.fileno(),0,access=mmap.ACCESS_READ)
+    try:
+      return verify_mp3(m)
+    finally:
+      m.close()
+
+# Verify a file unless it was verified before.  Results are kept by the
+# hash of the file, and the hash by path, size and modification time, so
+# an unchanged file is not even read again.  Only verdicts are kept: a
+# file that could not be read, or a decoder that could not be run, is
+# an error for this run alone.
+def verify_cached(f):
+  st = os.stat(f)
+  known = verified['files'].get(os.path.realpath(f))
+  if known != None and known[:2] == [st.st_size,st.st_mtime_ns]:
+    key = known[2]
+  else:
+    key = file_hash(f)
+    verified['files'][os.path.realpath(f)] = [st.st_size,st.st_mtime_ns,key]
+  if key not in verified['results']:
+    try:
+      verified['results'][key] = verify(f)
+    except Damaged as e:
+      verified['results'][key] = {'error':str(e)}
+  return verified['results'][key]
+
+def album_path(j,f):
+  return f if j['prefix'] == None else '/'.join([j['prefix'],f])
+
+if args.verify:
+  print()
+  print('Verifying {} audio file(s)...'.format(len(tracks)))
+  try:
+    with open(args.verify_cache,'r') as f:
+      verified = json.load(f)
+  except (FileNotFoundError,ValueError):
+    verified = {'files':{},'results':{}}
+  problems = []
+  try:
+    with ThreadPoolExecutor(max_workers=min(args.jobs,len(os.sched_getaffinity(0)))) as pool:
+      files = list(dict.fromkeys([album_path(j,tt['file']) for j,tt in tracks]))
+      checked = dict(zip(files,pool.map(verify_cached,files)))
+  finally:
+    save_cache(args.verify_cache,verified)
+  for f,r in checked.items():
+    if 'error' in r.keys():
+      problems.extend(['{}: {}'.format(f,r['error'])])
+    elif 'note' in r.keys():
+      print('  {}: {}'.format(f,r['note']))
+
+  # Cross-check the rip logs against the decoded audio of their disc: one
+  # CRC per file, whether the disc was ripped to tracks or to an image
+  for j in albums:
+    for log in j['logs'] or []:
+      crcs,null_samples = headers.log_crcs(album_path(j,log['file']))
+      disc = sorted([tt for tt in j['tracks'] if tt['disc'] == log['disc']],key=lambda x: x['track'])
+      files = list(dict.fromkeys([album_path(j,tt['file']) for tt in disc]))
+      if len(disc) == 0:
+        problems.extend(['{}: no tracks on disc {}'.format(log['file'],log['disc'])])
+      elif len(crcs) == 0:
+        print('  {}: no track CRCs to check'.format(log['file']))
+      elif not null_samples:
+        print('  {}: CRCs leave out null samples, not checked'.format(log['file']))
+      elif len(crcs) == len(files):
+        for crc,f in zip(crcs,files):
+          got = checked[f].get('crc32')
+          if got != None and got != crc:
+            problems.extend(['{}: CRC {} does not match {} in {}'.format(f,got,crc,log['file'])])
+      elif len(crcs) == len(disc) or log['range_rip']:
+        print('  {}: {} CRC(s) for {} file(s), not checked'.format(log['file'],len(crcs),len(files)))
+      else:
+        problems.extend(['{}: {} track CRC(s) for {} track(s) on disc {}'.format(log['file'],len(crcs),len(disc),log['disc'])])
+
+  if len(problems) > 0:
+    raise Exception('{} problem(s) found:\n  {}'.format(len(problems),'\n  '.join(problems)))
+  print('All audio files verified.')
+
 # Output Metadata JSON
 with open('metadata.json','w') as outjson:
   json.dump(metadata,outjson,indent=2)
@@ -0,0 +1,219 @@
+#!/bin/env python3
+
+# estimate.py
+#
+# This script estimates the resources that processing each archive will
+# take, so that qmus and qhos can ask the queue for them: walltime, memory
+# and local scratch space.  Only the ZIP central directory is read (member
+# names and uncompressed sizes), never the audio itself.
+#
+# With results files written by batch.py at hand, the walltime and memory
+# estimates come from past runs of the same kind of archive and codec
+# profile (the slow end of them, to be safe); without, from rough
+# encoding speeds.  Small archives can be packed together into one job so
+# that each job runs for a while instead of each single taking a slot.
+
+import argparse
+import os
+import json
+import math
+import zipfile
+import datetime
+from pathlib import Path
+
+# Define terminal colors
+class bcolors:
+  HEADER = '\033[95m'
+  OKBLUE = '\033[94m'
+  OKGREEN = '\033[92m'
+  WARNING = '\033[93m'
+  FAIL = '\033[91m'
+  ENDC = '\033[0m'
+  BOLD = '\033[1m'
+  UNDERLINE = '\033[4m'
+
+# Control parameters
+# CPU seconds per byte of archive, for music (FLAC sources) and for one
+# HoS voiceover setting, when there are no past runs to go by.  They
+# follow from the realtime factors in music.py.
+default_work = {('music','mp3'):3.7e-7,('music','aac'):2.0e-7,
+                ('hos','mp3'):7.0e-7,('hos','aac'):4.0e-7}
+# How much bigger a source is once decoded to wave
+expansion = {'.flac':1.8,'.wav':1.0,'.mp3':5.5,'.m4a':5.5,'.ts':5.5}
+# Past runs needed before they are trusted over the defaults
+min_history = 3
+# Margin on the estimates, and the least walltime and memory asked for
+safety = 1.5
+min_walltime = 600
+min_memory = 512
+# Rate of staging and organizing, bytes per second, and the fixed cost of
+# an archive in seconds
+io_rate = 100e6
+overhead = 60
+# Walltimes are rounded up to one of these, so that jobs fall into a few
+# classes (and SLURM job arrays)
+walltime_classes = [900,1800,3600,7200,14400,28800,43200,86400,172800]
+
+# Parse arguments
+parser = argparse.ArgumentParser(description='Estimate the walltime, memory and scratch space for archives.')
+parser.add_argument('archives',metavar='archive.zip',nargs='+',
+                    help='Music or HoS program archives.')
+parser.add_argument('--hos',action='store_true',dest='hos',
+                    help='The archives are Hearts of Space programs.')
+parser.add_argument('-v','--voiceover',metavar='SETTING',dest='voiceover',default='intro',
+                    choices={'intro','on','off','all'},
+                    help='HoS voiceover setting, or all. (Default: intro)')
+parser.add_argument('-c','--codec',metavar='CODEC',dest='codec',default='mp3',choices={'mp3','aac'},
+                    help='Output codec. (Default: mp3)')
+parser.add_argument('-b','--bitrate',metavar='BITRATE',dest='bitrate',
+                    help='Encoding bitrate, as for music.py/hos.py.')
+parser.add_argument('-g','--gapless',action='store_true',dest='gapless',
+                    help='Discs are encoded whole (music.py -g), so all their tracks are decoded at once.')
+parser.add_argument('-p','--cpus',metavar='N',type=int,dest='cpus',default=1,
+                    help='CPUs per job. (Default: 1)')
+parser.add_argument('-s','--stage',action='store_true',dest='stage',
+                    help='The archives are copied into scratch first (batch.py --stage).')
+parser.add_argument('-r','--results',metavar='FILE',dest='results',action='append',default=[],
+                    help='Results file of past runs; may be given more than once.')
+parser.add_argument('-P','--pack',metavar='SECONDS',type=int,dest='pack',default=0,
+                    help='Pack archives into jobs of about this walltime. (Default: one archive per job)')
+parser.add_argument('-n','--max',metavar='N',type=int,dest='max',default=0,
+                    help='At most this many archives per job. (Default: no limit)')
+parser.add_argument('-S','--shards',metavar='N',type=int,dest='shards',default=1,
+                    help='Each archive is split into this many shard jobs (music.py --shard), read in place. '
+                         'Archives are not packed. (Default: 1)')
+parser.add_argument('--tsv',action='store_true',dest='tsv',
+                    help='Print one line per job for the submit scripts: walltime (s), memory (MB), '
+                         'scratch (MB) and the archives, separated by tabs.')
+args=parser.parse_args()
+
+if args.shards < 1 or (args.shards > 1 and args.hos):
+  parser.error('--shards must be at least 1, and is only for music archives.')
+
+kind = 'hos' if args.hos else 'music'
+profile = '{} {}'.format(args.codec,args.bitrate or {'mp3':'V2','aac':'256'}[args.codec])
+nvo = 3 if args.hos and args.voiceover == 'all' else 1
+
+# A percentile of a list of numbers, nearest rank
+def percentile(values,p):
+  values = sorted(values)
+  return values[min(len(values)-1,int(len(values)*p/100))]
+
+# Past runs of this kind of archive and codec profile
+history = []
+for r in args.results:
+  if not Path(r).is_file():
+    continue
+  with open(r,'r') as f:
+    for line in f:
+      try:
+        x = json.loads(line)
+      except ValueError:
+        continue
+      if (x.get('kind') == kind and x.get('profile') == profile and x.get('status') == 'ok'
+          and x.get('bytes_in',0) > 0 and x['wall_seconds'].get('total',0) > 0):
+        history.extend([x])
+
+def vos(x):
+  return 3 if x.get('voiceover') == 'all' else 1
+
+# Walltime per byte of archive.  Runs with the same number of CPUs give it
+# directly; otherwise it follows from the CPU time, spread over the CPUs.
+# The 90th percentile is used, as a job that runs out of time is lost.
+same = [x for x in history if x['cpus'] == args.cpus]
+if len(same) >= min_history:
+  basis = '{} past runs'.format(len(same))
+  wall_rate = percentile([x['wall_seconds']['total']/x['bytes_in']/vos(x) for x in same],90)
+  work_rate = None
+elif len(history) >= min_history:
+  basis = '{} past runs, other CPU counts'.format(len(history))
+  wall_rate = None
+  work_rate = percentile([x['cpu_seconds']/x['bytes_in']/vos(x) for x in history],90)
+else:
+  basis = 'defaults'
+  wall_rate = None
+  work_rate = default_work[(kind,args.codec)]
+
+# Memory: the largest process seen, for the script and each encoder it
+# runs at once
+rss = [x['max_rss_mb'] for x in history if x.get('max_rss_mb')]
+if len(rss) >= min_history:
+  memory = max(rss) * (args.cpus+1)
+else:
+  memory = 256 * (args.cpus+1)
+
+# Estimate each archive from its central directory
+archives = []
+for z in args.archives:
+  if not zipfile.is_zipfile(z):
+    raise Exception(f"{bcolors.FAIL}ERROR: {z} is not a valid ZIP file!{bcolors.ENDC}")
+  with zipfile.ZipFile(z) as zf:
+    infos = zf.infolist()
+  size = Path(z).stat().st_size
+  if args.hos:
+    # hos.py works one track at a time.  The whole program is decoded, then
+    # split into one wave per track.
+    tracks = 1
+    settings = ['intro','on','off'] if args.voiceover == 'all' else [args.voiceover]
+    scratch = max([sum([x.file_size for x in infos if x.filename[-3:] == '.ts' and '/vo-{}/'.format(vo) in '/'+x.filename])
+                   for vo in settings]) * expansion['.ts'] * 2
+  else:
+    audio = [x for x in infos if Path(x.filename).suffix.lower() in ('.flac','.wav','.mp3','.m4a')]
+    tracks = len(audio)
+    wav = sorted([x.file_size * expansion[Path(x.filename).suffix.lower()] for x in audio],reverse=True)
+    # Up to --cpus tracks are decoded at once, or with --gapless a whole disc
+    scratch = sum(wav) if args.gapless else sum(wav[:args.cpus])
+  if args.stage:
+    scratch = scratch + size
+  if wall_rate != None:
+    wall = wall_rate * size * nvo
+  else:
+    wall = work_rate * size * nvo / max(1,min(args.cpus,tracks)) + size*2/io_rate + overhead
+  # A shard does its share of the work, and reads only its own tracks
+  if args.shards > 1:
+    wall = max(wall - overhead,0) / args.shards + overhead
+    if args.gapless:
+      scratch = max(sum(wav) / args.shards, wav[0] if wav else 0)
+  archives.extend([{'zip':os.path.realpath(z),'name':Path(z).stem,'size':size,'tracks':tracks,
+                    'wall':wall*safety,'scratch':scratch*safety}])
+
+# Pack the archives into jobs, smallest first, until a job reaches the
+# packing walltime.  batch.py stages the next archive of a job while the
+# current one encodes, so two archives may share scratch at a time.
+jobs = []
+for a in sorted(archives,key=lambda x: x['wall']):
+  if (len(jobs) > 0 and args.shards == 1 and sum([x['wall'] for x in jobs[-1]]) + a['wall'] <= args.pack
+      and (args.max < 1 or len(jobs[-1]) < args.max)):
+    jobs[-1].extend([a])
+  else:
+    jobs.extend([[a]])
+
+# Round the requests up
+def round_walltime(s):
+  s = max(s,min_walltime)
+  for c in walltime_classes:
+    if s <= c:
+      return c
+  return math.ceil(s/86400)*86400
+
+def round_memory(mb):
+  return 2**math.ceil(math.log2(max(mb*safety,min_memory)))
+
+plan = []
+for j in jobs:
+  plan.extend([{'wall':round_walltime(sum([x['wall'] for x in j])),
+                'memory':round_memory(memory),
+                'scratch':1024*math.ceil(sum(sorted([x['scratch'] for x in j],reverse=True)[:2])/2**30),
+                'archives':j}])
+
+if args.tsv:
+  for p in plan:
+    print('\t'.join([str(p['wall']),str(p['memory']),str(p['scratch'])]+[x['zip'] for x in p['archives']]))
+  quit(0)
+
+print('Estimates for {} {} from {}{}:'.format(kind,profile,basis,', per shard of {}'.format(args.shards) if args.shards > 1 else ''))
+print('{:>3}  {:>10}  {:>8}  {:>9}  {}'.format('Job','Walltime','Memory','Scratch','Archives'))
+print('-'*79)
+for i,p in enumerate(plan):
+  print('{:>3}  {:>10}  {:>5} MB  {:>6} MB  {}'.format(i+1,str(datetime.timedelta(seconds=p['wall'])),p['memory'],p['scratch'],
+        ', '.join(['{} ({:.0f} MB, {})'.format(x['name'],x['size']/1e6,datetime.timedelta(seconds=round(x['wall']))) for x in p['archives']])))
@@ -0,0 +1,249 @@
+#!/bin/env python3
+
+# hosbench.py
+#
+# This script times the stages of processing a Hearts of Space program
+# on fake programs built by hosfake.py, across program lengths, track
+# counts and the known listing problems: validation (hos.py -t),
+# concatenation of the TS segments, decoding, splitting into tracks, and
+# encoding.  The split is done in several ways, and each is checked
+# against the true track boundaries:
+#
+#   atrim    one ffmpeg atrim per track over the whole program (hos.py)
+#   seek     one ffmpeg per track, seeking to the start of the track
+#   segment  one ffmpeg for all tracks, with the segment muxer
+#   python   in-process, copying sample frames out of the wave file
+
+import argparse
+import os
+import json
+import time
+import wave
+import shutil
+import tempfile
+import datetime
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+# Define terminal colors
+class bcolors:
+  HEADER = '\033[95m'
+  OKBLUE = '\033[94m'
+  OKGREEN = '\033[92m'
+  WARNING = '\033[93m'
+  FAIL = '\033[91m'
+  ENDC = '\033[0m'
+  BOLD = '\033[1m'
+  UNDERLINE = '\033[4m'
+
+strategies = ['atrim','seek','segment','python']
+problems = ['none','duplicate','gap','late-start']
+
+# Parse arguments
+parser = argparse.ArgumentParser(description='Benchmark the stages of hos.py on fake programs.')
+parser.add_argument('-l','--lengths',metavar='SECONDS',dest='lengths',default='600,3600',
+                    help='Comma-separated program lengths in seconds. (Default: 600,3600)')
+parser.add_argument('-n','--tracks',metavar='N',dest='tracks',default='1,8,30',
+                    help='Comma-separated track counts. (Default: 1,8,30)')
+parser.add_argument('-e','--problems',metavar='PROBLEM',dest='problems',default=','.join(problems),
+                    help='Comma-separated listing problems, of {}. (Default: all)'.format(', '.join(problems)))
+parser.add_argument('-s','--strategies',metavar='STRATEGY',dest='strategies',default=','.join(strategies),
+                    help='Comma-separated split strategies, of {}. (Default: all)'.format(', '.join(strategies)))
+parser.add_argument('-j','--jobs',metavar='N',type=int,dest='jobs',default=1,
+                    help='Number of tracks to split or encode at once. (Default: 1)')
+parser.add_argument('--no-encode',action='store_false',dest='encode',
+                    help='Skip the encoding stage.')
+parser.add_argument('-t','--tmpdir',metavar='DIR',dest='tmpdir',default=tempfile.gettempdir(),
+                    help='Directory for the fake programs and scratch files. (Default: {})'.format(tempfile.gettempdir()))
+parser.add_argument('-k','--keep',action='store_true',dest='keep',
+                    help='Keep the fake programs and scratch files.')
+parser.add_argument('-o','--output',metavar='FILE',dest='output',
+                    help='Also append the timings to this JSONL file.')
+args=parser.parse_args()
+
+for x in args.strategies.split(','):
+  if x not in strategies:
+    raise Exception(f"{bcolors.FAIL}ERROR: Unknown split strategy '{x}'. Choose from {strategies}.{bcolors.ENDC}")
+for x in args.problems.split(','):
+  if x not in problems:
+    raise Exception(f"{bcolors.FAIL}ERROR: Unknown listing problem '{x}'. Choose from {problems}.{bcolors.ENDC}")
+
+here = os.path.dirname(os.path.realpath(__file__))
+
+def run(cmd,cwd=None):
+  subprocess.run(cmd,cwd=cwd,check=True,stdout=subprocess.DEVNULL,stderr=subprocess.DEVNULL)
+
+# Time a function call
+def timed(fn,*a):
+  t0 = time.perf_counter()
+  fn(*a)
+  return time.perf_counter() - t0
+
+# The TS segments of a voiceover setting, in playlist order
+def segments(program,vo):
+  d = os.path.join(program,'api.hos.com','vo-{}'.format(vo))
+  master = [x for x in Path(d).glob('pgm*.m3u8')][0]
+  url = [x.strip() for x in master.read_text().splitlines() if '256k' in x][0]
+  playlist = os.path.join(d,url)
+  return [os.path.join(os.path.dirname(playlist),x.strip())
+          for x in Path(playlist).read_text().splitlines() if '.ts' in x]
+
+def concatenate(segs,path):
+  with open(path,'wb') as dst:
+    for ts in segs:
+      with open(ts,'rb') as src:
+        shutil.copyfileobj(src,dst,1<<20)
+
+# Decode the way hos.py does, with the segments fed to ffmpeg's standard
+# input
+def decode(segs,path):
+  p = subprocess.Popen(['ffmpeg','-y','-f','mpegts','-i','-','-acodec','pcm_s16le',path],
+                       stdin=subprocess.PIPE,stdout=subprocess.DEVNULL,stderr=subprocess.DEVNULL)
+  try:
+    for ts in segs:
+      with open(ts,'rb') as src:
+        shutil.copyfileobj(src,p.stdin,1<<20)
+  finally:
+    p.stdin.close()
+  if p.wait() != 0:
+    raise subprocess.CalledProcessError(p.returncode,'ffmpeg')
+
+# The split strategies.  Each writes track001.wav, track002.wav, ... to a
+# directory.
+def split_atrim(wav,tracks,d):
+  def one(i):
+    x = tracks[i]
+    out = os.path.join(d,'track{:03}.wav'.format(i+1))
+    if len(tracks) == 1:
+      shutil.copyfile(wav,out)
+    elif i == 0:
+      run(['ffmpeg','-i',wav,'-af','atrim=end={}'.format(x['start']+x['duration']),out])
+    elif i < len(tracks)-1:
+      run(['ffmpeg','-i',wav,'-af','atrim={}:{}'.format(x['start'],x['start']+x['duration']),out])
+    else:
+      run(['ffmpeg','-i',wav,'-af','atrim=start={}'.format(x['start']),out])
+  with ThreadPoolExecutor(max_workers=args.jobs) as pool:
+    list(pool.map(one,range(len(tracks))))
+
+def split_seek(wav,tracks,d):
+  def one(i):
+    x = tracks[i]
+    cmd = ['ffmpeg','-ss',str(x['start']),'-i',wav]
+    if i < len(tracks)-1:
+      cmd.extend(['-t',str(x['duration'])])
+    run(cmd+['-acodec','pcm_s16le',os.path.join(d,'track{:03}.wav'.format(i+1))])
+  with ThreadPoolExecutor(max_workers=args.jobs) as pool:
+    list(pool.map(one,range(len(tracks))))
+
+def split_segment(wav,tracks,d):
+  cmd = ['ffmpeg','-i',wav,'-c','copy','-f','segment','-segment_start_number','1']
+  if len(tracks) > 1:
+    cmd.extend(['-segment_times',','.join([str(x['start']) for x in tracks[1:]])])
+  run(cmd+[os.path.join(d,'track%03d.wav')])
+
+def split_python(wav,tracks,d):
+  with wave.open(wav,'rb') as src:
+    rate = src.getframerate()
+    for i,x in enumerate(tracks):
+      n = src.getnframes() - src.tell() if i == len(tracks)-1 else round((x['start']+x['duration'])*rate) - src.tell()
+      with wave.open(os.path.join(d,'track{:03}.wav'.format(i+1)),'wb') as dst:
+        dst.setparams(src.getparams())
+        dst.writeframes(src.readframes(n))
+
+split = {'atrim':split_atrim,'seek':split_seek,'segment':split_segment,'python':split_python}
+
+# The largest error of the track boundaries of a split, in milliseconds.
+# The last track runs to the end of the decoded audio, whatever its
+# length.
+def boundary_error(tracks,d,rate):
+  files = sorted(Path(d).glob('track*.wav'))
+  if len(files) != len(tracks):
+    print(f"{bcolors.WARNING}WARNING: {len(files)} tracks in {d}, should be {len(tracks)}.{bcolors.ENDC}")
+    return None
+  error = 0
+  end = 0
+  for i,(x,f) in enumerate(zip(tracks,files)):
+    with wave.open(str(f),'rb') as w:
+      end = end + w.getnframes()
+    if i < len(tracks)-1:
+      error = max(error,abs(end - (x['start']+x['duration'])*rate))
+  return error / rate * 1000
+
+def encode(d):
+  def one(f):
+    run(['lame','-m','j','-V','2','-q','0',str(f),str(f.with_suffix('.mp3'))])
+  with ThreadPoolExecutor(max_workers=args.jobs) as pool:
+    list(pool.map(one,sorted(Path(d).glob('track*.wav'))))
+
+# Run the benchmark for each kind of program
+results = []
+os.makedirs(args.tmpdir,exist_ok=True)
+work = tempfile.mkdtemp(prefix='hosbench.',dir=args.tmpdir)
+try:
+  for length in [int(x) for x in args.lengths.split(',')]:
+    for ntracks in [int(x) for x in args.tracks.split(',')]:
+      for problem in args.problems.split(','):
+        if (problem == 'gap' and ntracks < 3) or (problem == 'late-start' and ntracks < 2):
+          continue
+        case = '{}s-{}tr-{}'.format(length,ntracks,problem)
+        program = os.path.join(work,case)
+        print(f"{bcolors.BOLD}{case}{bcolors.ENDC}")
+        cmd = [os.path.join(here,'hosfake.py'),'-l',str(length),'-n',str(ntracks),program]
+        if problem != 'none':
+          cmd.extend(['--{}'.format(problem)])
+        run(cmd)
+        with open(os.path.join(program,'fixture.json'),'r') as f:
+          fixture = json.load(f)
+        tracks = fixture['tracks']
+        scratch = os.path.join(work,'scratch')
+        os.makedirs(scratch)
+
+        timings = []
+        timings.extend([('validate','',timed(run,[os.path.join(here,'hos.py'),'-t',os.path.realpath(program)],scratch),None)])
+        segs = segments(program,'intro')
+        timings.extend([('concatenate','',timed(concatenate,segs,os.path.join(scratch,'pgm.ts')),None)])
+        wav = os.path.join(scratch,'pgm.wav')
+        timings.extend([('decode','',timed(decode,segs,wav),None)])
+        for s in args.strategies.split(','):
+          d = os.path.join(scratch,s)
+          os.makedirs(d)
+          t = timed(split[s],wav,tracks,d)
+          timings.extend([('split',s,t,boundary_error(tracks,d,fixture['sample_rate']))])
+        if args.encode:
+          timings.extend([('encode','',timed(encode,os.path.join(scratch,args.strategies.split(',')[0])),None)])
+
+        for stage,strategy,seconds,error in timings:
+          print('  {:12} {:8} {:>9.2f}s  {:>8.0f}x realtime{}'.format(stage,strategy,seconds,length/seconds if seconds > 0 else 0,
+                '' if error == None else '  boundary error {:.1f} ms'.format(error)))
+          results.extend([{'time':datetime.datetime.now().isoformat(timespec='seconds'),'length':length,'tracks':ntracks,
+                           'problem':problem,'stage':stage,'strategy':strategy,'jobs':args.jobs,
+                           'seconds':round(seconds,3),'boundary_error_ms':error}])
+        print()
+        if not args.keep:
+          shutil.rmtree(scratch)
+          shutil.rmtree(program)
+        else:
+          os.rename(scratch,os.path.join(work,'{}.scratch'.format(case)))
+finally:
+  if not args.keep:
+    shutil.rmtree(work,ignore_errors=True)
+  else:
+    print('Kept the programs and scratch files in {}'.format(work))
+
+# The fastest split strategy for each kind of program
+print('#'*79)
+print('{} FASTEST SPLIT {}'.format('#'*32,'#'*32))
+print('#'*79)
+cases = {}
+for x in results:
+  if x['stage'] == 'split':
+    cases.setdefault((x['length'],x['tracks'],x['problem']),[]).extend([x])
+for (length,ntracks,problem),xs in cases.items():
+  best = min(xs,key=lambda x: x['seconds'])
+  print('{:>6}s {:>3} tracks {:11} {:8} {:.2f}s'.format(length,ntracks,problem,best['strategy'],best['seconds']))
+
+if args.output != None:
+  with open(args.output,'a') as f:
+    for x in results:
+      f.write(json.dumps(x)+'\n')
@@ -0,0 +1,176 @@
+#!/bin/env python3
+
+# hosfake.py
+#
+# This script builds a fake Hearts of Space program in the layout of a
+# downloaded api.hos.com tree, for trying out hos.py and for hosbench.py:
+# the program JSON with its albums and tracks, the play JSON, the master
+# and 256k playlists of the three voiceover settings, TS segments of
+# generated tones (a different tone for each track), and the album and
+# program images.  The audio is the same for all three voiceover settings.
+#
+# The known problems of real program listings can be put into the JSON
+# (--duplicate, --gap, --late-start); the audio is not changed by them.
+# The true track boundaries are written to fixture.json next to the
+# api.hos.com tree.
+
+import argparse
+import os
+import json
+import random
+import shutil
+import zipfile
+import subprocess
+from pathlib import Path
+
+# Define terminal colors
+class bcolors:
+  HEADER = '\033[95m'
+  OKBLUE = '\033[94m'
+  OKGREEN = '\033[92m'
+  WARNING = '\033[93m'
+  FAIL = '\033[91m'
+  ENDC = '\033[0m'
+  BOLD = '\033[1m'
+  UNDERLINE = '\033[4m'
+
+# Parse arguments
+parser = argparse.ArgumentParser(description='Build a fake Hearts of Space program for testing and benchmarking.')
+parser.add_argument('destination',metavar='destination',
+                    help='Directory to build the program in.')
+parser.add_argument('-p','--program',metavar='NUMBER',type=int,dest='pgm',default=123,
+                    help='Program number. (Default: 123)')
+parser.add_argument('-n','--tracks',metavar='N',type=int,dest='tracks',default=8,
+                    help='Number of tracks. (Default: 8)')
+parser.add_argument('-l','--length',metavar='SECONDS',type=int,dest='length',default=600,
+                    help='Program length in seconds. (Default: 600)')
+parser.add_argument('-s','--segment',metavar='SECONDS',type=int,dest='segment',default=10,
+                    help='Length of the TS segments in seconds. (Default: 10)')
+parser.add_argument('--seed',metavar='N',type=int,dest='seed',default=0,
+                    help='Seed for the track lengths. (Default: 0)')
+parser.add_argument('--duplicate',action='store_true',dest='duplicate',
+                    help='List one track twice, as in program 0785.')
+parser.add_argument('--gap',action='store_true',dest='gap',
+                    help='Leave one track in the middle out of the listing.')
+parser.add_argument('--late-start',action='store_true',dest='late_start',
+                    help='Leave the first track out of the listing.')
+parser.add_argument('-z','--zip',action='store_true',dest='zip',
+                    help='Also pack the program into destination.zip.')
+args=parser.parse_args()
+
+if args.tracks < 1 or args.length < args.tracks:
+  raise Exception(f"{bcolors.FAIL}ERROR: Need at least one track, and at least one second per track.{bcolors.ENDC}")
+if args.gap and args.tracks < 3:
+  raise Exception(f"{bcolors.FAIL}ERROR: --gap needs at least 3 tracks.{bcolors.ENDC}")
+if args.late_start and args.tracks < 2:
+  raise Exception(f"{bcolors.FAIL}ERROR: --late-start needs at least 2 tracks.{bcolors.ENDC}")
+
+pgm = '{:04}'.format(args.pgm)
+root = os.path.join(args.destination,'api.hos.com')
+sample_rate = 44100
+
+def run(cmd):
+  print('{}{}{}'.format(bcolors.OKGREEN,cmd,bcolors.ENDC))
+  subprocess.run(cmd,check=True,stdout=subprocess.DEVNULL,stderr=subprocess.DEVNULL)
+
+def write(name,data):
+  path = os.path.join(root,name)
+  os.makedirs(os.path.dirname(path),exist_ok=True)
+  with open(path,'w') as f:
+    f.write(data)
+
+# Split the program into tracks of whole seconds, of random lengths within
+# a factor of three of each other, each with its own tone
+rng = random.Random(args.seed)
+weights = [rng.uniform(0.5,1.5) for i in range(args.tracks)]
+durations = [max(1,int(args.length*w/sum(weights))) for w in weights]
+durations[-1] = durations[-1] + args.length - sum(durations)
+tracks = []
+for i,d in enumerate(durations):
+  tracks.extend([{'title':'Track {}'.format(i+1),
+                  'artists':[{'name':'artist {}'.format(i%3+1)}],
+                  'startPositionInStream':sum(durations[:i]),
+                  'duration':d,
+                  'frequency':220+20*i}])
+
+# Group the tracks into albums of one to three tracks
+albums = []
+i = 0
+while i < len(tracks):
+  n = rng.randint(1,3)
+  albums.extend([{'id':1000+len(albums),'title':'Album {}'.format(len(albums)+1),
+                  'tracks':[dict(x) for x in tracks[i:i+n]]}])
+  i = i + n
+listed = [x for album in albums for x in album['tracks']]
+for x in listed:
+  del x['frequency']
+
+# Put the requested problems into the listing
+if args.gap:
+  gone = listed[len(listed)//2]
+  for album in albums:
+    album['tracks'] = [x for x in album['tracks'] if x is not gone]
+if args.late_start:
+  albums[0]['tracks'] = albums[0]['tracks'][1:]
+albums = [album for album in albums if len(album['tracks']) > 0]
+if args.duplicate:
+  album = albums[len(albums)//2]
+  album['tracks'].insert(0,dict(album['tracks'][0]))
+
+# Program and play JSON
+program = {'id':args.pgm,'title':'a fake program of {} tracks'.format(args.tracks),
+           'date':'2001-02-03','producer':'Stephen Hill',
+           'genres':[{'name':'Ambient'}],'albums':albums}
+write('api/v1/programs/{}'.format(args.pgm),json.dumps(program))
+write('api/v1/player/play',json.dumps({'signedUrl':'https://example.com/vo-intro/pgm{}.m3u8?sig=0'.format(pgm)}))
+
+# The audio, one tone after another, encoded to AAC in MPEG-TS segments
+# with their EXTINF playlist by the ffmpeg HLS muxer
+segdir = os.path.join(root,'vo-on','256k')
+os.makedirs(segdir,exist_ok=True)
+cmd = ['ffmpeg','-y','-loglevel','error']
+for x in tracks:
+  cmd.extend(['-f','lavfi','-i','sine=frequency={}:duration={}:sample_rate={}'.format(x['frequency'],x['duration'],sample_rate)])
+cmd.extend(['-filter_complex','{}concat=n={}:v=0:a=1[a]'.format(''.join(['[{}:a]'.format(i) for i in range(len(tracks))]),len(tracks)),
+            '-map','[a]','-ac','2','-c:a','aac','-b:a','256k',
+            '-f','hls','-hls_time',str(args.segment),'-hls_list_size','0',
+            '-hls_segment_filename',os.path.join(segdir,'s%05d.ts'),
+            os.path.join(segdir,'pgm{}_256k.m3u8'.format(pgm))])
+run(cmd)
+for vo in ('intro','off'):
+  shutil.copytree(segdir,os.path.join(root,'vo-{}'.format(vo),'256k'),dirs_exist_ok=True)
+# The master playlists list only the 256k variant, the one that is
+# downloaded (hos.py warns about any file the playlists do not name)
+for vo in ('intro','on','off'):
+  write('vo-{}/pgm{}.m3u8'.format(vo,pgm),
+        '#EXTM3U\n#EXT-X-STREAM-INF:BANDWIDTH=256000\n256k/pgm{0}_256k.m3u8\n'.format(pgm))
+
+# Images, a plain colour square of each size
+for r in (80,150):
+  for album in albums:
+    path = os.path.join(root,'api/v1/images-repo/albums/w/{}/{}.jpg'.format(r,album['id']))
+    os.makedirs(os.path.dirname(path),exist_ok=True)
+    run(['ffmpeg','-y','-loglevel','error','-f','lavfi','-i','color=c=navy:s={0}x{0}'.format(r),'-frames:v','1',path])
+for r in (180,550,1024):
+  path = os.path.join(root,'api/v1/images-repo/programs/w/{}/{}.jpg'.format(r,args.pgm))
+  os.makedirs(os.path.dirname(path),exist_ok=True)
+  run(['ffmpeg','-y','-loglevel','error','-f','lavfi','-i','color=c=purple:s={0}x{0}'.format(r),'-frames:v','1',path])
+
+# The true track boundaries, whatever the listing says
+with open(os.path.join(args.destination,'fixture.json'),'w') as f:
+  json.dump({'program':pgm,'length':args.length,'sample_rate':sample_rate,
+             'tracks':[{'start':x['startPositionInStream'],'duration':x['duration'],'frequency':x['frequency']} for x in tracks]},f,indent=2)
+
+# Pack the program, under a directory named after it.  The TS segments and
+# images are compressed already.
+if args.zip:
+  zipname = '{}.zip'.format(os.path.normpath(args.destination))
+  top = os.path.basename(os.path.normpath(args.destination))
+  with zipfile.ZipFile(zipname,'w',zipfile.ZIP_STORED) as zf:
+    for path in sorted(Path(root).rglob('*')):
+      if path.is_file():
+        zf.write(path,os.path.join(top,str(path.relative_to(args.destination))))
+  print('Wrote {}'.format(zipname))
+
+print('Program {}: {} tracks in {} listed, {} seconds, in {}'.format(
+      pgm,len(tracks),len([x for album in albums for x in album['tracks']]),args.length,args.destination))
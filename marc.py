@@ -0,0 +1,446 @@
+#!/bin/env python3
+
+# marc.py
+#
+# This script archives album directories: the audio directory of each album
+# goes into a ZIP archive (which qmus and batch.py read), and the extra
+# directory, if there is one, into a RAR archive, both next to the album
+# directory.
+#
+# Members are compressed in parallel, and formats that are already
+# compressed (FLAC, MP3, JPEG, ...) are stored rather than run through
+# deflate, which gains nothing on them.  Several albums are archived at
+# once.  The ZIP files are written directly, but are ordinary ZIP files
+# (with ZIP64 extensions only where sizes need them).
+#
+# Each ZIP carries a manifest.json listing every file with its size, CRC,
+# SHA-256 and, for FLAC, the audio MD5 from STREAMINFO.  Re-archiving an
+# album only compresses the files that changed since the manifest was
+# written, and leaves the archive alone if nothing did.  With --check, the
+# arguments are ZIP archives to check against their manifests instead.
+
+import argparse
+import os
+import sys
+import json
+import zlib
+import time
+import hashlib
+import zipfile
+import datetime
+import shutil
+import struct
+import tempfile
+import subprocess
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+# Define terminal colors
+class bcolors:
+  HEADER = '\033[95m'
+  OKBLUE = '\033[94m'
+  OKGREEN = '\033[92m'
+  WARNING = '\033[93m'
+  FAIL = '\033[91m'
+  ENDC = '\033[0m'
+  BOLD = '\033[1m'
+  UNDERLINE = '\033[4m'
+
+# Formats that are already compressed, and are stored as they are
+stored_types = {'.flac','.mp3','.m4a','.aac','.ogg','.oga','.opus','.wv','.ape','.wma',
+                '.jpg','.jpeg','.png','.gif','.webp','.zip','.rar','.7z','.gz','.bz2','.xz'}
+
+# Parse arguments
+parser = argparse.ArgumentParser(description='Archive album directories.')
+parser.add_argument('albums',metavar='album_dir',nargs='+',
+                    help='One or more album directories to archive (with --check, ZIP archives to check).')
+parser.add_argument('-l','--level',metavar='LEVEL',type=int,dest='level',default=9,choices=range(1,10),
+                    help='Deflate compression level for compressible files. (Default: 9)')
+parser.add_argument('-j','--jobs',metavar='N',type=int,dest='jobs',default=len(os.sched_getaffinity(0)),
+                    help='Number of files to compress at once. (Default: number of available CPUs)')
+parser.add_argument('-a','--albums',metavar='N',type=int,dest='concurrent',default=2,
+                    help='Number of albums to archive at once. (Default: 2)')
+parser.add_argument('-f','--force',action='store_true',dest='force',
+                    help='Rebuild existing archives from scratch instead of updating them.')
+parser.add_argument('-c','--check',action='store_true',dest='check',
+                    help='Check ZIP archives against their manifests: members and sizes.')
+parser.add_argument('--full',action='store_true',dest='full',
+                    help='With --check, also read every member and compare its SHA-256.')
+parser.add_argument('--failed',metavar='FILE',dest='failed',
+                    help='With --check, write the archives that failed their check to FILE, one per line.')
+parser.add_argument('-v','--verbose',action='store_true',dest='verbose',
+                    help='Verbose mode.')
+args=parser.parse_args()
+
+if args.jobs < 1 or args.concurrent < 1:
+  parser.error('--jobs and --albums must be at least 1.')
+
+# Archives get the usual permissions, not the 0600 of a temporary file
+umask = os.umask(0)
+os.umask(umask)
+
+# DOS date and time of a file's modification time
+def dos_time(mtime):
+  t = time.localtime(max(mtime,315532800))
+  return ((t.tm_hour<<11) | (t.tm_min<<5) | (t.tm_sec//2),
+          ((t.tm_year-1980)<<9) | (t.tm_mon<<5) | t.tm_mday)
+
+manifest_name = 'manifest.json'
+
+# Checksums of a file, kept up to date as it passes through: the CRC the
+# ZIP needs, the SHA-256 of the whole file, and the first bytes, which for
+# FLAC hold the MD5 of the decoded audio in STREAMINFO
+class Digest:
+  def __init__(self):
+    self.crc = 0
+    self.size = 0
+    self.sha = hashlib.sha256()
+    self.head = b''
+
+  def update(self,buf):
+    self.crc = zlib.crc32(buf,self.crc)
+    self.size = self.size + len(buf)
+    self.sha.update(buf)
+    if len(self.head) < 42:
+      self.head = self.head + buf[:42-len(self.head)]
+
+  # The manifest entry of the file
+  def entry(self,st):
+    e = {'size':self.size,'mtime_ns':st.st_mtime_ns,'crc32':self.crc,'sha256':self.sha.hexdigest()}
+    if len(self.head) == 42 and self.head[:4] == b'fLaC' and self.head[4] & 0x7F == 0:
+      e.update({'flac_md5':self.head[26:42].hex()})
+    return e
+
+# Compress one file with raw deflate into a spool file.  A file that does
+# not get smaller is stored instead, as zip does.
+def deflate(path):
+  d = Digest()
+  spool = tempfile.SpooledTemporaryFile(max_size=1<<26)
+  z = zlib.compressobj(args.level,zlib.DEFLATED,-15)
+  with open(path,'rb') as f:
+    while True:
+      buf = f.read(1<<20)
+      if not buf:
+        break
+      d.update(buf)
+      spool.write(z.compress(buf))
+  spool.write(z.flush())
+  csize = spool.tell()
+  if csize >= d.size:
+    spool.close()
+    return None
+  spool.seek(0)
+  return (d,csize,spool)
+
+# Pass the items through fn on the pool, in order, keeping no more than
+# depth of them in flight
+def bounded_map(pool,fn,items,depth):
+  window = deque()
+  for x in items:
+    window.append(pool.submit(fn,x))
+    if len(window) >= depth:
+      yield window.popleft().result()
+  while window:
+    yield window.popleft().result()
+
+# Write a ZIP file.  Members are (name, path) pairs; directory names end
+# with '/'.  Compressible files are deflated on the pool ahead of the
+# writer; stored files are copied straight in, and unchanged members of an
+# earlier archive are copied over as they are.  Each add returns the
+# file's manifest entry.
+class ZipWriter:
+  def __init__(self,f):
+    self.f = f
+    self.central = []
+
+  def header(self,name,method,crc,csize,usize,mtime,zip64):
+    flags = 0x800 if not name.isascii() else 0
+    dtime,ddate = dos_time(mtime)
+    extra = b''
+    if zip64:
+      extra = struct.pack('<HHQQ',0x0001,16,usize,csize)
+      csize = usize = 0xFFFFFFFF
+    version = 45 if zip64 else 20
+    return (struct.pack('<IHHHHHIIIHH',0x04034b50,version,flags,method,dtime,ddate,
+                        crc,csize,usize,len(name.encode()),len(extra))
+            + name.encode() + extra)
+
+  def add(self,name,path,compressed=None):
+    st = os.stat(path)
+    offset = self.f.tell()
+    d = Digest()
+    if name[-1] == '/':
+      method,crc,csize,usize = 0,0,0,0
+    elif compressed != None:
+      method = 8
+      d,csize,spool = compressed
+      crc,usize = d.crc,d.size
+    else:
+      method,crc,usize = 0,0,st.st_size
+      csize = usize
+    zip64 = usize >= 0xFFFFFFFF or csize >= 0xFFFFFFFF
+    self.f.write(self.header(name,method,crc,csize,usize,st.st_mtime,zip64))
+    if name[-1] == '/':
+      pass
+    elif method == 8:
+      shutil.copyfileobj(spool,self.f,1<<20)
+      spool.close()
+    else:
+      # Stored: copy the file, then go back and fill in its CRC
+      with open(path,'rb') as src:
+        while True:
+          buf = src.read(1<<20)
+          if not buf:
+            break
+          d.update(buf)
+          self.f.write(buf)
+      if d.size != csize:
+        raise Exception('{} changed size while being archived.'.format(path))
+      crc = d.crc
+      end = self.f.tell()
+      self.f.seek(offset+14)
+      self.f.write(struct.pack('<I',crc))
+      self.f.seek(end)
+    attr = (st.st_mode & 0xFFFF) << 16
+    if name[-1] == '/':
+      attr = attr | 0x10
+    self.central.extend([(name,method,crc,csize,usize,st.st_mtime,attr,offset)])
+    if name[-1] != '/':
+      return d.entry(st)
+
+  # Copy a member of an earlier archive without recompressing it
+  def add_raw(self,name,path,old,info):
+    st = os.stat(path)
+    offset = self.f.tell()
+    zip64 = info.file_size >= 0xFFFFFFFF or info.compress_size >= 0xFFFFFFFF
+    self.f.write(self.header(name,info.compress_type,info.CRC,info.compress_size,info.file_size,st.st_mtime,zip64))
+    old.seek(info.header_offset)
+    n,e = struct.unpack('<HH',old.read(30)[26:30])
+    old.seek(info.header_offset+30+n+e)
+    left = info.compress_size
+    while left > 0:
+      buf = old.read(min(left,1<<20))
+      if not buf:
+        raise Exception('{} is truncated.'.format(old.name))
+      self.f.write(buf)
+      left = left - len(buf)
+    attr = (st.st_mode & 0xFFFF) << 16
+    self.central.extend([(name,info.compress_type,info.CRC,info.compress_size,info.file_size,st.st_mtime,attr,offset)])
+
+  # Add a file from memory (the manifest)
+  def add_bytes(self,name,data):
+    offset = self.f.tell()
+    crc = zlib.crc32(data)
+    mtime = time.time()
+    self.f.write(self.header(name,0,crc,len(data),len(data),mtime,False))
+    self.f.write(data)
+    self.central.extend([(name,0,crc,len(data),len(data),mtime,(0o100644<<16),offset)])
+
+  def close(self):
+    start = self.f.tell()
+    for name,method,crc,csize,usize,mtime,attr,offset in self.central:
+      flags = 0x800 if not name.isascii() else 0
+      dtime,ddate = dos_time(mtime)
+      extra = b''
+      if usize >= 0xFFFFFFFF or csize >= 0xFFFFFFFF or offset >= 0xFFFFFFFF:
+        extra = struct.pack('<HHQQQ',0x0001,24,usize,csize,offset)
+        usize = csize = offset = 0xFFFFFFFF
+      version = 45 if extra else 20
+      self.f.write(struct.pack('<IHHHHHHIIIHHHHHII',0x02014b50,(3<<8)|version,version,flags,method,
+                               dtime,ddate,crc,csize,usize,len(name.encode()),len(extra),0,0,0,attr,offset)
+                   + name.encode() + extra)
+    end = self.f.tell()
+    count = len(self.central)
+    if count >= 0xFFFF or start >= 0xFFFFFFFF or end-start >= 0xFFFFFFFF:
+      self.f.write(struct.pack('<IQHHIIQQQQ',0x06064b50,44,(3<<8)|45,45,0,0,count,count,end-start,start))
+      self.f.write(struct.pack('<IIQI',0x07064b50,0,end,1))
+      self.f.write(struct.pack('<IHHHHIIH',0x06054b50,0,0,min(count,0xFFFF),min(count,0xFFFF),
+                               0xFFFFFFFF,0xFFFFFFFF,0))
+    else:
+      self.f.write(struct.pack('<IHHHHIIH',0x06054b50,0,0,count,count,end-start,start,0))
+
+# The members of a ZIP of a directory, as zip -r would name them
+def members(album,directory):
+  out = []
+  for root,dirs,files in os.walk(os.path.join(album,directory)):
+    dirs.sort()
+    rel = os.path.relpath(root,album)
+    out.extend([(rel+'/',root)])
+    out.extend([('/'.join([rel,x]),os.path.join(root,x)) for x in sorted(files)])
+  return out
+
+# Read the manifest of an archive
+def read_manifest(zf):
+  return json.loads(zf.read(manifest_name))['files']
+
+# Archive the audio directory of one album to a ZIP, through a temporary
+# file that is only renamed into place once complete.  When the album was
+# archived before, files whose size and modification time match the old
+# manifest are copied over from the old archive as they are.  Returns None
+# if the old archive is already up to date.
+def zip_album(album,pool):
+  name = os.path.basename(os.path.normpath(album))
+  target = os.path.join(os.path.dirname(os.path.normpath(album)),'{}.zip'.format(name))
+  items = members(album,'audio')
+
+  old = None
+  manifest = {}
+  reuse = {}
+  if Path(target).exists() and not args.force:
+    try:
+      old = zipfile.ZipFile(target)
+      manifest = read_manifest(old)
+    except (zipfile.BadZipFile,KeyError,ValueError) as e:
+      print('{}WARNING: Rebuilding {}, it has no usable manifest ({}).{}\n'.format(bcolors.WARNING,target,e,bcolors.ENDC),end='')
+      if old != None:
+        old.close()
+      old = None
+      manifest = {}
+    names = set(old.namelist()) if old != None else set()
+    for mname,path in items:
+      if mname in manifest.keys() and mname in names:
+        st = os.stat(path)
+        if st.st_size == manifest[mname]['size'] and st.st_mtime_ns == manifest[mname]['mtime_ns']:
+          reuse.update({mname:old.getinfo(mname)})
+    if old != None and len(reuse) == len(manifest) == len([x for x in items if x[0][-1] != '/']):
+      old.close()
+      return None
+
+  def compress(item):
+    if item[0][-1] == '/' or item[0] in reuse.keys() or Path(item[1]).suffix.lower() in stored_types:
+      return item,None
+    return item,deflate(item[1])
+  fd,temp = tempfile.mkstemp(dir=os.path.dirname(target),prefix='.{}.'.format(name),suffix='.zip')
+  try:
+    with os.fdopen(fd,'wb') as f:
+      zw = ZipWriter(f)
+      files = {}
+      for (mname,path),compressed in bounded_map(pool,compress,items,args.jobs*4):
+        if mname in reuse.keys():
+          how = 'unchanged'
+          zw.add_raw(mname,path,old.fp,reuse[mname])
+          files.update({mname:manifest[mname]})
+        else:
+          how = 'deflated' if compressed else 'stored'
+          entry = zw.add(mname,path,compressed)
+          if entry != None:
+            files.update({mname:entry})
+        if args.verbose:
+          print('  {} ({})\n'.format(mname,how),end='')
+      zw.add_bytes(manifest_name,json.dumps({'created':datetime.datetime.now().astimezone().isoformat(timespec='seconds'),
+                                              'files':files},indent=1).encode())
+      zw.close()
+    os.chmod(temp,0o666 & ~umask)
+    os.replace(temp,target)
+  except BaseException:
+    Path(temp).unlink(missing_ok=True)
+    raise
+  finally:
+    if old != None:
+      old.close()
+  return target
+
+# Archive the extra directory of one album to a RAR.  An existing RAR is
+# updated with the files that changed, unless it is to be rebuilt.
+def rar_album(album):
+  name = os.path.basename(os.path.normpath(album))
+  target = os.path.join(os.path.dirname(os.path.normpath(album)),'{}.rar'.format(name))
+  if Path(target).exists() and args.force:
+    Path(target).unlink()
+  subprocess.run(['rar','u' if Path(target).exists() else 'a','-rr5','-s','-m5','-r','-idq',
+                  os.path.abspath(target),'extra'],cwd=album,check=True)
+  return target
+
+# Archive one album
+def archive(album,pool):
+  start = time.monotonic()
+  made = []
+  if Path(album,'audio').is_dir():
+    made.extend([zip_album(album,pool) or 'ZIP up to date'])
+  if Path(album,'extra').is_dir():
+    made.extend([rar_album(album)])
+  print('{}{}: {} ({:.1f}s){}\n'.format(bcolors.OKGREEN,album,', '.join(made) or 'nothing to archive',
+        time.monotonic()-start,bcolors.ENDC),end='')
+
+# Check one member of an archive against its manifest entry by reading it
+# (which also checks its CRC)
+def check_member(z,mname,entry):
+  d = Digest()
+  with zipfile.ZipFile(z) as zf, zf.open(mname) as f:
+    while True:
+      buf = f.read(1<<20)
+      if not buf:
+        break
+      d.update(buf)
+  if d.sha.hexdigest() != entry['sha256']:
+    return '{}: SHA-256 does not match the manifest'.format(mname)
+  return None
+
+# Check an archive against its manifest: the same files, with the same
+# sizes and CRCs, and with --full the same contents.  An archive without a
+# manifest (made before marc.py wrote them) passes with a warning.
+def check(z,pool):
+  try:
+    with zipfile.ZipFile(z) as zf:
+      try:
+        manifest = read_manifest(zf)
+      except KeyError:
+        return None
+      infos = {x.filename:x for x in zf.infolist() if x.filename[-1] != '/' and x.filename != manifest_name}
+  except (zipfile.BadZipFile,OSError,ValueError) as e:
+    return ['{}'.format(e)]
+  problems = []
+  problems.extend(['{}: missing from the archive'.format(x) for x in sorted(set(manifest)-set(infos))])
+  problems.extend(['{}: not in the manifest'.format(x) for x in sorted(set(infos)-set(manifest))])
+  for x in sorted(set(infos) & set(manifest)):
+    if infos[x].file_size != manifest[x]['size'] or infos[x].CRC != manifest[x]['crc32']:
+      problems.extend(['{}: size or CRC does not match the manifest'.format(x)])
+  if args.full and len(problems) == 0:
+    futures = [pool.submit(check_member,z,x,manifest[x]) for x in sorted(infos)]
+    for f in futures:
+      try:
+        if f.result() != None:
+          problems.extend([f.result()])
+      except (zipfile.BadZipFile,OSError,zlib.error) as e:
+        problems.extend(['{}'.format(e)])
+  return problems
+
+failed = []
+
+# Check mode
+if args.check:
+  with ThreadPoolExecutor(max_workers=args.jobs) as pool:
+    for z in args.albums:
+      problems = check(z,pool)
+      if problems == None:
+        print('{}WARNING: {} has no manifest to check.{}'.format(bcolors.WARNING,z,bcolors.ENDC))
+      elif len(problems) > 0:
+        print('{}ERROR: {} failed its check:{}'.format(bcolors.FAIL,z,bcolors.ENDC))
+        for x in problems:
+          print('  {}'.format(x))
+        failed.extend([z])
+      elif args.verbose:
+        print('{}{}: OK{}'.format(bcolors.OKGREEN,z,bcolors.ENDC))
+  if args.failed != None:
+    with open(args.failed,'w') as f:
+      f.writelines(['{}\n'.format(z) for z in failed])
+  if len(failed) > 0:
+    sys.exit(4)
+  quit(0)
+
+# Archive the albums, several at once.  The compression pool is shared,
+# so the number of files being compressed stays at --jobs however many
+# albums are in progress.
+with ThreadPoolExecutor(max_workers=args.jobs) as pool:
+  with ThreadPoolExecutor(max_workers=args.concurrent) as albums:
+    futures = {albums.submit(archive,a,pool):a for a in args.albums}
+    for f,a in futures.items():
+      try:
+        f.result()
+      except Exception as e:
+        print('{}ERROR: {}: {}{}'.format(bcolors.FAIL,a,e,bcolors.ENDC))
+        failed.extend([a])
+
+if len(failed) > 0:
+  sys.exit(4)
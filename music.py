@@ -11,10 +11,19 @@
 #import glob
 import argparse
 import re
+import os
 import json
 import math
+import hashlib
+import shutil
+import zipfile
+import datetime
+import threading
 import subprocess
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
+import mutagen.id3
+import verify
 
 # Define terminal colors
 class bcolors:
@@ -31,6 +40,19 @@ class bcolors:
 mp3_cbr_bitrates = ['32', '40', '48', '56', '64', '80', '96', '112', '128', '160', '192', '224', '256', '320']
 aac_vbr_bitrates = ['1', '2', '3', '4', '5']
 
+# Rough single-core encoding speeds, in multiples of realtime, used only
+# for the runtime estimate shown before a run
+realtime_factor = {'mp3': 30, 'aac': 60}
+
+# Typical average bitrates (kbps) of LAME VBR qualities V0-V9 and of the
+# FDK AAC VBR modes 1-5 in stereo, for comparing lossy sources against
+# the requested profile.  A source up to passthrough_margin above the
+# profile is still passed through, as VBR averages vary from album to
+# album.
+lame_vbr_kbps = [245, 225, 190, 175, 165, 130, 115, 100, 85, 65, 65]
+fdk_vbr_kbps = {'1': 64, '2': 80, '3': 112, '4': 128, '5': 192}
+passthrough_margin = 1.1
+
 # Parse arguments
 parser = argparse.ArgumentParser(description='Process a set of music files.')
 parser.add_argument('-e','--edition',metavar='ALBUM_EDITION',dest='edition',
@@ -51,87 +73,153 @@ parser.add_argument('-t','--test',action='store_true',dest='test',
                     help='Only show the constructed commands, do not execute anything.')
 parser.add_argument('-v','--verbose',action='store_true',dest='verbose',
                     help='Verbose mode.')
-args=parser.parse_args()
-
-try:
-  rqindex = [int(i) for i in args.rqindex.split(',')]
-except (AttributeError,ValueError) as e:
-  rqindex = None
-
-# Set album title dictionary key
-album_title_key = 'title'
-if args.alt:
-  album_title_key = 'alt_title'
-
-# Validate requested bitrate
-codec = args.codec
-
-if args.bitrate == None and codec == 'mp3':
-  bitrate = 'V2'
-elif args.bitrate == None and codec == 'aac':
-  bitrate = '256'
-else:
-  bitrate = args.bitrate
-
-if bitrate[0].upper() == "V":
-  mode = 'vbr'
-else:
-  mode = 'cbr'
-
-if codec == 'mp3' and mode == 'cbr':
-  mp3_cbr_bitrate = bitrate
-  encoding = 'LAME MP3 CBR {}kbps'.format(mp3_cbr_bitrate)
-  if not mp3_cbr_bitrate in mp3_cbr_bitrates:
-    raise argparse.ArgumentTypeError("Invalid CBR bitrate '{}'. Valid MP3 CBR bitrates are {}. Higher is better.".format(mp3_cbr_bitrate,mp3_cbr_bitrates))
-elif codec == 'mp3' and mode == 'vbr':
+parser.add_argument('albums',metavar='album_dir',nargs='*',
+                    help='Album directories or ZIP archives to process in one run. (Default: the current directory)')
+parser.add_argument('--catalog',metavar='FILE',dest='catalog',
+                    help='Process every album in a catalog file.')
+parser.add_argument('--write-catalog',metavar='FILE',dest='write_catalog',
+                    help='Merge the metadata of the albums into a catalog file and exit.')
+parser.add_argument('-g','--gapless',action='store_true',dest='gapless',
+                    help='Encode each disc in one lame session, for gapless playback across tracks. (MP3 only)')
+parser.add_argument('--no-verify',action='store_false',dest='verify',
+                    help='Do not check the encoded files against the track durations after the run.')
+parser.add_argument('--no-passthrough',action='store_false',dest='passthrough',
+                    help='Re-encode lossy sources even when they are at or below the requested bitrate.')
+parser.add_argument('-j','--jobs',metavar='N',type=int,dest='jobs',default=len(os.sched_getaffinity(0)),
+                    help='Number of tracks to process concurrently. (Default: number of available CPUs)')
+parser.add_argument('--shard',metavar='I/N',dest='shard',
+                    help='Process only shard I of N, a share of the tracks balanced by duration, so that one '
+                         'album can be split across several jobs.')
+
+# Work out the settings that follow from the command line arguments: the
+# editions and shard asked for, and the encoder and its options
+def options(args):
   try:
-    mp3_vbr_quality = float(bitrate[1:])
-  except:
-    mp3_vbr_quality = float(-1)
-  encoding = 'LAME MP3 VBR {}'.format(mp3_vbr_quality)
-  if mp3_vbr_quality < 0 or mp3_vbr_quality > 9.999:
-    raise argparse.ArgumentTypeError("Invalid VBR quality '{}'. MP3 VBR quality must be between 0 and 9.999. Lower is better.".format(bitrate))
-elif codec == 'aac' and mode == 'cbr':
-  try:
-    aac_cbr_bitrate = float(bitrate)
-  except:
-    aac_cbr_bitrate = float(-1)
-  encoding = 'Fraunhofer FDK AAC CBR {}kbps'.format(aac_cbr_bitrate)
-  if aac_cbr_bitrate < 112 or aac_cbr_bitrate > 320:
-    raise argparse.ArgumentTypeError("Invalid CBR bitrate '{}'. AAC CBR bitrate must be between 112 and 320. Higher is better.".format(bitrate))
-elif codec == 'aac' and mode == 'vbr':
-  if len(bitrate)>1:
-    aac_vbr_quality = bitrate[1:]
+    rqindex = [int(i) for i in args.rqindex.split(',')]
+  except (AttributeError,ValueError) as e:
+    rqindex = None
+
+  shard = None
+  if args.shard != None:
+    try:
+      shard = [int(i) for i in args.shard.split('/')]
+    except ValueError:
+      shard = []
+    if len(shard) != 2 or shard[0] < 1 or shard[0] > shard[1]:
+      raise argparse.ArgumentTypeError("Invalid shard '{}'. Give it as I/N, with I from 1 to N.".format(args.shard))
+
+  # Set album title dictionary key
+  album_title_key = 'title'
+  if args.alt:
+    album_title_key = 'alt_title'
+
+  # Validate requested bitrate
+  codec = args.codec
+
+  # Only lame can carry its encoder state from one track into the next; an
+  # AAC encoder primes and pads every file on its own
+  if args.gapless and codec == 'aac':
+    raise Exception('Gapless encoding (-g) is only supported for MP3, not AAC.')
+
+  if args.bitrate == None and codec == 'mp3':
+    bitrate = 'V2'
+  elif args.bitrate == None and codec == 'aac':
+    bitrate = '256'
+  else:
+    bitrate = args.bitrate
+
+  if bitrate[0].upper() == "V":
+    mode = 'vbr'
+  else:
+    mode = 'cbr'
+
+  if codec == 'mp3' and mode == 'cbr':
+    mp3_cbr_bitrate = bitrate
+    encoding = 'LAME MP3 CBR {}kbps'.format(mp3_cbr_bitrate)
+    if not mp3_cbr_bitrate in mp3_cbr_bitrates:
+      raise argparse.ArgumentTypeError("Invalid CBR bitrate '{}'. Valid MP3 CBR bitrates are {}. Higher is better.".format(mp3_cbr_bitrate,mp3_cbr_bitrates))
+  elif codec == 'mp3' and mode == 'vbr':
+    try:
+      mp3_vbr_quality = float(bitrate[1:])
+    except:
+      mp3_vbr_quality = float(-1)
+    encoding = 'LAME MP3 VBR {}'.format(mp3_vbr_quality)
+    if mp3_vbr_quality < 0 or mp3_vbr_quality > 9.999:
+      raise argparse.ArgumentTypeError("Invalid VBR quality '{}'. MP3 VBR quality must be between 0 and 9.999. Lower is better.".format(bitrate))
+  elif codec == 'aac' and mode == 'cbr':
+    try:
+      aac_cbr_bitrate = float(bitrate)
+    except:
+      aac_cbr_bitrate = float(-1)
+    encoding = 'Fraunhofer FDK AAC CBR {}kbps'.format(aac_cbr_bitrate)
+    if aac_cbr_bitrate < 112 or aac_cbr_bitrate > 320:
+      raise argparse.ArgumentTypeError("Invalid CBR bitrate '{}'. AAC CBR bitrate must be between 112 and 320. Higher is better.".format(bitrate))
+  elif codec == 'aac' and mode == 'vbr':
+    if len(bitrate)>1:
+      aac_vbr_quality = bitrate[1:]
+    else:
+      aac_vbr_quality = ''
+    encoding = 'Fraunhofer FDK AAC VBR {}'.format(aac_vbr_quality)
+    if not aac_vbr_quality in aac_vbr_bitrates:
+      raise argparse.ArgumentTypeError("Invalid VBR quality '{}'. Valid AAC VBR qualities are {}. Higher is better.".format(bitrate,aac_vbr_bitrates))
   else:
-    aac_vbr_quality = ''
-  encoding = 'Fraunhofer FDK AAC VBR {}'.format(aac_vbr_quality)
-  if not aac_vbr_quality in aac_vbr_bitrates:
-    raise argparse.ArgumentTypeError("Invalid VBR quality '{}'. Valid AAC VBR qualities are {}. Higher is better.".format(bitrate,aac_vbr_bitrates))
-else:
-  raise Exception("Unknown codec/mode {}/{}.".format(codec,mode))
+    raise Exception("Unknown codec/mode {}/{}.".format(codec,mode))
   
 
-# If doing AAC encoding, then figure out the libfdk_aac version being used.
-# This section ends up with a string, for example, libfdk_aac_version='0.1.6'
-libfdk_aac_version=''
-if codec == 'aac':
-  ffmpeg_path=subprocess.run(['which','ffmpeg'],capture_output=True,text=True).stdout.strip()
-  ldd_output=[x.strip() for x in subprocess.run(['ldd',ffmpeg_path],capture_output=True,text=True).stdout.split('\n')]
-  for x in ldd_output:
-    a=x.split('=>')
-    if 'libfdk-aac.so' in a[0]:
-      libfdk=a[1].strip()
-      libfdk_path=re.split(r'(.*/)(.*)',libfdk)[1]
-  with open('{}/pkgconfig/fdk-aac.pc'.format(libfdk_path),'r') as pc:
-    pkgconfig=pc.readlines()
-  for line in pkgconfig:
-    if 'Version:' in line:
-      libfdk_aac_version=line.split()[1]
-  if len(libfdk_aac_version)<2:
-    raise Exception("Could not determine version of libfdk_aac library.")
-
-
-def displayBanner(ii):
+  # If doing AAC encoding, then figure out the libfdk_aac version being used.
+  # This section ends up with a string, for example, libfdk_aac_version='0.1.6'
+  # A worker.py that already found it passes it in LIBFDK_AAC_VERSION.
+  libfdk_aac_version=os.environ.get('LIBFDK_AAC_VERSION','')
+  if codec == 'aac' and len(libfdk_aac_version)<2:
+    ffmpeg_path=subprocess.run(['which','ffmpeg'],capture_output=True,text=True).stdout.strip()
+    ldd_output=[x.strip() for x in subprocess.run(['ldd',ffmpeg_path],capture_output=True,text=True).stdout.split('\n')]
+    for x in ldd_output:
+      a=x.split('=>')
+      if 'libfdk-aac.so' in a[0]:
+        libfdk=a[1].strip()
+        libfdk_path=re.split(r'(.*/)(.*)',libfdk)[1]
+    with open('{}/pkgconfig/fdk-aac.pc'.format(libfdk_path),'r') as pc:
+      pkgconfig=pc.readlines()
+    for line in pkgconfig:
+      if 'Version:' in line:
+        libfdk_aac_version=line.split()[1]
+    if len(libfdk_aac_version)<2:
+      raise Exception("Could not determine version of libfdk_aac library.")
+
+  # Encoder options, the same for every track
+  lame_opts = None
+  fdk_opts = None
+  if codec=='mp3':
+    lame_opts=['lame','-m','j']
+    if mode=="cbr":
+      lame_opts.extend(['-b',mp3_cbr_bitrate])
+    if mode=="vbr":
+      lame_opts.extend(['-V',str(mp3_vbr_quality)])
+    lame_opts.extend(['-q','0'])
+  if codec=='aac':
+    fdk_opts=['-acodec','libfdk_aac']
+    if mode=="cbr":
+      fdk_opts.extend(['-b:a','{}k'.format(aac_cbr_bitrate)])
+    if mode=="vbr":
+      fdk_opts.extend(['-vbr',aac_vbr_quality])
+
+  # Average bitrate of the requested profile
+  if codec=='mp3' and mode=='cbr':
+    profile_kbps = int(mp3_cbr_bitrate)
+  elif codec=='mp3':
+    q = math.floor(mp3_vbr_quality)
+    profile_kbps = lame_vbr_kbps[q] + (lame_vbr_kbps[q+1]-lame_vbr_kbps[q])*(mp3_vbr_quality-q)
+  elif mode=='cbr':
+    profile_kbps = aac_cbr_bitrate
+  else:
+    profile_kbps = fdk_vbr_kbps[aac_vbr_quality]
+
+  return {'rqindex':rqindex,'shard':shard,'album_title_key':album_title_key,
+          'codec':codec,'encoding':encoding,'lame_opts':lame_opts,'fdk_opts':fdk_opts,
+          'profile_kbps':profile_kbps,'libfdk_aac_version':libfdk_aac_version}
+
+
+def displayBanner(ii,encoding,verbose):
   print('#'*60)
   print('#'*25 + ' SUMMARY ' + '#'*26)
   print('#'*60)
@@ -161,7 +249,7 @@ def displayBanner(ii):
     print('#'*25 + ' DISC {:2d} '.format(d) + '#'*26)
     for t in ii['tracks']:
       if t['disc'] == d:
-        if args.verbose:
+        if verbose:
           print(('{:2d} {:' + '{}'.format(max_artist_length) + 's}  {:' + '{}'.format(max_title_length) + 's}  {}').format(t['track'],t['artist'],t['title'],t['file']))
         else:
           print(('{:2d} {:' + '{}'.format(max_artist_length) + 's}  {}').format(t['track'],t['artist'],t['title']))
@@ -170,234 +258,600 @@ def displayBanner(ii):
 
 
 
-# Read metadata JSON
-try:
-  with open('metadata.json','r') as f:
-    metadata = json.load(f)
-except FileNotFoundError:
-  with open('audio/metadata.json','r') as f:
-    metadata = json.load(f)
+# An album can also be read straight out of its ZIP archive, without
+# unpacking it first
+def is_archive(base):
+  return Path(base).is_file() and zipfile.is_zipfile(base)
+
+# Member names of an archive, read once
+archive_members = {}
+def members(archive):
+  if archive not in archive_members:
+    with zipfile.ZipFile(archive) as zf:
+      archive_members[archive] = set(zf.namelist())
+  return archive_members[archive]
+
+# Read a JSON file from an album directory or archive
+def read_json(base,name):
+  if is_archive(base):
+    if name not in members(base):
+      raise FileNotFoundError('{} is not in {}'.format(name,base))
+    with zipfile.ZipFile(base) as zf:
+      return json.loads(zf.read(name))
+  with open(os.path.join(base,name),'r') as f:
+    return json.load(f)
+
+# Read the metadata JSON of the album in a base directory or archive
+def read_metadata(base):
+  try:
+    metadata = read_json(base,'metadata.json')
+  except FileNotFoundError:
+    metadata = read_json(base,'audio/metadata.json')
     for m in metadata:
       if 'prefix' in m.keys():
         if m['prefix'] == None:
           m['prefix'] = 'audio'
         else:
           m['prefix'] = '/'.join(['audio',m['prefix']])
-#print(json.dumps(metadata,indent=2))
-  
+#  print(json.dumps(metadata,indent=2))
+  return metadata
+
+# Make the paths in an album's metadata relative to the current directory
+# by folding its base directory into each edition's prefix
+def rebase(base,metadata):
+  metadata = json.loads(json.dumps(metadata))
+  if base != '.':
+    for m in metadata:
+      if 'prefix' in m.keys():
+        if m['prefix'] == None:
+          m['prefix'] = base
+        else:
+          m['prefix'] = '/'.join([base,m['prefix']])
+  return metadata
 
 # Determine active indices
-active = []
-if args.edition in ('default','original','optimized'):
-  active.extend(metadata[[i for i, x in enumerate(metadata) if x['index'] == -1][0]][args.edition])
-  if len(active) == 0:
-    active.extend(metadata[[i for i, x in enumerate(metadata) if x['index'] == -1][0]]['default'])
-if len(active) == 0 or args.edition == 'all':
-  active.extend([x['index'] for i, x in enumerate(metadata) if x['index'] != -1])
-
-# If specific index/indices were requested, then use those if they are valid
-if rqindex != None:
+def active_indices(metadata,edition,rqindex):
   active = []
-  active.extend([i for i in rqindex if i in [x['index'] for x in metadata if x['index'] != -1]])
-
-if len(active) < 1:
-  raise Exception('Could not identify any album editions to load.')
-
-
-# Iterate through album editions
-cmds = []
-temp_files = []
-
-for a in active:
-  # Get index item
-  b = metadata[[i for i, x in enumerate(metadata) if x['index'] == a][0]]
-
-  # Format the album title and edition for display
-  if 'alt_title' not in b.keys():
-    album_title_key = 'title'
-  b['album_title'] = '{} [{}]'.format(b[album_title_key],b['edition'])
-  if b['edition'] == None:
-    b['album_title'] = b[album_title_key]
-
-  # Set the sortalbum and sortalbumartist
-  if 'sortalbumartist' not in b.keys():
-    b['sortalbumartist']=b['artist']
-  if 'sortalbum' not in b.keys():
-    b['sortalbum']=b['album_title']
-  elif b['edition'] != None:
-    b['sortalbum'] = '{} [{}]'.format(b['sortalbum'],b['edition'])
-
-  # Determine maximum number of discs
-  b['discs'] = list(set([x['disc'] for x in b['tracks']]))
-
-  # Print info banner
-  displayBanner(b)
-
-  # Set up formats for file names 
-  max_did=math.floor(math.log10(len(b['discs'])))+1
-  max_tid=math.floor(math.log10(len(b['tracks'])))+1
-  ____format='index{}'.format(b['index']) + 'disc{:0' + str(max_did)+ '}track{:0' + str(max_tid)+'}'
-  wav_format=____format + '.wav'
-  tmp_format=____format + '_.wav'
-  mp3_format=____format + '.mp3'
-  m4a_format=____format + '.m4a'
-
-  # Loop through discs
-  for di in b['discs']:
-    print('Processing disc {}...'.format(di))
-    tracklist = [t for t in b['tracks'] if t['disc'] == di]
-    numtracks = max([t['track'] for t in tracklist])
-
-    for tr in tracklist:
-
-      if 'start' in tr.keys() or 'end' in tr.keys():
-        dec_format = tmp_format
-      else:
-        dec_format = wav_format
-
-      # Step 1: Decode the flac/m4a file to wave
-
-      # bitexact: strips out metadata, "Only write platform-, build- and time-independent data.
-      #           This ensures that file and data checksums are reproducible and match between
-      #           platforms. Its primary use is for regression testing."
-
-      if b['prefix'] == None:
-        flacd = ['flac','-f','-d',tr['file'],'--output-name={}'.format(dec_format.format(tr['disc'],tr['track']))]
-        mp3d = ['lame','--decode',tr['file'],dec_format.format(tr['disc'],tr['track'])]
-        m4ad  = ['ffmpeg','-i',tr['file'],'-acodec','pcm_s16le','-map_metadata','-1','-fflags','+bitexact','-flags:a','+bitexact','-flags:v','+bitexact','{}'.format(dec_format.format(tr['disc'],tr['track']))]
-      else:
-        flacd = ['flac','-f','-d','/'.join([b['prefix'],tr['file']]),'--output-name={}'.format(dec_format.format(tr['disc'],tr['track']))]
-        mp3d = ['lame','--decode','/'.join([b['prefix'],tr['file']]),dec_format.format(tr['disc'],tr['track'])]
-        m4ad  = ['ffmpeg','-i','/'.join([b['prefix'],tr['file']]),'-acodec','pcm_s16le','-map_metadata','-1','-fflags','+bitexact','-flags:a','+bitexact','-flags:v','+bitexact','{}'.format(dec_format.format(tr['disc'],tr['track']))]
-
-      if tr['file'][-5:] == '.flac':
-        cmds.extend([flacd])
-      elif tr['file'][-4:] == '.m4a':
-        cmds.extend([m4ad])
-      elif tr['file'][-4:] == '.mp3':
-        cmds.extend([mp3d])
-      else:
-        raise Exception("Unknown file type extension for {}".format(tr['file']))
-
-      temp_files.extend([dec_format.format(tr['disc'],tr['track'])])
-
-      atrim = None
-
-      if 'start' in tr.keys() and 'end' in tr.keys():
-        atrim = 'atrim={}:{}'.format(tr['start'],tr['end'])
-      elif 'start' in tr.keys():
-        atrim = 'atrim=start={}'.format(tr['start'])
-      elif 'end' in tr.keys():
-        atrim = 'atrim=end={}'.format(tr['end'])
-      
-      if atrim != None:
-        trim  = ['ffmpeg','-i',dec_format.format(tr['disc'],tr['track']),'-af',atrim,wav_format.format(tr['disc'],tr['track'])]
-        cmds.extend([trim])
-        temp_files.extend([wav_format.format(tr['disc'],tr['track'])])
-
-      # Sort artist
-      if 'sortartist' not in tr.keys():
-        tr['sortartist'] = tr['artist']
-
-      # Step 2a: Encode the wave to MP3
-      if codec=='mp3':
-        lame=['lame','-m','j']
-        if mode=="cbr":
-          lame.extend(['-b',mp3_cbr_bitrate])
-        if mode=="vbr":
-          lame.extend(['-V',str(mp3_vbr_quality)])
-        lame.extend(['-q','0',wav_format.format(tr['disc'],tr['track']),mp3_format.format(tr['disc'],tr['track']),
-                     '--id3v2-only','--tt',tr['title'],
-                     '--ta',tr['artist'],
-                     '--tl',b['album_title'],
-                     '--tv','TPE2={}'.format(b['artist']),
-                     '--tv','TSOA={}'.format(b['sortalbum']),
-                     '--tv','TSOP={}'.format(tr['sortartist']),
-                     '--tv','TSO2={}'.format(b['sortalbumartist']),
-                     '--ty','{}'.format(b['year']),
-                     '--tn','{}/{}'.format(tr['track'],numtracks),
-                     '--tv','TPOS={}/{}'.format(di,max(b['discs'])),
-                     '--tv','TCON={}'.format(b['genre'])])
-        if b['compilation']:
-          lame.extend(['--tv','TCMP=1'])
-
-        if 'comment' in tr.keys():
-          lame.extend(['--tc',tr['comment']])
+  if edition in ('default','original','optimized'):
+    active.extend(metadata[[i for i, x in enumerate(metadata) if x['index'] == -1][0]][edition])
+    if len(active) == 0:
+      active.extend(metadata[[i for i, x in enumerate(metadata) if x['index'] == -1][0]]['default'])
+  if len(active) == 0 or edition == 'all':
+    active.extend([x['index'] for i, x in enumerate(metadata) if x['index'] != -1])
+
+  # If specific index/indices were requested, then use those if they are valid
+  if rqindex != None:
+    active = []
+    active.extend([i for i in rqindex if i in [x['index'] for x in metadata if x['index'] != -1]])
+
+  return active
+
+# Gather the albums to work on: a catalog of many albums, a list of album
+# directories or archives, or (the default) the album in the current
+# directory.  A catalog is a JSON list of {"base": directory, "metadata":
+# [...]} entries; "metadata" may be left out to read it from the base
+# directory, and relative bases are taken relative to the catalog file.
+def read_catalog(args):
+  catalog = []
+  if args.catalog != None:
+    with open(args.catalog,'r') as f:
+      for entry in json.load(f):
+        base = os.path.normpath(os.path.join(os.path.dirname(args.catalog),entry['base']))
+        if 'metadata' in entry.keys():
+          catalog.extend([(base,entry['metadata'])])
+        else:
+          catalog.extend([(base,read_metadata(base))])
+  else:
+    for base in args.albums or ['.']:
+      catalog.extend([(os.path.normpath(base),read_metadata(os.path.normpath(base)))])
+  return catalog
+
+# Write a merged catalog out, with its bases relative to the catalog file
+def write_catalog(catalog,path):
+  with open(path,'w') as f:
+    json.dump([{'base':os.path.relpath(base,os.path.dirname(path) or '.'),'metadata':metadata}
+               for base,metadata in catalog],f,indent=2)
+  print('Wrote {} album(s) to {}'.format(len(catalog),path))
+
+# Paths in the metadata of an archive stay relative to the archive.  Its
+# output goes to the current directory, or, when several albums are done in
+# one run, to a directory named after the archive.
+def album_editions(catalog,edition,rqindex):
+  editions = []
+  for base,metadata in catalog:
+    archive = None
+    if is_archive(base):
+      archive = base
+      base = '.' if len(catalog) == 1 else Path(archive).stem
+    else:
+      metadata = rebase(base,metadata)
+    active = active_indices(metadata,edition,rqindex)
+    if len(active) < 1:
+      raise Exception('Could not identify any album editions to load in {}.'.format(archive or base))
+    for a in active:
+      editions.extend([(base,archive,metadata[[i for i, x in enumerate(metadata) if x['index'] == a][0]])])
+  return editions
+
+# Path of a file of an album edition, relative to its directory or archive
+def source(b,name):
+  if b['prefix'] == None:
+    return name
+  return '/'.join([b['prefix'],name])
+
+# Cover images are told apart by the hash of their contents, not by where
+# they are, so an image is checked and (from an archive) extracted once,
+# however many albums and editions share it.  Images in an archive are
+# extracted to a hidden file in the output directory before the run, and
+# removed after it.  What is known of them is kept in art, one per plan.
+def coverart(base,archive,b,art):
+  path = source(b,b['coverart'])
+  where = os.path.realpath(path) if archive == None else (os.path.realpath(archive),path)
+  if where not in art['hashes']:
+    h = hashlib.sha256()
+    if archive == None:
+      if not Path(path).is_file():
+        raise Exception('Could not find cover art image {}'.format(path))
+      with open(path,'rb') as f:
+        for buf in iter(lambda: f.read(1<<20),b''):
+          h.update(buf)
+    else:
+      if path not in members(archive):
+        raise Exception('Could not find cover art image {} in {}'.format(path,archive))
+      with zipfile.ZipFile(archive) as zf, zf.open(path) as f:
+        for buf in iter(lambda: f.read(1<<20),b''):
+          h.update(buf)
+    art['hashes'][where] = h.hexdigest()
+  key = art['hashes'][where]
+  if key not in art['cache']:
+    if archive == None:
+      art['cache'][key] = path
+    else:
+      art['cache'][key] = os.path.normpath(os.path.join(base,'.coverart{}{}'.format(len(art['extract'])+1,Path(path).suffix)))
+      art['extract'].extend([(archive,path,art['cache'][key])])
+  return art['cache'][key]
+
+
+# Write ID3v2 tags, given as lame tag options, to an MP3 file.  With
+# --gapless, lame encodes a disc's tracks in one session and the tags of
+# each track are written afterwards.
+id3_options = {'--tt':'TIT2','--ta':'TPE1','--tl':'TALB','--ty':'TDRC','--tn':'TRCK'}
+def write_id3(path,tags):
+  id3 = mutagen.id3.ID3()
+  for opt,value in zip(tags[0::2],tags[1::2]):
+    if opt in id3_options.keys():
+      id3.add(getattr(mutagen.id3,id3_options[opt])(encoding=3,text=value))
+    elif opt == '--tv':
+      frame,value = value.split('=',1)
+      id3.add(getattr(mutagen.id3,frame)(encoding=3,text=value))
+    elif opt == '--tc':
+      id3.add(mutagen.id3.COMM(encoding=3,lang='eng',desc='',text=value))
+    elif opt == '--ti':
+      with open(value,'rb') as f:
+        mime = 'image/png' if value.lower().endswith('.png') else 'image/jpeg'
+        id3.add(mutagen.id3.APIC(encoding=3,mime=mime,type=3,desc='',data=f.read()))
+    else:
+      raise Exception('Unknown tag option {}'.format(opt))
+  id3.save(path,v2_version=3)
+
+# Encoder options, the same for every track
+# Codec and average bitrate of a lossy source, from its headers alone.
+# None for a lossless source (FLAC, ALAC) or one that cannot be read.
+def lossy_source(archive,src):
+  if src[-4:] not in ('.mp3','.m4a'):
+    return None
+  info = verify.mp3_info if src[-4:] == '.mp3' else verify.m4a_info
+  try:
+    if archive == None:
+      x = info(src)
+    else:
+      with zipfile.ZipFile(archive) as zf:
+        x = info(zf.open(src))
+  except Exception:
+    return None
+  if x.get('codec','mp4a') != 'mp4a' or x['duration'] <= 0:
+    return None
+  return {'codec':'mp3' if src[-4:] == '.mp3' else 'aac','kbps':x['bytes']*8/x['duration']/1000}
+
+# Plan the work for the albums given by args, the command line arguments
+# as a list (or already parsed), without running anything.  The plan is a
+# dict of the arguments, the album editions, the jobs and the cover images
+# to extract, for show_plan() or run_plan().
+def plan_album(args):
+  if not isinstance(args,argparse.Namespace):
+    args = parser.parse_args(args)
+  o = options(args)
+  codec = o['codec']
+  editions = album_editions(read_catalog(args),args.edition,o['rqindex'])
+  art = {'hashes':{},'cache':{},'extract':[]}
+
+  # Iterate through album editions, building one job (a chain of commands
+  # plus its temporary files) per track.  With --gapless, there is one job
+  # per disc instead: the tracks are decoded as its parts, then encoded in
+  # one encoder session and tagged.
+  jobs = []
+
+  for base,archive,b in editions:
+
+    # Format the album title and edition for display
+    title_key = o['album_title_key']
+    if 'alt_title' not in b.keys():
+      title_key = 'title'
+    b['album_title'] = '{} [{}]'.format(b[title_key],b['edition'])
+    if b['edition'] == None:
+      b['album_title'] = b[title_key]
+
+    # Set the sortalbum and sortalbumartist
+    if 'sortalbumartist' not in b.keys():
+      b['sortalbumartist']=b['artist']
+    if 'sortalbum' not in b.keys():
+      b['sortalbum']=b['album_title']
+    elif b['edition'] != None:
+      b['sortalbum'] = '{} [{}]'.format(b['sortalbum'],b['edition'])
+
+    # Determine maximum number of discs
+    b['discs'] = list(set([x['disc'] for x in b['tracks']]))
+
+    # Print info banner
+    displayBanner(b,o['encoding'],args.verbose)
+
+    # Set up formats for file names 
+    max_did=math.floor(math.log10(len(b['discs'])))+1
+    max_tid=math.floor(math.log10(len(b['tracks'])))+1
+    ____format='index{}'.format(b['index']) + 'disc{:0' + str(max_did)+ '}track{:0' + str(max_tid)+'}'
+    if base != '.':
+      ____format=os.path.join(base.replace('{','{{').replace('}','}}'),____format)
+    wav_format=____format + '.wav'
+    tmp_format=____format + '_.wav'
+    mp3_format=____format + '.mp3'
+    m4a_format=____format + '.m4a'
+
+    # Loop through discs
+    for di in b['discs']:
+      print('Processing disc {}...'.format(di))
+      tracklist = [t for t in b['tracks'] if t['disc'] == di]
+      numtracks = max([t['track'] for t in tracklist])
+      disc = {'cmds':[],'temp':[],'duration':0,'scratch':0,'source':None,'parts':[],'outputs':[],'copy':False}
+      tagging = []
+
+      for tr in tracklist:
+
+        # Playing time and decoded size, when csv2json.py recorded them
+        job = {'cmds':[],'temp':[],'duration':0,'scratch':0,'source':None,'parts':[],'outputs':[],'copy':False}
+        if 'duration' in tr.keys():
+          job['duration'] = min(tr.get('end',tr['duration']),tr['duration']) - tr.get('start',0)
+          wav_bytes = tr['duration'] * (tr['sample_rate'] or 44100) * (tr['channels'] or 2) * (tr['bits'] or 16) // 8
+          job['scratch'] = wav_bytes
+          if 'start' in tr.keys() or 'end' in tr.keys():
+            job['scratch'] = wav_bytes + wav_bytes * job['duration'] // tr['duration']
+
+        if 'start' in tr.keys() or 'end' in tr.keys():
+          dec_format = tmp_format
         else:
-          if b['label'] != None and b['catalog'] != None:
-            lame.extend(['--tc','{} {}'.format(b['label'],b['catalog'])])
-          #elif b['label'] != None:
-          #  lame.extend(['--tc',b['label']])
-
-        if b['label'] != None:
-          lame.extend(['--tv','TPUB={}'.format(b['label'])])
-        if b['coverart'] != None:
-          if b['prefix'] == None:
-            lame.extend(['--ti',b['coverart']])
+          dec_format = wav_format
+
+        # A lossy source in the output codec, at or below the requested
+        # bitrate, gains nothing from being decoded and encoded again.  Its
+        # audio is copied (MP3) or remuxed (AAC) as it is, and tagged.
+        src = source(b,tr['file'])
+        if (args.passthrough and not args.gapless and dec_format == wav_format
+            and (archive == None or src in members(archive))):
+          lossy = lossy_source(archive,src)
+          if lossy != None and lossy['codec'] == codec and lossy['kbps'] <= o['profile_kbps']*passthrough_margin:
+            print('  Track {}: {} source at {:.0f} kbps, passing it through'.format(tr['track'],codec.upper(),lossy['kbps']))
+            job['copy'] = True
+            job['scratch'] = 0
+
+        # Step 1: Decode the flac/m4a file to wave
+
+        # bitexact: strips out metadata, "Only write platform-, build- and time-independent data.
+        #           This ensures that file and data checksums are reproducible and match between
+        #           platforms. Its primary use is for regression testing."
+
+        # From an archive, FLAC and MP3 sources are streamed into the decoder's
+        # standard input.  MP4 cannot be reliably decoded from a pipe (the moov
+        # atom may come last), so an M4A source is extracted to scratch first.
+        if archive != None:
+          if src not in members(archive):
+            raise Exception('Could not find {} in {}'.format(src,archive))
+          if job['copy'] and codec == 'mp3':
+            job['source'] = (archive,src,mp3_format.format(tr['disc'],tr['track']))
+          elif tr['file'][-4:] == '.m4a':
+            job['source'] = (archive,src,____format.format(tr['disc'],tr['track']) + '_.m4a')
+            job['temp'].extend([job['source'][2]])
+            src = job['source'][2]
           else:
-            lame.extend(['--ti','/'.join([b['prefix'],b['coverart']])])
-        cmds.extend([lame])
-
-
-      # Step 2b: Encode the wave to AAC
-      if codec=='aac':
-        ffmpeg=['ffmpeg','-i',wav_format.format(tr['disc'],tr['track']),'-acodec','libfdk_aac']
-        if mode=="cbr":
-          ffmpeg.extend(['-b:a','{}k'.format(aac_cbr_bitrate)])
-        if mode=="vbr":
-          ffmpeg.extend(['-vbr',aac_vbr_quality])
-        ffmpeg.extend(['-f','mp4',m4a_format.format(tr['disc'],tr['track'])])
-        mp4tags=['mp4tags','-song',tr['title'],'-artist',tr['artist'],
-                 '-album',b['album_title'],
-                 '-albumartist',b['artist'],
-                 '-sortalbum',b['sortalbum'],
-                 '-sortartist',tr['sortartist'],
-                 '-sortalbumartist',b['sortalbumartist'],
-                 '-year','{}'.format(b['year']),
-                 '-track',str(tr['track']),'-tracks',str(numtracks),
-                 '-disk',str(di),'-disks',str(max(b['discs'])),
-                 '-genre',b['genre']]
-        if b['compilation']:
-          mp4tags.extend(['-compilation','1']),
-
-        if 'comment' in tr.keys():
-          mp4tags.extend(['-comment',tr['comment']])
+            job['source'] = (archive,src,None)
+            src = '-'
+
+        flacd = ['flac','-f','-d',src,'--output-name={}'.format(dec_format.format(tr['disc'],tr['track']))]
+        mp3d = ['lame','--decode',src,dec_format.format(tr['disc'],tr['track'])]
+        m4ad  = ['ffmpeg','-i',src,'-acodec','pcm_s16le','-map_metadata','-1','-fflags','+bitexact','-flags:a','+bitexact','-flags:v','+bitexact','{}'.format(dec_format.format(tr['disc'],tr['track']))]
+
+        if job['copy']:
+          if codec == 'mp3' and archive == None:
+            job['cmds'].extend([(shutil.copyfile,src,mp3_format.format(tr['disc'],tr['track']))])
+        elif tr['file'][-5:] == '.flac':
+          job['cmds'].extend([flacd])
+        elif tr['file'][-4:] == '.m4a':
+          job['cmds'].extend([m4ad])
+        elif tr['file'][-4:] == '.mp3':
+          job['cmds'].extend([mp3d])
         else:
-          if b['label'] != None and b['catalog'] != None:
-            mp4tags.extend(['-comment','{} {}'.format(b['label'],b['catalog'])])
-          #elif b['label'] != None:
-          #  mp4tags.extend(['-comment',b['label']])
-
-        mp4tags.extend(['-tool','Fraunhofer FDK AAC {}'.format(libfdk_aac_version)])
-        mp4tags.extend([m4a_format.format(tr['disc'],tr['track'])])
-        cmds.extend([ffmpeg,mp4tags])
-
-        if b['coverart'] != None:
-          if b['prefix'] == None:
-            mp4art=['mp4art','-z','--add',b['coverart']]
+          raise Exception("Unknown file type extension for {}".format(tr['file']))
+
+        if not job['copy']:
+          job['temp'].extend([dec_format.format(tr['disc'],tr['track'])])
+
+        atrim = None
+
+        if 'start' in tr.keys() and 'end' in tr.keys():
+          atrim = 'atrim={}:{}'.format(tr['start'],tr['end'])
+        elif 'start' in tr.keys():
+          atrim = 'atrim=start={}'.format(tr['start'])
+        elif 'end' in tr.keys():
+          atrim = 'atrim=end={}'.format(tr['end'])
+      
+        if atrim != None:
+          trim  = ['ffmpeg','-i',dec_format.format(tr['disc'],tr['track']),'-af',atrim,wav_format.format(tr['disc'],tr['track'])]
+          job['cmds'].extend([trim])
+          job['temp'].extend([wav_format.format(tr['disc'],tr['track'])])
+
+        # Sort artist
+        if 'sortartist' not in tr.keys():
+          tr['sortartist'] = tr['artist']
+
+        # Step 2a: Encode the wave to MP3
+        if codec=='mp3':
+          tags=['--tt',tr['title'],
+                '--ta',tr['artist'],
+                '--tl',b['album_title'],
+                '--tv','TPE2={}'.format(b['artist']),
+                '--tv','TSOA={}'.format(b['sortalbum']),
+                '--tv','TSOP={}'.format(tr['sortartist']),
+                '--tv','TSO2={}'.format(b['sortalbumartist']),
+                '--ty','{}'.format(b['year']),
+                '--tn','{}/{}'.format(tr['track'],numtracks),
+                '--tv','TPOS={}/{}'.format(di,max(b['discs'])),
+                '--tv','TCON={}'.format(b['genre'])]
+          if b['compilation']:
+            tags.extend(['--tv','TCMP=1'])
+
+          if 'comment' in tr.keys():
+            tags.extend(['--tc',tr['comment']])
           else:
-            mp4art=['mp4art','-z','--add','/'.join([b['prefix'],b['coverart']])]
-          mp4art.extend([m4a_format.format(tr['disc'],tr['track'])])
-          cmds.extend([mp4art])
-    
-# Test run - only show the constructed commands, but don't actually run anything.
-if args.test:
-  for cmd in cmds:
-    print('{}{}{}'.format(bcolors.OKGREEN,cmd,bcolors.ENDC))
-
-# Run the full job
-elif args.run:
-
-  # Run each of the constructed commands one by one
-  for cmd in cmds:
-    print('{}{}{}'.format(bcolors.OKGREEN,cmd,bcolors.ENDC))
-    subprocess.run(cmd,check=True)
-
-  # Delete temporary files
-  if args.verbose:
-    print("Cleaning up...")
-  for i in temp_files:
-    if args.verbose:
-      print(i)
+            if b['label'] != None and b['catalog'] != None:
+              tags.extend(['--tc','{} {}'.format(b['label'],b['catalog'])])
+            #elif b['label'] != None:
+            #  tags.extend(['--tc',b['label']])
+
+          if b['label'] != None:
+            tags.extend(['--tv','TPUB={}'.format(b['label'])])
+          if b['coverart'] != None:
+            tags.extend(['--ti',coverart(base,archive,b,art)])
+          if args.gapless:
+            tagging.extend([(write_id3,mp3_format.format(tr['disc'],tr['track']),tags)])
+          elif job['copy']:
+            job['cmds'].extend([(write_id3,mp3_format.format(tr['disc'],tr['track']),tags)])
+          else:
+            lame=o['lame_opts']+[wav_format.format(tr['disc'],tr['track']),mp3_format.format(tr['disc'],tr['track']),'--id3v2-only']+tags
+            job['cmds'].extend([lame])
+
+
+        # Step 2b: Encode the wave to AAC
+        if codec=='aac':
+          ffmpeg=['ffmpeg','-i',wav_format.format(tr['disc'],tr['track'])]+o['fdk_opts']+['-f','mp4',m4a_format.format(tr['disc'],tr['track'])]
+          if job['copy']:
+            ffmpeg=['ffmpeg','-i',src,'-map','0:a','-c:a','copy','-map_metadata','-1','-f','mp4',m4a_format.format(tr['disc'],tr['track'])]
+          mp4tags=['mp4tags','-song',tr['title'],'-artist',tr['artist'],
+                   '-album',b['album_title'],
+                   '-albumartist',b['artist'],
+                   '-sortalbum',b['sortalbum'],
+                   '-sortartist',tr['sortartist'],
+                   '-sortalbumartist',b['sortalbumartist'],
+                   '-year','{}'.format(b['year']),
+                   '-track',str(tr['track']),'-tracks',str(numtracks),
+                   '-disk',str(di),'-disks',str(max(b['discs'])),
+                   '-genre',b['genre']]
+          if b['compilation']:
+            mp4tags.extend(['-compilation','1']),
+
+          if 'comment' in tr.keys():
+            mp4tags.extend(['-comment',tr['comment']])
+          else:
+            if b['label'] != None and b['catalog'] != None:
+              mp4tags.extend(['-comment','{} {}'.format(b['label'],b['catalog'])])
+            #elif b['label'] != None:
+            #  mp4tags.extend(['-comment',b['label']])
+
+          if not job['copy']:
+            mp4tags.extend(['-tool','Fraunhofer FDK AAC {}'.format(o['libfdk_aac_version'])])
+          mp4tags.extend([m4a_format.format(tr['disc'],tr['track'])])
+          job['cmds'].extend([ffmpeg,mp4tags])
+
+          if b['coverart'] != None:
+            mp4art=['mp4art','-z','--add',coverart(base,archive,b,art)]
+            mp4art.extend([m4a_format.format(tr['disc'],tr['track'])])
+            job['cmds'].extend([mp4art])
+
+        # The encoded file, and how long it should play (when known)
+        out = mp3_format if codec=='mp3' else m4a_format
+        job['outputs'].extend([(out.format(tr['disc'],tr['track']),job['duration'] or None)])
+
+        if args.gapless:
+          disc['parts'].extend([job])
+          disc['outputs'].extend(job['outputs'])
+          disc['duration'] = disc['duration'] + job['duration']
+          disc['scratch'] = disc['scratch'] + job['scratch']
+        else:
+          jobs.extend([job])
+
+      # Encode the whole disc in one session.  lame --nogap carries the
+      # encoder state from one track into the next, so there is no gap
+      # between them, and names each MP3 after its wave file.
+      if args.gapless:
+        wavs = [wav_format.format(tr['disc'],tr['track']) for tr in tracklist]
+        disc['cmds'].extend([o['lame_opts']+['--nogap','--nogaptags']+wavs])
+        disc['cmds'].extend(tagging)
+        jobs.extend([disc])
+
+
+  # With --shard, keep only this shard's share of the jobs.  Every shard
+  # works out the same split: the jobs, longest first (in the order they were
+  # built when their durations tie or are unknown), each go to the shard with
+  # the least encoding so far, or with the fewest jobs when that ties.
+  # Passed-through tracks count for nothing but a job.
+  shard = o['shard']
+  if shard != None:
+    loads = [(0,0)]*shard[1]
+    mine = []
+    for k in sorted(range(len(jobs)),key=lambda k: 0 if jobs[k]['copy'] else -jobs[k]['duration']):
+      i = min(range(shard[1]),key=lambda i: loads[i])
+      loads[i] = (loads[i][0] + (0 if jobs[k]['copy'] else jobs[k]['duration']),loads[i][1]+1)
+      if i == shard[0]-1:
+        mine.extend([k])
+    print('Shard {}/{}: {} of {} {}'.format(shard[0],shard[1],len(mine),len(jobs),'discs' if args.gapless else 'tracks'))
+    jobs = [jobs[k] for k in sorted(mine)]
+
+  # Estimate the work ahead from the durations recorded by csv2json.py.  With
+  # the temporary files of each track removed as soon as it is done, peak
+  # scratch use is that of the largest tracks running side by side.
+  # Tracks passed through take next to no time and are left out.
+  if sum([jb['duration'] for jb in jobs]) > 0:
+    total = sum([jb['duration'] for jb in jobs])
+    encoded = [jb['duration'] for jb in jobs if not jb['copy']] or [0]
+    workers = max(1,min(args.jobs,len(jobs)))
+    scratch = sum(sorted([jb['scratch'] for jb in jobs],reverse=True)[:workers])
+    runtime = max(sum(encoded) / workers, max(encoded)) / realtime_factor[codec]
+    print('Audio: {} in {} tracks'.format(datetime.timedelta(seconds=round(total)),sum([len(jb['parts']) or 1 for jb in jobs])))
+    if len([jb for jb in jobs if jb['copy']]) > 0:
+      print('Passed through: {} of them'.format(len([jb for jb in jobs if jb['copy']])))
+    print('Estimated scratch space: {:.1f} MB, runtime: {} with {} worker(s)'.format(
+          scratch/1e6,datetime.timedelta(seconds=round(runtime)),workers))
+    print()
+
+  return {'args':args,'codec':codec,'editions':editions,'jobs':jobs,'coverart_extract':art['extract']}
+
+
+# Feed an archive member to a command's standard input from a separate
+# thread, decompressing it on the fly.  Errors reading the archive are kept
+# so that a truncated stream is not mistaken for a good decode.
+def stream_member(archive,member):
+  r,w = os.pipe()
+  errors = []
+  def feed():
+    try:
+      with open(w,'wb') as dst, zipfile.ZipFile(archive) as zf, zf.open(member) as src:
+        shutil.copyfileobj(src,dst,1<<20)
+    except BrokenPipeError:
+      pass
+    except BaseException as e:
+      errors.extend([e])
+  t = threading.Thread(target=feed,daemon=True)
+  t.start()
+  return r,t,errors
+
+# Extract an archive member to a file
+def extract_member(archive,member,path):
+  print('Extract {} from {} to {}\n'.format(member,archive,path),end='')
+  with zipfile.ZipFile(archive) as zf, zf.open(member) as src, open(path,'wb') as dst:
+    shutil.copyfileobj(src,dst,1<<20)
+
+# Show a command, and where its standard input comes from
+def show(job,i):
+  if callable(job['cmds'][i][0]):
+    return '{}{}{}{}'.format(bcolors.OKGREEN,job['cmds'][i][0].__name__,job['cmds'][i][1:],bcolors.ENDC)
+  if i == 0 and job['source'] != None and job['source'][2] == None:
+    return '{}{} < {}:{}{}'.format(bcolors.OKGREEN,job['cmds'][i],job['source'][0],job['source'][1],bcolors.ENDC)
+  return '{}{}{}'.format(bcolors.OKGREEN,job['cmds'][i],bcolors.ENDC)
+
+# Run a job's commands in order.  Some steps (tagging an MP3 with
+# --gapless) are Python functions, run in-process.
+def run_cmds(job,quiet):
+  if job['source'] != None and job['source'][2] != None:
+    extract_member(*job['source'])
+  for i,cmd in enumerate(job['cmds']):
+    print('{}\n'.format(show(job,i)),end='')
+    if callable(cmd[0]):
+      cmd[0](*cmd[1:])
+      continue
+    stdin = None
+    if i == 0 and job['source'] != None and job['source'][2] == None:
+      stdin,feeder,errors = stream_member(*job['source'][:2])
+    try:
+      subprocess.run(cmd,stdin=stdin,check=True,capture_output=quiet,text=True,errors='replace')
+    except subprocess.CalledProcessError as e:
+      if quiet:
+        print(e.stdout,e.stderr)
+      raise
+    finally:
+      if stdin != None:
+        os.close(stdin)
+        feeder.join()
+    if stdin != None and len(errors) > 0:
+      raise Exception('Could not read {} from {}: {}'.format(job['source'][1],job['source'][0],errors[0]))
+
+# Run one job, its parts first, then delete the temporary files of them all
+def run_job(job,quiet=False,verbose=False):
+  for part in job['parts']+[job]:
+    run_cmds(part,quiet)
+  for i in [t for part in job['parts']+[job] for t in part['temp']]:
+    if verbose:
+      print('Cleaning up {}\n'.format(i),end='')
     Path(i).unlink(missing_ok=False)
 
+# Test run - only show the constructed commands, but don't actually run anything.
+def show_plan(plan):
+  for x in plan['coverart_extract']:
+    print('Extract {} from {} to {}'.format(x[1],x[0],x[2]))
+  for job in [part for jb in plan['jobs'] for part in jb['parts']+[jb]]:
+    if job['source'] != None and job['source'][2] != None:
+      print('Extract {} from {} to {}'.format(job['source'][1],job['source'][0],job['source'][2]))
+    for i in range(len(job['cmds'])):
+      print(show(job,i))
+
+# Run the full job, longest tracks first so that the tail of the run is
+# not left waiting on one long track
+def run_plan(plan):
+  args = plan['args']
+  jobs = plan['jobs']
+  for base in set([base for base,archive,b in plan['editions'] if archive != None]):
+    os.makedirs(base,exist_ok=True)
+  try:
+    for x in plan['coverart_extract']:
+      extract_member(*x)
+    with ThreadPoolExecutor(max_workers=max(1,args.jobs)) as pool:
+      futures = [pool.submit(run_job,jb,args.jobs>1,args.verbose) for jb in sorted(jobs,key=lambda x: x['duration'],reverse=True)]
+      try:
+        for f in as_completed(futures):
+          f.result()
+      except BaseException:
+        for f in futures:
+          f.cancel()
+        raise
+
+    # Check the encoded files from their headers before anything else
+    # picks them up
+    if args.verify:
+      bad = verify.verify([x for jb in jobs for x in jb['outputs']],args.jobs)
+      if len(bad) > 0:
+        raise Exception('{}ERROR: {} encoded file(s) failed verification.{}'.format(bcolors.FAIL,len(bad),bcolors.ENDC))
+  finally:
+    for x in plan['coverart_extract']:
+      Path(x[2]).unlink(missing_ok=True)
+
+# Write the merged catalog out instead of processing it, or plan the albums
+# and then show or run the plan
+def main(argv=None):
+  args = parser.parse_args(argv)
+  if args.write_catalog != None:
+    options(args)
+    write_catalog(read_catalog(args),args.write_catalog)
+    return
+  plan = plan_album(args)
+  if args.test:
+    show_plan(plan)
+  elif args.run:
+    run_plan(plan)
+
+if __name__ == '__main__':
+  main()
@@ -7,11 +7,28 @@
 
 import argparse
 import re
+import os
+import errno
+import io
+import fcntl
+import filecmp
+import tempfile
+import hashlib
 import json
 import math
+import mmap
+import shutil
+import select
+import struct
+import time
+import ctypes
+import ctypes.util
 import subprocess
+import collections
 import mutagen
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+import verify
 
 # Define terminal colors
 class bcolors:
@@ -82,6 +99,379 @@ def path_create(metadata):
   outfile='{}/{}/{}.{}'.format(clean_dir(artist[:40]),clean_dir(album[:40]),filename,metadata['type'])
   return outfile
 
+# ioctl request number for cloning a file's extents (linux/fs.h)
+FICLONE = 0x40049409
+
+# Copy file contents in-kernel using copy_file_range, with a plain
+# read/write fallback for kernels or filesystems that do not support it.
+# With reflink, the file is cloned if it can be (like cp --reflink=auto),
+# and copied with a warning, once per reason, if it cannot.
+reflink_warned = set()
+def copy_data(a,b,reflink=False):
+  with open(a,'rb',buffering=0) as fin, open(b,'wb',buffering=0) as fout:
+    if reflink:
+      try:
+        fcntl.ioctl(fout.fileno(),FICLONE,fin.fileno())
+        return
+      except OSError as e:
+        if e.errno not in (errno.EXDEV,errno.EOPNOTSUPP,errno.ENOTTY,errno.EINVAL):
+          raise
+        if e.errno not in reflink_warned:
+          reflink_warned.add(e.errno)
+          print(f"{bcolors.WARNING}WARNING: Cannot clone '{a}' to '{os.path.dirname(b)}' ({e.strerror}), copying instead.{bcolors.ENDC}\n",end='')
+    remaining = os.fstat(fin.fileno()).st_size
+    try:
+      while remaining > 0:
+        n = os.copy_file_range(fin.fileno(),fout.fileno(),remaining)
+        if n == 0:
+          break
+        remaining = remaining - n
+    except AttributeError:
+      pass
+    except OSError as e:
+      if e.errno not in (errno.EXDEV,errno.ENOSYS,errno.EOPNOTSUPP,errno.EINVAL):
+        raise
+    shutil.copyfileobj(fin,fout,1048576)
+
+# Copy timestamps, permissions and (where allowed) ownership, like cp -a
+def copy_meta(a,b):
+  shutil.copystat(a,b)
+  st = os.stat(a)
+  try:
+    os.chown(b,st.st_uid,st.st_gid)
+  except PermissionError:
+    pass
+
+# Many jobs may organize into the same destination at once.  Making a
+# directory, and later renaming a file into it, is done under a shared lock
+# on the destination, and directory cleanup holds an exclusive one, so that
+# cleanup never removes a directory another job has just made for a file.
+# In between, while the data is copied, the job's temporary file keeps the
+# directory from being empty.  The index has a lock of its own.  (flock
+# works across NFSv4 clients.)
+lock_name = '.organize.lock'
+index_lock_name = '.organize_index.lock'
+def lock(mode,name=lock_name):
+  f = open(os.path.join(destination,name),'a')
+  try:
+    fcntl.flock(f,mode)
+  except BaseException:
+    f.close()
+    raise
+  return f
+
+# Directories files were placed into or moved out of, for cleanup.  A
+# test run records the directories it would touch, and the files it would
+# take out of them, so that it shows the same cleanup as the real run.
+touched = set()
+vacated = set()
+
+# Whether a new file has the same contents as one already in place.  Files
+# of different sizes differ; with -d, the hash of the new file (h) is
+# checked against the index entry of the other when that is up to date,
+# and only otherwise are the two compared byte for byte.
+def identical(tmp,b,h=None):
+  st = os.stat(b)
+  if os.stat(tmp).st_size != st.st_size:
+    return False
+  e = index.get(os.path.relpath(b,destination)) if index != None and h != None else None
+  if e != None and e['size'] == st.st_size and e['mtime'] == st.st_mtime_ns:
+    return e['audio'] == h['audio'] and e['tags'] == h['tags']
+  return filecmp.cmp(tmp,b,shallow=False)
+
+# Rename a finished temporary file to its destination name.  Another run
+# or job may have put a file there already: an identical one is kept as it
+# is, a different one is replaced, or the new file is given the next free
+# name ('01 Title 1.mp3', as iTunes does), or it is skipped, depending on
+# --collision.  Returns the name used, or None when skipped, in which case
+# the temporary file is left for the caller.
+def commit(tmp,b,h=None):
+  if args.collision == 'replace':
+    if Path(b).is_file() and not identical(tmp,b,h):
+      print(f"{bcolors.WARNING}WARNING: Replacing '{b}', which has different contents.{bcolors.ENDC}")
+    os.replace(tmp,b)
+    return b
+  stem,ext = os.path.splitext(b)
+  n = 0
+  while True:
+    c = b if n == 0 else '{} {}{}'.format(stem,n,ext)
+    try:
+      os.link(tmp,c)
+    except FileExistsError:
+      if identical(tmp,c,h):
+        Path(tmp).unlink()
+        return c
+      if args.collision == 'skip':
+        print(f"{bcolors.WARNING}WARNING: Skipping '{b}', a different file is already there.{bcolors.ENDC}")
+        return None
+      n = n + 1
+      continue
+    except OSError as e:
+      # No hard links on this filesystem; check, then rename
+      if e.errno not in (errno.EPERM,errno.EMLINK,errno.EOPNOTSUPP) or Path(c).exists():
+        raise
+      os.replace(tmp,c)
+      return c
+    Path(tmp).unlink()
+    if c != b:
+      print(f"{bcolors.WARNING}WARNING: '{b}' already exists with different contents, placed as '{c}'.{bcolors.ENDC}")
+    return c
+
+# Carry out one of the constructed mkdir/mv/cp/ln/rm commands in-process.
+# The file is first put under a temporary name next to its destination,
+# then renamed into place, so that nobody ever sees a half-written file.
+# The shared lock is held while the directory and the temporary file are
+# made, and while the file is renamed into place, but not while its data
+# is copied.  h is the hash of the file, when -d has it.  Returns where the
+# file ended up, or None if it was skipped.
+def place(cmd,h=None):
+  b = cmd[-1]
+  if cmd[0] == 'rm':
+    Path(b).unlink()
+    touched.update([os.path.abspath(os.path.dirname(b))])
+    return None
+  if cmd[0] == 'mkdir':
+    f = lock(fcntl.LOCK_SH)
+    try:
+      Path(b).mkdir(parents=True,exist_ok=True)
+    finally:
+      f.close()
+    return b
+  if cmd[0] not in ('mv','ln','cp'):
+    raise Exception("{}Unknown placement command {}.{}".format(bcolors.FAIL,cmd,bcolors.ENDC))
+  a = cmd[-2]
+  d = os.path.dirname(b)
+  tmp = None
+  final = None
+  moved = False
+  copy = cmd[0] == 'cp'
+  try:
+    f = lock(fcntl.LOCK_SH)
+    try:
+      Path(d).mkdir(parents=True,exist_ok=True)
+      if cmd[0] == 'ln' and Path(b).exists() and Path(b).samefile(a):
+        final = b
+        return b
+      fd,tmp = tempfile.mkstemp(prefix='.organize.',suffix='.tmp',dir=d)
+      os.close(fd)
+      if cmd[0] == 'mv':
+        try:
+          os.replace(a,tmp)
+          moved = True
+        except OSError as e:
+          if e.errno != errno.EXDEV:
+            raise
+          copy = True
+      elif cmd[0] == 'ln':
+        Path(tmp).unlink()
+        try:
+          os.link(a,tmp)
+        except OSError as e:
+          open(tmp,'wb').close()
+          if e.errno not in (errno.EXDEV,errno.EPERM,errno.EMLINK):
+            raise
+          copy = True
+    finally:
+      f.close()
+    if copy:
+      copy_data(a,tmp,reflink='--reflink=auto' in cmd)
+      copy_meta(a,tmp)
+    f = lock(fcntl.LOCK_SH)
+    try:
+      final = commit(tmp,b,h)
+    finally:
+      f.close()
+  finally:
+    # Put a moved file back where it was if it did not make it into place
+    if final == None and moved:
+      os.replace(tmp,a)
+    elif final == None and tmp != None:
+      Path(tmp).unlink(missing_ok=True)
+  if cmd[0] == 'mv' and not moved and final != None:
+    Path(a).unlink()
+  touched.update([os.path.abspath(d)])
+  if cmd[0] == 'mv':
+    touched.update([os.path.abspath(os.path.dirname(a))])
+  return final
+
+# Record what place() would do with a step, for a test run
+def preview(cmd):
+  b = cmd[-1]
+  if cmd[0] == 'rm':
+    vacated.update([os.path.abspath(b)])
+    touched.update([os.path.abspath(os.path.dirname(b))])
+  elif cmd[0] in ('mv','ln','cp'):
+    vacated.discard(os.path.abspath(b))
+    touched.update([os.path.abspath(os.path.dirname(b))])
+    if cmd[0] == 'mv':
+      vacated.update([os.path.abspath(cmd[-2])])
+      touched.update([os.path.abspath(os.path.dirname(cmd[-2]))])
+
+# Locate the tag blocks of an MP3 (ID3v2 at the front, APEv2 and ID3v1
+# at the back); everything in between is the audio payload
+def mp3_regions(f,size):
+  start = 0
+  f.seek(0)
+  head = f.read(10)
+  if len(head)==10 and head[:3]==b'ID3':
+    start = 10 + ((head[6]&0x7f)<<21 | (head[7]&0x7f)<<14 | (head[8]&0x7f)<<7 | (head[9]&0x7f))
+    if head[5] & 0x10:
+      start = start + 10
+  end = size
+  if end-start >= 128:
+    f.seek(end-128)
+    if f.read(3)==b'TAG':
+      end = end - 128
+  if end-start >= 32:
+    f.seek(end-32)
+    ape = f.read(32)
+    if ape[:8]==b'APETAGEX':
+      end = end - int.from_bytes(ape[12:16],'little')
+      if int.from_bytes(ape[20:24],'little') & 0x80000000:
+        end = end - 32
+  start = min(start,size)
+  end = max(end,start)
+  return [(0,start,False),(start,end,True),(end,size,False)]
+
+# Locate the top-level atoms of an M4A; the mdat payloads are the audio,
+# everything else (moov with its udta/meta/ilst tags, free, ...) is not
+def m4a_regions(f,size):
+  regions = []
+  pos = 0
+  while pos+8 <= size:
+    f.seek(pos)
+    head = f.read(16)
+    asize = int.from_bytes(head[0:4],'big')
+    atype = head[4:8]
+    hsize = 8
+    if asize == 1:
+      asize = int.from_bytes(head[8:16],'big')
+      hsize = 16
+    elif asize == 0:
+      asize = size-pos
+    if asize < hsize:
+      break
+    end = min(pos+asize,size)
+    if atype == b'mdat':
+      regions.extend([(pos,pos+hsize,False),(pos+hsize,end,True)])
+    else:
+      regions.extend([(pos,end,False)])
+    pos = end
+  regions.extend([(pos,size,False)])
+  return regions
+
+# Hash the audio payload of a file separately from its tag blocks, so that
+# the same audio with different tags can be told apart from a true copy
+def audio_hash(audiofile):
+  audio = hashlib.sha256()
+  tags = hashlib.sha256()
+  with open(audiofile,'rb') as f:
+    size = os.fstat(f.fileno()).st_size
+    if audiofile[-3:] == 'm4a':
+      regions = m4a_regions(f,size)
+    else:
+      regions = mp3_regions(f,size)
+    for start,end,is_audio in regions:
+      h = audio if is_audio else tags
+      f.seek(start)
+      remaining = end-start
+      while remaining > 0:
+        buf = f.read(min(remaining,1048576))
+        if not buf:
+          break
+        h.update(buf)
+        remaining = remaining - len(buf)
+  return {'audio':audio.hexdigest(),'tags':tags.hexdigest()}
+
+# Name of the content-hash index kept at the top of the destination
+index_name = '.organize_index.json'
+
+# Load the destination index.  Its entries are trusted as they are, and
+# each is checked against its file only when a lookup lands on it (see
+# refresh()), so a run does not have to walk the whole destination.  The
+# destination is walked, and files whose size or modification time changed
+# are hashed again, only when there is no index yet or with --rescan.
+def load_index(destination,jobs,rescan=False):
+  try:
+    with open('{}/{}'.format(destination,index_name),'r') as f:
+      old = json.load(f)['files']
+  except (FileNotFoundError,ValueError,KeyError):
+    old = None
+  if old != None and not rescan:
+    return old
+  old = old or {}
+  index = {}
+  stale = []
+  top = str(Path(destination))
+  for d, subdirs, filenames in os.walk(top):
+    for x in filenames:
+      if x[-4:] not in ('.mp3','.m4a'):
+        continue
+      full = os.path.join(d,x)
+      rel = os.path.relpath(full,top)
+      st = os.stat(full)
+      e = old.get(rel)
+      if e != None and e['size'] == st.st_size and e['mtime'] == st.st_mtime_ns:
+        index.update({rel:e})
+      else:
+        stale.extend([(rel,full,st)])
+  if len(stale)>0:
+    print('Indexing {} file(s) in {} ...'.format(len(stale),destination))
+  with ThreadPoolExecutor(max_workers=jobs) as pool:
+    for (rel,full,st),h in zip(stale,pool.map(audio_hash,[x[1] for x in stale])):
+      h.update({'size':st.st_size,'mtime':st.st_mtime_ns})
+      index.update({rel:h})
+  for rel in old.keys():
+    if rel not in index.keys():
+      dropped.update({rel:old[rel]})
+  return index
+
+# Index entries found to be out of date, to be taken out of the index file
+# when it is saved (unless another job has since replaced them)
+dropped = {}
+
+# Check the index entry of a file before relying on it.  An entry whose
+# file is gone is dropped; one whose file changed is hashed again.
+# Returns the entry, or None.
+def refresh(rel):
+  e = index[rel]
+  try:
+    st = os.stat(os.path.join(destination,rel))
+  except FileNotFoundError:
+    st = None
+  if st != None and e['size'] == st.st_size and e['mtime'] == st.st_mtime_ns:
+    return e
+  by_audio[e['audio']].remove(rel)
+  if st == None:
+    dropped.update({rel:index.pop(rel)})
+    return None
+  e = audio_hash(os.path.join(destination,rel))
+  e.update({'size':st.st_size,'mtime':st.st_mtime_ns})
+  index.update({rel:e})
+  by_audio.setdefault(e['audio'],[]).extend([rel])
+  return e
+
+# Write the destination index back out.  Other jobs may have added files
+# since it was loaded, so their entries are merged in, under the index lock.
+def save_index(destination,index):
+  lk = lock(fcntl.LOCK_EX,index_lock_name)
+  try:
+    try:
+      with open('{}/{}'.format(destination,index_name),'r') as f:
+        files = json.load(f)['files']
+    except (FileNotFoundError,ValueError,KeyError):
+      files = {}
+    for rel,e in dropped.items():
+      if files.get(rel) == e:
+        files.pop(rel)
+    files.update(index)
+    tmp = '{}/{}.{}'.format(destination,index_name,os.getpid())
+    with open(tmp,'w') as f:
+      json.dump({'version':1,'files':files},f)
+    os.replace(tmp,'{}/{}'.format(destination,index_name))
+  finally:
+    lk.close()
+
 # Get metadata using ffprobe method
 def get_metdata_ffprobe(audiofile):
   ffprobe = ['ffprobe', audiofile]
@@ -128,6 +518,195 @@ def get_metdata_mutagen(audiofile):
     raise Exception("{}Unrecognized audio type: {}{}".format(bcolors.FAIL,raw_data.mime,bcolors.ENDC))
   return [audiotype,raw_data.tags]
   
+# ID3v2.2 frame names and their ID3v2.3/2.4 equivalents
+id3v22_frames = {'TP1':'TPE1','TP2':'TPE2','TAL':'TALB','TT2':'TIT2','TCO':'TCON','TSS':'TSSE',
+                 'TYE':'TYER','TDA':'TDAT','TRK':'TRCK','TPA':'TPOS','TCP':'TCMP','COM':'COMM'}
+
+# Decode an ID3v2 text payload into its list of values
+def id3_text(enc,data):
+  if enc == 0:
+    values = data.decode('latin-1')
+  elif enc == 1:
+    values = data[:len(data)//2*2].decode('utf-16').replace('\ufeff','')
+  elif enc == 2:
+    values = data[:len(data)//2*2].decode('utf-16-be')
+  else:
+    values = data.decode('utf-8')
+  return [x for x in values.split('\x00') if x != ''] or ['']
+
+# The ID3v2 frames standardize() uses: text frames (but not TXXX) and
+# comments.  Everything else (cover art, private frames, ...) is skipped
+# without being read.
+def id3_wanted(fid):
+  return (fid[:1] == 'T' and fid != 'TXXX') or fid == 'COMM'
+
+# Read the ID3v2 tag at the front of an MP3.  Only the headers of the
+# frames, the frames that are used and the first frame header after the
+# tag are read.  Returns None for anything unusual (no ID3v2 tag,
+# compressed or encrypted frames, ...) so the caller can fall back to
+# mutagen.
+def id3_fast(f):
+  head = f.read(10)
+  if len(head)<10 or head[:3] != b'ID3' or head[3] not in (2,3,4):
+    return None
+  version = head[3]
+  size = (head[6]&0x7f)<<21 | (head[7]&0x7f)<<14 | (head[8]&0x7f)<<7 | (head[9]&0x7f)
+  f.seek(10+size+(10 if head[5] & 0x10 else 0))
+  sync = f.read(4)
+  if len(sync)<4 or sync[0] != 0xff or (sync[1]&0xe0) != 0xe0 or (sync[1]&0x06) == 0:
+    return None
+
+  # Frame sizes in an ID3v2.2/2.3 tag that is unsynchronised as a whole
+  # are of the restored data, so such a tag is read in one piece
+  tag = f
+  start,end = 10,10+size
+  if head[5] & 0x80 and version < 4:
+    f.seek(10)
+    data = f.read(size)
+    if len(data) < size:
+      return None
+    tag = io.BytesIO(data.replace(b'\xff\x00',b'\xff'))
+    start,end = 0,len(tag.getvalue())
+  pos = start
+  if head[5] & 0x40:
+    tag.seek(start)
+    b = tag.read(4)
+    if version == 3:
+      pos = start + 4 + int.from_bytes(b,'big')
+    else:
+      pos = start + ((b[0]&0x7f)<<21 | (b[1]&0x7f)<<14 | (b[2]&0x7f)<<7 | (b[3]&0x7f))
+  idlen,hlen = (3,6) if version == 2 else (4,10)
+  tags = {}
+  while pos+hlen <= end:
+    tag.seek(pos)
+    h = tag.read(hlen)
+    if len(h) < hlen or h[0] == 0:
+      break
+    fid = h[:idlen].decode('latin-1')
+    if version == 2:
+      fsize = int.from_bytes(h[3:6],'big')
+      fid = id3v22_frames.get(fid,fid)
+      flags = 0
+    elif version == 3:
+      fsize = int.from_bytes(h[4:8],'big')
+      flags = h[9]
+    else:
+      fsize = (h[4]&0x7f)<<21 | (h[5]&0x7f)<<14 | (h[6]&0x7f)<<7 | (h[7]&0x7f)
+      flags = h[9]
+    pos = pos+hlen+fsize
+    if not id3_wanted(fid):
+      continue
+    if (version == 3 and flags & 0xc0) or (version == 4 and flags & 0x0c):
+      return None
+    data = tag.read(max(0,min(fsize,end-(pos-fsize))))
+    # A group identity byte (2.3 flag 0x20, 2.4 flag 0x40) comes first,
+    # then in 2.4 the data length indicator
+    if (version == 3 and flags & 0x20) or (version == 4 and flags & 0x40):
+      data = data[1:]
+    if version == 4 and flags & 0x01:
+      data = data[4:]
+    if version == 4 and flags & 0x02:
+      data = data.replace(b'\xff\x00',b'\xff')
+    if len(data)<1:
+      continue
+    if fid[:1] == 'T':
+      tags.update({fid:id3_text(data[0],data[1:])})
+    elif len(data)>4:
+      enc = data[0]
+      lang = data[1:4].decode('latin-1')
+      sep = b'\x00\x00' if enc in (1,2) else b'\x00'
+      i = data.find(sep,4)
+      while enc in (1,2) and i>0 and (i-4)%2:
+        i = data.find(sep,i+1)
+      if i<0:
+        continue
+      desc = ''.join(id3_text(enc,data[4:i]))
+      tags.setdefault('COMM:{}:{}'.format(desc,lang),id3_text(enc,data[i+len(sep):]))
+  # Numeric ID3v1 genre references need mutagen's genre table
+  for x in tags.get('TCON',[]):
+    if x.isdigit() or '(' in x:
+      return None
+  # ID3v2.3 keeps the date in TYER/TDAT, mutagen presents it as TDRC
+  if 'TDRC' in tags:
+    tags.update({'TDRC':'\x00'.join(tags['TDRC'])})
+  elif 'TYER' in tags:
+    date = tags['TYER'][0]
+    if 'TDAT' in tags and len(tags['TDAT'][0]) == 4:
+      date = '{}-{}-{}'.format(date,tags['TDAT'][0][2:],tags['TDAT'][0][:2])
+    tags.update({'TDRC':date})
+  return tags
+
+# Read the iTunes tags of an M4A by walking only moov/udta/meta/ilst, with
+# the file memory mapped so that the audio data is never touched.  Returns
+# None for anything unusual so the caller can fall back to mutagen.
+def ilst_fast(f):
+  m = mmap.mmap(f.fileno(),0,access=mmap.ACCESS_READ)
+  try:
+    top = verify.mp4_boxes(m)
+    if b'ftyp' not in top or b'moov' not in top:
+      return None
+    moov = verify.mp4_boxes(m,*top[b'moov'])
+    tags = {}
+    if b'udta' not in moov:
+      return tags
+    udta = verify.mp4_boxes(m,*moov[b'udta'])
+    if b'meta' not in udta:
+      return tags
+    meta = verify.mp4_boxes(m,udta[b'meta'][0]+4,udta[b'meta'][1])
+    if b'ilst' not in meta:
+      return tags
+    pos,end = meta[b'ilst']
+    while pos+8 <= end:
+      asize = int.from_bytes(m[pos:pos+4],'big')
+      if asize < 8:
+        return None
+      key = bytes(m[pos+4:pos+8]).decode('latin-1')
+      if key == 'gnre':
+        return None
+      values = []
+      dpos = pos+8
+      while dpos+16 <= pos+asize:
+        dsize = int.from_bytes(m[dpos:dpos+4],'big')
+        if dsize < 16:
+          return None
+        if m[dpos+4:dpos+8] == b'data':
+          dtype = int.from_bytes(m[dpos+9:dpos+12],'big')
+          data = bytes(m[dpos+16:dpos+dsize])
+          if key in ('trkn','disk'):
+            values.extend([(int.from_bytes(data[2:4],'big'),int.from_bytes(data[4:6],'big'))])
+          elif key == 'cpil':
+            values = bool(int.from_bytes(data,'big'))
+          elif dtype == 1:
+            values.extend([data.decode('utf-8')])
+        dpos = dpos+dsize
+      tags.update({key:values})
+      pos = pos+asize
+    return tags
+  finally:
+    m.close()
+
+# Get metadata by reading only the tag region of the file, falling back
+# to mutagen for anything the fast reader does not handle
+def get_metdata_header(audiofile):
+  try:
+    with open(audiofile,'rb') as f:
+      # The type comes from the contents, as it does with mutagen, so that
+      # a mislabeled file is still caught
+      head = f.read(8)
+      f.seek(0)
+      tags = None
+      if head[4:8] == b'ftyp':
+        tags = ilst_fast(f)
+        audiotype = 'm4a'
+      elif head[:3] == b'ID3':
+        tags = id3_fast(f)
+        audiotype = 'mp3'
+  except (OSError,ValueError,IndexError,UnicodeDecodeError,struct.error):
+    tags = None
+  if tags == None:
+    return get_metdata_mutagen(audiofile)
+  return [audiotype,tags]
+
 # Standardize raw metadata structures
 def standardize(metadata_raw):
   metadata_s = {'sense_type':metadata_raw[0]}
@@ -236,75 +815,95 @@ parser.add_argument('-m','--move',action='store_true',dest='move',
                     help='Move the files instead of copying them (copy is the default).')
 parser.add_argument('-c','--cleanup',action='store_true',dest='clean_empty_dirs',
                     help='Use "rmdir" to clean up extraneous empty directories.')
-args=parser.parse_args()
+parser.add_argument('-l','--hardlink',action='store_true',dest='hardlink',
+                    help='Hard link the files into the destination instead of copying them.')
+parser.add_argument('--reflink',action='store_true',dest='reflink',
+                    help='Clone the files (FICLONE) into the destination when the filesystem supports it, '
+                         'and copy them with a warning when it does not.')
+parser.add_argument('-d','--dedup',action='store_true',dest='dedup',
+                    help='Skip (or hard link) files whose audio is already in the destination, and flag tag-only differences.')
+parser.add_argument('--rescan',action='store_true',dest='rescan',
+                    help='With --dedup, walk the whole destination and bring its index up to date first '
+                         '(otherwise index entries are only checked when a file matches them).')
+parser.add_argument('-w','--watch',metavar='DIR',action='append',dest='watch',
+                    help='Keep running and organize files as they are written into DIR (may be repeated).')
+parser.add_argument('--debounce',metavar='SECONDS',type=float,dest='debounce',default=2.0,
+                    help='How long a file must be left alone before --watch picks it up. (Default: 2)')
+parser.add_argument('-j','--jobs',metavar='N',type=int,dest='jobs',default=4,
+                    help='Number of files to copy concurrently. (Default: 4)')
+parser.add_argument('--collision',metavar='ACTION',dest='collision',default='replace',
+                    choices={'replace','rename','skip'},
+                    help='What to do when a different file already has the destination name: replace it, '
+                         'rename the new file (as iTunes does), or skip it. (Default: replace)')
 
-destination=args.destination[0]
+# The arguments and destination of the run in progress (see organize())
+args = None
+destination = None
 
-# The destination directory should already exist
-if not Path(destination).is_dir():
-  if not args.run:
-    print(f"{bcolors.WARNING}WARNING: Destination directory '{destination}' does not exist!{bcolors.ENDC}")
-  else:
-    raise Exception(f"{bcolors.FAIL}ERROR: Destination directory '{destination}' does not exist!{bcolors.ENDC}")
-
-# If the 'all' option was selected, then glob the files
-if args.all:
-  source = []
-  for ext in ('mp3','m4a'):
-    source.extend([str(x) for x in list(Path('.').rglob('*.{}'.format(ext))) if x.is_file()])
-else:
-  source=args.source
-
-source.sort()
-
-# Check whether there are any source files to operate on
-if len(source)<1 and not args.clean_empty_dirs:
-  raise Exception(f"{bcolors.FAIL}ERROR: Please specify one or more mp3/m4a files, or use the --all option.{bcolors.ENDC}")
-
-# Validate list of source files and determine whether they are mp3 or m4a
-files = []
-for f in source:
-  ff = {'name':f}
-  if not Path(f).is_file():
-    if not args.run:
-      print(f"{bcolors.WARNING}WARNING: Source file '{f}' does not exist!{bcolors.ENDC}")
-    else:
-      raise Exception(f"{bcolors.FAIL}ERROR: Source file '{f}' does not exist!{bcolors.ENDC}")
+# The organize job runs as a pipeline of generators: discover -> validate
+# -> scan -> plan -> place.  Each file flows through on its own, so placing
+# starts while the tree is still being scanned, and only a bounded number
+# of files (depth, four per job) is ever in flight.
+depth = None
+
+# Run fn over items on a thread pool, with at most depth results in flight,
+# and yield the results in order
+def bounded_map(pool,fn,items):
+  pending = collections.deque()
+  for x in items:
+    pending.append(pool.submit(fn,x))
+    if len(pending) >= depth:
+      yield pending.popleft().result()
+  while pending:
+    yield pending.popleft().result()
+
+# If the 'all' option was selected, then walk the tree, sorting each
+# directory as it is read instead of globbing and sorting everything
+def discover():
+  if args.all:
+    for d, subdirs, filenames in os.walk('.'):
+      subdirs.sort()
+      for x in sorted(filenames):
+        if x[-4:] in ('.mp3','.m4a'):
+          yield os.path.normpath(os.path.join(d,x))
   else:
-    if f[-3:] in ['mp3','m4a']:
-      ff.update({'type':f[-3:]}) 
-      files.extend([ff])
-    else:
+    for f in sorted(args.source):
+      yield f
+
+# Validate the source files and determine whether they are mp3 or m4a
+def validate(source):
+  for f in source:
+    if not Path(f).is_file():
       if not args.run:
-        print(f"{bcolors.WARNING}WARNING: Cannot determine type of source file '{f}'!{bcolors.ENDC}")
+        print(f"{bcolors.WARNING}WARNING: Source file '{f}' does not exist!{bcolors.ENDC}")
+      else:
+        raise Exception(f"{bcolors.FAIL}ERROR: Source file '{f}' does not exist!{bcolors.ENDC}")
+    else:
+      if f[-3:] in ['mp3','m4a']:
+        yield {'name':f,'type':f[-3:]}
       else:
-        raise Exception(f"{bcolors.FAIL}ERROR: Cannot determine type of source file '{f}'!{bcolors.ENDC}")
-
-# Read metadata from source files using ffprobe (part of ffmpeg)
-i = 0
-j = len(files)
-try:
-  digits=math.floor(math.log10(j))+1
-except:
-  digits=1
-progress='Scanning metadata {:'+str(digits)+'}/{:'+str(digits)+'} -- {:7.2%} ...'
-
-for ff in files:
-  i = i + 1
-  print(progress.format(i,j,i/j),ff['name'])
-#  print(progress.format(i,j,i/j),end='\r')
+        if not args.run:
+          print(f"{bcolors.WARNING}WARNING: Cannot determine type of source file '{f}'!{bcolors.ENDC}")
+        else:
+          raise Exception(f"{bcolors.FAIL}ERROR: Cannot determine type of source file '{f}'!{bcolors.ENDC}")
+
+# Read the metadata of one file and reduce it to a compact record holding
+# only what the later stages need
+def scan_file(ff):
 
 ## ffprobe (FFmpeg) method
 #  metadata=standardize(get_metdata_ffprobe(ff['name']))
 
 ## Mutagen method
-  metadata=standardize(get_metdata_mutagen(ff['name']))
+#  metadata=standardize(get_metdata_mutagen(ff['name']))
 
-  ff.update(metadata)
-  if ff['type'] != ff['sense_type']:
-    raise Exception("{}File contents ({}) do not match file extension ({}).{}".format(bcolors.FAIL,ff['sense_type'],ff['type'],bcolors.ENDC))
+## Header-only method (falls back to mutagen)
+  metadata=standardize(get_metdata_header(ff['name']))
 
-  ff.update({'outfile':path_create(ff)}) 
+  if ff['type'] != metadata['sense_type']:
+    raise Exception("{}File contents ({}) do not match file extension ({}).{}".format(bcolors.FAIL,metadata['sense_type'],ff['type'],bcolors.ENDC))
+  metadata.update({'type':ff['type']})
+  ff.update({'outfile':path_create(metadata)})
 
   # Test
 #  if ff['name'].upper() != ff['outfile'].upper():
@@ -313,65 +912,340 @@ for ff in files:
 #    print("{}PYTHON: {}{}".format(bcolors.FAIL,ff['outfile'],bcolors.ENDC))
 #    raise Exception(f"{bcolors.FAIL}Conflict error!{bcolors.ENDC}")
 
-dirs = []
-for ff in files:
-  d = re.split(r'(.*/)(.+)',ff['outfile'])[1][:-1]
-  if d not in dirs:
-    dirs.extend([d])
-
-cmds = []
-for d in dirs:
-  if not Path('{}/{}'.format(destination,d)).is_dir():
-    cmds.extend([['mkdir','-pv','{}/{}'.format(destination,d)]])
-
-for f in files:
-  a=f['name']
-  a2=f'./{a}'
-  b='{}/{}'.format(destination,f['outfile'])
-  if a!=b and a2!=b:
-    if args.move:
-      cmds.extend([['mv','-fv',a,b]])
-    else:
-      cmds.extend([['cp','-afv',a,b]])
+  if index != None:
+    ff.update({'hash':audio_hash(ff['name'])})
+  return ff
 
-# Test run - only show the constructed commands, but don't actually run anything.
-if args.test:
-  for cmd in cmds:
-    print('\033[92m{}\033[0m'.format(cmd))
+# Scan the files on a worker pool, reporting progress in order
+def scan(files,j=None):
+  if j == None:
+    progress='Scanning metadata {} ...'
+  else:
+    try:
+      digits=math.floor(math.log10(j))+1
+    except:
+      digits=1
+    progress='Scanning metadata {:'+str(digits)+'}/'+str(j)+' -- {:7.2%} ...'
+  with ThreadPoolExecutor(max_workers=args.jobs) as pool:
+    i = 0
+    for ff in bounded_map(pool,scan_file,files):
+      i = i + 1
+      if j == None:
+        print(progress.format(i),ff['name'])
+      else:
+        print(progress.format(i,i/j),ff['name'])
+      yield ff
 
-# Run the full job
-elif args.run:
+# Construct the mkdir and placement commands for each file.  An exact copy
+# of a file already in the destination index is skipped if it is already
+# at its destination, or hard linked there from wherever it sits; the same
+# audio with different tags is flagged.  With --move, the source of such a
+# copy is removed once it is proven identical.
+def plan(files):
+  dirs = set()
+  for f in files:
+    a=f['name']
+    a2=f'./{a}'
+    b='{}/{}'.format(destination,f['outfile'])
+    cmd = None
+    after = None
+    if index != None:
+      found = [x for x in list(by_audio.get(f['hash']['audio'],[])) if refresh(x) != None]
+      found = [x for x in found if index[x]['audio'] == f['hash']['audio']]
+      same = [x for x in found if index[x]['tags'] == f['hash']['tags']]
+      retagged = [x for x in found if index[x]['tags'] != f['hash']['tags']]
+      # With --move, a source proven byte for byte the same as the file
+      # in the destination is removed rather than left behind
+      if f['outfile'] in same:
+        if args.move and not Path(a).samefile(b) and filecmp.cmp(a,b,shallow=False):
+          print(f"{bcolors.WARNING}WARNING: '{a}' is already at '{b}', removing it.{bcolors.ENDC}")
+          yield [['rm','-fv',a],None]
+        else:
+          print(f"{bcolors.WARNING}WARNING: Skipping '{a}', identical file already at '{b}'.{bcolors.ENDC}")
+        continue
+      for x in retagged:
+        print(f"{bcolors.WARNING}WARNING: '{a}' has the same audio as '{destination}/{x}' but different tags.{bcolors.ENDC}")
+      if args.move:
+        same = [x for x in same if not Path(a).samefile('{}/{}'.format(destination,x))]
+      if len(same)>0:
+        x = '{}/{}'.format(destination,same[0])
+        print(f"{bcolors.WARNING}WARNING: '{a}' is identical to '{x}', linking instead of copying.{bcolors.ENDC}")
+        cmd = ['ln','-fv',x,b]
+        if args.move and filecmp.cmp(a,x,shallow=False):
+          after = ['rm','-fv',a]
+    if cmd == None and a!=b and a2!=b:
+      if args.move:
+        cmd = ['mv','-fv',a,b]
+      elif args.hardlink:
+        cmd = ['ln','-fv',a,b]
+      elif args.reflink:
+        cmd = ['cp','-afv','--reflink=auto',a,b]
+      else:
+        cmd = ['cp','-afv',a,b]
+    if cmd == None:
+      continue
+    d = re.split(r'(.*/)(.+)',f['outfile'])[1][:-1]
+    if d not in dirs:
+      dirs.add(d)
+      if not Path('{}/{}'.format(destination,d)).is_dir():
+        yield [['mkdir','-pv','{}/{}'.format(destination,d)],None]
+    yield [cmd,f]
+    if after != None:
+      yield [after,None]
 
-  # Run each of the constructed commands one by one
-  for cmd in cmds:
-    print('\033[92m{}\033[0m'.format(cmd))
-    subprocess.run(cmd,check=True)
+# The destination index when deduplicating, and its files by audio hash
+index = None
+by_audio = {}
 
+# Count the files as they pass from validation to scanning
+counter = {'files':0}
+def count(files):
+  for ff in files:
+    counter['files'] = counter['files'] + 1
+    yield ff
 
-# Directory cleanup
-if args.clean_empty_dirs:
-  def contains_files(d):
-    s = [str(x) for x in Path(d).rglob('*') if not x.is_dir()]
-    return len(s)>0
-  
-  empty_dirs = [str(x) for x in Path(destination).rglob('*') if x.is_dir() and not contains_files(x)]
-  empty_dirs.sort(key=lambda x: x.count('/'),reverse=True)
-  
-  cleanup_cmds = []
-  for d in empty_dirs:
-    cleanup_cmds.extend([['rmdir','-v',d]])
-  
-  # Test run
+# Carry out the planned steps
+def execute(steps):
+
+  # Test run - only show the constructed commands, but don't actually run anything.
   if args.test:
-    for cmd in cleanup_cmds:
+    for cmd,f in steps:
       print('\033[92m{}\033[0m'.format(cmd))
-  
+      preview(cmd)
+
   # Run the full job
   elif args.run:
-  
-    # Run each of the constructed commands one by one
-    for cmd in cleanup_cmds:
-      print('\033[92m{}\033[0m'.format(cmd))
-      subprocess.run(cmd,check=True)
 
+    # Directories are created inline as they come up; the file placements
+    # (cross-filesystem copies being the slow part) go to a worker pool
+    def run_cmd(step):
+      print('\033[92m{}\033[0m\n'.format(step[0]),end='')
+      return step + [place(step[0],step[1].get('hash') if step[1] != None else None)]
+
+    def place_steps(steps):
+      for step in steps:
+        if step[0][0] == 'mkdir':
+          run_cmd(step)
+        else:
+          yield step
+
+    with ThreadPoolExecutor(max_workers=args.jobs) as pool:
+      for cmd,f,final in bounded_map(pool,run_cmd,place_steps(steps)):
+
+        # Record the newly placed file in the destination index
+        if index != None and final != None:
+          rel = os.path.relpath(final,destination)
+          st = os.stat(final)
+          e = dict(f['hash'])
+          e.update({'size':st.st_size,'mtime':st.st_mtime_ns})
+          index.update({rel:e})
+          if rel not in by_audio.setdefault(e['audio'],[]):
+            by_audio[e['audio']].extend([rel])
+
+    if index != None:
+      save_index(destination,index)
+
+  else:
+    for step in steps:
+      pass
+
+# Minimal inotify(7) binding through libc
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO    = 0x00000080
+IN_CREATE      = 0x00000100
+IN_Q_OVERFLOW  = 0x00004000
+IN_ISDIR       = 0x40000000
+
+class Inotify:
+  def __init__(self):
+    self.libc = ctypes.CDLL(ctypes.util.find_library('c'),use_errno=True)
+    self.fd = self.libc.inotify_init1(os.O_CLOEXEC)
+    if self.fd < 0:
+      raise OSError(ctypes.get_errno(),'inotify_init1 failed')
+    self.dirs = {}
+
+  # Watch a directory and everything below it; returns any audio files
+  # that were already there, since they may have landed before the watch
+  def add_tree(self,top):
+    found = []
+    for d, subdirs, filenames in os.walk(top):
+      wd = self.libc.inotify_add_watch(self.fd,os.fsencode(d),IN_CLOSE_WRITE|IN_MOVED_TO|IN_CREATE)
+      if wd < 0:
+        raise OSError(ctypes.get_errno(),"Cannot watch '{}'".format(d))
+      self.dirs.update({wd:d})
+      found.extend([os.path.join(d,x) for x in filenames if x[-4:] in ('.mp3','.m4a')])
+    return found
+
+  # Wait up to timeout seconds and return the (mask, path) events seen
+  def read(self,timeout):
+    if not select.select([self.fd],[],[],timeout)[0]:
+      return []
+    buf = os.read(self.fd,65536)
+    events = []
+    pos = 0
+    while pos+16 <= len(buf):
+      wd, mask, cookie, n = struct.unpack_from('iIII',buf,pos)
+      name = os.fsdecode(buf[pos+16:pos+16+n].rstrip(b'\0'))
+      pos = pos+16+n
+      if mask & IN_Q_OVERFLOW:
+        events.extend([(mask,None)])
+      elif wd in self.dirs:
+        events.extend([(mask,os.path.join(self.dirs[wd],name))])
+    return events
+
+# Organize one batch of files, retrying them one at a time if the batch
+# fails so that a single bad file cannot hold up the others
+def organize_batch(batch):
+  try:
+    execute(plan(scan(validate(batch),len(batch))))
+  except Exception as e:
+    if len(batch) == 1:
+      print(f"{bcolors.FAIL}ERROR: Could not organize '{batch[0]}': {e}{bcolors.ENDC}")
+    else:
+      for f in batch:
+        organize_batch([f])
+
+# Watch the drop folders and organize files as soon as they have been
+# written and left alone for the debounce interval
+def watch(dirs):
+  inotify = Inotify()
+  pending = {}
+  for d in dirs:
+    for f in inotify.add_tree(d):
+      pending.update({f:time.monotonic()})
+  print('Watching {} for new files ...'.format(', '.join(dirs)))
+  while True:
+    if pending:
+      timeout = max(0,min(pending.values())+args.debounce-time.monotonic())
+    else:
+      timeout = None
+    for mask,path in inotify.read(timeout):
+      if path == None:
+        print(f"{bcolors.WARNING}WARNING: inotify queue overflowed, rescanning {', '.join(dirs)}.{bcolors.ENDC}")
+        for d in dirs:
+          for f in inotify.add_tree(d):
+            pending.update({f:time.monotonic()})
+      elif mask & IN_ISDIR:
+        for f in inotify.add_tree(path):
+          pending.update({f:time.monotonic()})
+      elif mask & (IN_CLOSE_WRITE|IN_MOVED_TO) and path[-4:] in ('.mp3','.m4a'):
+        pending.update({path:time.monotonic()})
+    now = time.monotonic()
+    ready = sorted([f for f,t in pending.items() if now-t >= args.debounce])
+    for f in ready:
+      pending.pop(f)
+    ready = [f for f in ready if Path(f).is_file()]
+    if ready:
+      organize_batch(ready)
+
+# Remove a directory if it is (still) empty
+def rmdir(d):
+  cmd = ['rmdir','-v',d]
+  if args.test:
+    print('\033[92m{}\033[0m'.format(cmd))
+    return True
+  if args.run:
+    try:
+      os.rmdir(d)
+    except OSError as e:
+      if e.errno not in (errno.ENOTEMPTY,errno.EEXIST,errno.ENOENT):
+        raise
+      return False
+    print('\033[92m{}\033[0m'.format(cmd))
+  return True
+
+# Directory cleanup
+def cleanup():
+  top = str(Path(destination))
+  lk = lock(fcntl.LOCK_EX) if args.run else None
+  try:
+
+    # After organizing files, only the directories this run placed files
+    # into or moved them out of are looked at, and their parents up to the
+    # destination, deepest first, so that the cleanup stays clear of the
+    # rest of a destination shared with other jobs
+    if counter['files'] > 0 or len(touched) > 0:
+      dirs = set()
+      for d in touched:
+        while os.path.commonpath([d,os.path.abspath(top)]) == os.path.abspath(top) and d != os.path.abspath(top):
+          dirs.add(d)
+          d = os.path.dirname(d)
+      for d in sorted(dirs,key=lambda x: x.count(os.sep),reverse=True):
+        if Path(d).is_dir() and all(os.path.join(d,x) in vacated for x in os.listdir(d)):
+          if rmdir(d) and args.test:
+            vacated.update([d])
+
+    # Otherwise walk the whole destination once, bottom-up.  A directory is
+    # empty when it holds no files and every one of its subdirectories was
+    # found empty, so emptiness is settled (and the rmdir done) in the same
+    # pass.
+    else:
+      empty_dirs = set()
+      for d, subdirs, filenames in os.walk(top,topdown=False):
+        children = [os.path.join(d,x) for x in subdirs]
+        is_empty = len(filenames)==0 and all(x in empty_dirs for x in children)
+        empty_dirs.difference_update(children)
+        if not is_empty or d == top:
+          continue
+        if rmdir(d):
+          empty_dirs.add(d)
+  finally:
+    if lk != None:
+      lk.close()
+
+# Organize the files given by args, the command line arguments as a list
+# (or already parsed).  The state of a run (the arguments, the destination
+# and its index, the files counted and the directories touched) is kept in
+# module globals, so one organize() runs at a time in a process.
+def organize(argv):
+  global args,destination,depth,index,by_audio
+  args = argv if isinstance(argv,argparse.Namespace) else parser.parse_args(argv)
+
+  if [args.move,args.hardlink,args.reflink].count(True) > 1:
+    parser.error('Only one of --move, --hardlink and --reflink may be given.')
+  if args.jobs < 1:
+    parser.error('--jobs must be at least 1.')
+
+  destination=args.destination[0]
+  depth = args.jobs*4
+  counter['files'] = 0
+  touched.clear()
+  vacated.clear()
+  dropped.clear()
+
+  # The destination directory should already exist
+  if not Path(destination).is_dir():
+    if not args.run:
+      print(f"{bcolors.WARNING}WARNING: Destination directory '{destination}' does not exist!{bcolors.ENDC}")
+    else:
+      raise Exception(f"{bcolors.FAIL}ERROR: Destination directory '{destination}' does not exist!{bcolors.ENDC}")
+
+  # Load the destination index when deduplicating
+  index = None
+  by_audio = {}
+  if args.dedup and Path(destination).is_dir():
+    index = load_index(destination,args.jobs,args.rescan)
+    for rel,e in index.items():
+      by_audio.setdefault(e['audio'],[]).extend([rel])
+
+  if args.watch:
+    try:
+      watch(args.watch)
+    except KeyboardInterrupt:
+      print()
+  else:
+    execute(plan(scan(count(validate(discover())),None if args.all else len(args.source))))
+
+    # Check whether there were any source files to operate on
+    if counter['files']<1 and not args.clean_empty_dirs:
+      raise Exception(f"{bcolors.FAIL}ERROR: Please specify one or more mp3/m4a files, or use the --all option.{bcolors.ENDC}")
+
+  if args.clean_empty_dirs and Path(destination).is_dir():
+    cleanup()
+
+# Organize the files named on the command line
+def main(argv=None):
+  organize(parser.parse_args(argv))
 
+if __name__ == '__main__':
+  main()
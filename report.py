@@ -0,0 +1,110 @@
+#!/bin/env python3
+
+# report.py
+#
+# This script summarizes the results files written by batch.py (and so by
+# the qmus/qhos queue jobs): realtime factors and throughput per codec
+# profile, and the slowest archives.  Splitting the profiles by toolchain
+# (--tools) shows whether a module upgrade made encoding faster or slower.
+
+import argparse
+import json
+import datetime
+from pathlib import Path
+
+# Define terminal colors
+class bcolors:
+  HEADER = '\033[95m'
+  OKBLUE = '\033[94m'
+  OKGREEN = '\033[92m'
+  WARNING = '\033[93m'
+  FAIL = '\033[91m'
+  ENDC = '\033[0m'
+  BOLD = '\033[1m'
+  UNDERLINE = '\033[4m'
+
+# Parse arguments
+parser = argparse.ArgumentParser(description='Report on the results of batch.py, qmus and qhos jobs.')
+parser.add_argument('results',metavar='results.jsonl',nargs='+',
+                    help='One or more results files.')
+parser.add_argument('-n','--slowest',metavar='N',type=int,dest='slowest',default=10,
+                    help='Number of slowest archives to list. (Default: 10)')
+parser.add_argument('-s','--since',metavar='DATE',dest='since',
+                    help='Only use records from this date (YYYY-MM-DD) on.')
+parser.add_argument('-t','--tools',action='store_true',dest='tools',
+                    help='Split each codec profile by toolchain (tool versions and loaded modules).')
+args=parser.parse_args()
+
+# Read the records
+records = []
+for r in args.results:
+  if not Path(r).is_file():
+    raise Exception(f"{bcolors.FAIL}ERROR: Results file '{r}' does not exist!{bcolors.ENDC}")
+  with open(r,'r') as f:
+    for n,line in enumerate(f):
+      try:
+        records.extend([json.loads(line)])
+      except ValueError:
+        print(f"{bcolors.WARNING}WARNING: Skipping bad record at {r} line {n+1}.{bcolors.ENDC}")
+if args.since != None:
+  records = [x for x in records if x['time'][:10] >= args.since]
+if len(records) == 0:
+  print('No records to report on.')
+  quit(0)
+
+def hms(seconds):
+  return str(datetime.timedelta(seconds=round(seconds)))
+
+# Realtime factor: seconds of audio encoded per second of encoding
+def rtf(x):
+  return x['audio_seconds'] / x['wall_seconds']['encode'] if x['wall_seconds'].get('encode') else 0
+
+# A percentile of a list of numbers, nearest rank
+def percentile(values,p):
+  values = sorted(values)
+  return values[min(len(values)-1,int(len(values)*p/100))]
+
+# Group the records by codec profile, or profile and toolchain
+groups = {}
+for x in records:
+  key = '{} {}'.format(x['kind'],x['profile'])
+  if args.tools:
+    key = '{} | {}'.format(key,'; '.join([v for k,v in sorted(x['tools'].items()) if v]+[x['modules'] or '']).strip('; ') or 'unknown tools')
+  groups.setdefault(key,[]).extend([x])
+
+# Per-profile summary.  The slow realtime factor (10th percentile) is the
+# one to size walltime requests by.
+print('#'*79)
+print('{} CODEC PROFILES {}'.format('#'*31,'#'*32))
+print('#'*79)
+for key,xs in sorted(groups.items()):
+  ok = [x for x in xs if x['status'] == 'ok' and rtf(x) > 0]
+  print(f"{bcolors.BOLD}{key}{bcolors.ENDC}")
+  print('  Archives: {} ok, {} failed'.format(len([x for x in xs if x['status'] == 'ok']),
+        len([x for x in xs if x['status'] != 'ok'])))
+  if len(ok) == 0:
+    print()
+    continue
+  audio = sum([x['audio_seconds'] for x in ok])
+  wall = sum([x['wall_seconds']['encode'] for x in ok])
+  cpu = sum([x['cpu_seconds'] for x in ok])
+  print('  Audio: {} in {} tracks, encoded in {} ({} CPU)'.format(hms(audio),sum([x['tracks'] for x in ok]),hms(wall),hms(cpu)))
+  print('  Realtime factor: {:.1f}x overall, {:.1f}x median, {:.1f}x slow (10th percentile)'.format(
+        audio/wall,percentile([rtf(x) for x in ok],50),percentile([rtf(x) for x in ok],10)))
+  print('  Per CPU: {:.1f}x realtime'.format(audio/cpu if cpu > 0 else 0))
+  print('  Throughput: {:.2f} MB/s in, {:.2f} MB/s out'.format(
+        sum([x['bytes_in'] for x in ok])/wall/1e6,sum([x['bytes_out'] for x in ok])/wall/1e6))
+  print()
+
+# The slowest archives by total time
+print('#'*79)
+print('{} SLOWEST ARCHIVES {}'.format('#'*30,'#'*31))
+print('#'*79)
+slowest = sorted(records,key=lambda x: x['wall_seconds'].get('total',0),reverse=True)[:args.slowest]
+width = max([len(x['name']) for x in slowest]+[7])
+print('{:{}}  {:9}  {:>8}  {:>8}  {:>6}  {:10}  {}'.format('Archive',width,'Status','Total','Audio','RTF','Profile','Node'))
+print('-'*(width+60))
+for x in slowest:
+  color = bcolors.ENDC if x['status'] == 'ok' else bcolors.FAIL
+  print('{}{:{}}  {:9}  {:>8}  {:>8}  {:>5.1f}x  {:10}  {}{}'.format(color,x['name'],width,x['status'],
+        hms(x['wall_seconds'].get('total',0)),hms(x['audio_seconds']),rtf(x),x['profile'],x['node'],bcolors.ENDC))
@@ -0,0 +1,67 @@
+# Tests for verify.py
+
+import os
+import sys
+
+sys.path.insert(0,os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+import verify
+
+# An excerpt of an EAC log of a disc ripped with null samples left out of
+# the CRCs
+eac_log = '''Exact Audio Copy V1.6 from 23. October 2020
+
+EAC extraction logfile from 3. January 2022, 14:02
+
+Used drive  : HL-DT-STDVDRAM GP57EB40   Adapter: 0  ID: 0
+
+Read mode               : Secure
+Utilize accurate stream : Yes
+Defeat audio cache      : Yes
+Make use of C2 pointers : No
+
+Read offset correction                      : 6
+Overread into Lead-In and Lead-Out          : No
+Fill up missing offset samples with silence : Yes
+Delete leading and trailing silent blocks   : No
+Null samples used in CRC calculations       : No
+Used interface                              : Native Win32 interface for Win NT & 2000
+Gap handling                                : Appended to previous track
+
+Track  1
+
+     Filename C:\\Rips\\01 First.wav
+
+     Peak level 98.0 %
+     Extraction speed 4.1 X
+     Track quality 100.0 %
+     Test CRC 5E1F3A2B
+     Copy CRC 5e1f3a2b
+     Accurately ripped (confidence 12)  [0A4C7D11]  (AR v2)
+     Copy OK
+
+Track  2
+
+     Filename C:\\Rips\\02 Second.wav
+
+     Peak level 87.3 %
+     Extraction speed 5.0 X
+     Track quality 100.0 %
+     Test CRC 0011AA22
+     Copy CRC 0011AA22
+     Accurately ripped (confidence 12)  [7E55C102]  (AR v2)
+     Copy OK
+'''
+
+def test_log_crcs_eac_null_samples_off(tmp_path):
+  f = tmp_path / 'rip.log'
+  f.write_bytes(b'\xff\xfe'+eac_log.encode('utf-16-le'))
+  crcs,null_samples = verify.log_crcs(str(f))
+  assert crcs == ['5E1F3A2B','0011AA22']
+  assert null_samples == False
+
+def test_log_crcs_eac_null_samples_on(tmp_path):
+  f = tmp_path / 'rip.log'
+  f.write_text(eac_log.replace('CRC calculations       : No','CRC calculations       : Yes'))
+  crcs,null_samples = verify.log_crcs(str(f))
+  assert crcs == ['5E1F3A2B','0011AA22']
+  assert null_samples == True
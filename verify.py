@@ -0,0 +1,323 @@
+#!/bin/env python3
+
+# verify.py
+#
+# Quick checks of encoded MP3 and M4A files from their headers alone,
+# without decoding them.  The duration and frame count of an MP3 come from
+# its Xing/Info and LAME headers, those of an M4A from the mvhd and stts
+# boxes.  A file is bad when it cannot be parsed, when the encoder did not
+# finish it (an empty Xing frame count, a missing moov box), when its
+# audio is shorter than its headers say, or when its duration is off the
+# expected one by more than the tolerance.
+#
+# music.py and hos.py check their outputs with this before they exit, so
+# a failed encode stops the job before organize.py moves anything.  On
+# its own, verify.py reports on the files given.  It also reads the copy
+# CRCs of a rip log, which csv2json.py checks against the rips.
+
+import argparse
+import os
+import struct
+import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+# Define terminal colors
+class bcolors:
+  HEADER = '\033[95m'
+  OKBLUE = '\033[94m'
+  OKGREEN = '\033[92m'
+  WARNING = '\033[93m'
+  FAIL = '\033[91m'
+  ENDC = '\033[0m'
+  BOLD = '\033[1m'
+  UNDERLINE = '\033[4m'
+
+# Default allowed difference from the expected duration, in seconds
+tolerance = 1.0
+
+# MPEG audio layer III header tables, by MPEG version (1, 2, 2.5)
+mp3_rates = {3:(44100,48000,32000),2:(22050,24000,16000),0:(11025,12000,8000)}
+mp3_bitrates = {3:(0,32,40,48,56,64,80,96,112,128,160,192,224,256,320),
+                2:(0,8,16,24,32,40,48,56,64,80,96,112,128,144,160),
+                0:(0,8,16,24,32,40,48,56,64,80,96,112,128,144,160)}
+
+# Parse a layer III frame header; None if it is not one
+def mp3_frame(h):
+  if len(h) < 4 or h[0] != 0xff or h[1] & 0xe0 != 0xe0:
+    return None
+  version = (h[1]>>3) & 3
+  if version == 1 or (h[1]>>1) & 3 != 1 or h[2]>>4 in (0,15) or (h[2]>>2) & 3 == 3:
+    return None
+  rate = mp3_rates[version][(h[2]>>2) & 3]
+  bitrate = mp3_bitrates[version][h[2]>>4]
+  spf = 1152 if version == 3 else 576
+  mono = h[3]>>6 == 3
+  side = (17 if mono else 32) if version == 3 else (9 if mono else 17)
+  return {'rate':rate,'bitrate':bitrate,'spf':spf,'side':side}
+
+# A path, or a file object opened for binary reading (an archive member)
+def opened(path):
+  return open(path,'rb') if isinstance(path,str) else path
+
+def mp3_info(path):
+  with opened(path) as f:
+    size = f.seek(0,2)
+    f.seek(0)
+
+    # Skip the ID3v2 tag, and leave out ID3v1 and APEv2 tags at the end
+    start = 0
+    head = f.read(10)
+    if len(head) == 10 and head[:3] == b'ID3':
+      start = 10 + ((head[6]&0x7f)<<21 | (head[7]&0x7f)<<14 | (head[8]&0x7f)<<7 | (head[9]&0x7f))
+      if head[5] & 0x10:
+        start = start + 10
+    end = size
+    if end-start >= 128:
+      f.seek(end-128)
+      if f.read(3) == b'TAG':
+        end = end - 128
+    if end-start >= 32:
+      f.seek(end-32)
+      ape = f.read(32)
+      if ape[:8] == b'APETAGEX':
+        end = end - int.from_bytes(ape[12:16],'little') - (32 if int.from_bytes(ape[20:24],'little') & 0x80000000 else 0)
+
+    # The first frame, right after the tag
+    f.seek(start)
+    buf = f.read(65536)
+    pos = 0
+    while pos+4 <= len(buf) and mp3_frame(buf[pos:pos+4]) == None:
+      pos = pos + 1
+    frame = mp3_frame(buf[pos:pos+4])
+    if frame == None:
+      raise Exception('no MPEG audio frame found')
+    payload = end - start - pos
+
+    # Without a Xing/Info header, a CBR file's length follows from its size
+    xing = buf[pos+4+frame['side']:pos+4+frame['side']+120+36]
+    if xing[:4] not in (b'Xing',b'Info'):
+      return {'duration':payload*8/(frame['bitrate']*1000),'frames':None,'bytes':payload}
+    flags = int.from_bytes(xing[4:8],'big')
+    fields = xing[8:]
+    frames = None
+    stream = None
+    if flags & 1:
+      frames = int.from_bytes(fields[:4],'big')
+      fields = fields[4:]
+    if flags & 2:
+      stream = int.from_bytes(fields[:4],'big')
+      fields = fields[4:]
+    if flags & 4:
+      fields = fields[100:]
+    if flags & 8:
+      fields = fields[4:]
+    if frames == None:
+      raise Exception('no frame count in the Xing/Info header')
+    if frames == 0:
+      raise Exception('the encoder did not finish the file (no frames in the Xing/Info header)')
+    if stream != None and payload < stream:
+      raise Exception('truncated, {:,} of {:,} bytes of audio'.format(payload,stream))
+
+    # The LAME header has the encoder delay and padding
+    samples = frames * frame['spf']
+    if len(fields) >= 24 and fields[:4] in (b'LAME',b'Lavc',b'Lavf'):
+      samples = samples - ((fields[21]<<4) | (fields[22]>>4)) - (((fields[22]&0xf)<<8) | fields[23])
+    return {'duration':samples/frame['rate'],'frames':frames,'bytes':payload if stream == None else stream}
+
+# The boxes in a part of an MP4 file, in order, as (type, start, end) of
+# their contents
+def mp4_box_list(data,start=0,end=None):
+  end = len(data) if end == None else end
+  boxes = []
+  pos = start
+  while pos+8 <= end:
+    bsize,btype = struct.unpack('>I4s',data[pos:pos+8])
+    hsize = 8
+    if bsize == 1:
+      bsize = struct.unpack('>Q',data[pos+8:pos+16])[0]
+      hsize = 16
+    elif bsize == 0:
+      bsize = end-pos
+    if bsize < hsize or pos+bsize > end:
+      raise ValueError('bad {} box'.format(btype.decode('latin-1')))
+    boxes.append((btype,pos+hsize,pos+bsize))
+    pos = pos+bsize
+  return boxes
+
+# The boxes in a part of an MP4 file, by type (the first of each)
+def mp4_boxes(data,start=0,end=None):
+  boxes = {}
+  for btype,s,e in mp4_box_list(data,start,end):
+    boxes.setdefault(btype,(s,e))
+  return boxes
+
+# The mdia boxes of the first track in moov with the given handler type
+# (b'soun' for audio), or None if there is no such track.  Cover art and
+# chapter tracks may come before the audio.
+def mp4_track(data,start=0,end=None,handler=b'soun'):
+  for btype,s,e in mp4_box_list(data,start,end):
+    if btype != b'trak':
+      continue
+    trak = mp4_boxes(data,s,e)
+    if b'mdia' not in trak:
+      continue
+    mdia = mp4_boxes(data,*trak[b'mdia'])
+    if b'hdlr' in mdia and data[mdia[b'hdlr'][0]+8:mdia[b'hdlr'][0]+12] == handler:
+      return mdia
+  return None
+
+def m4a_info(path):
+  with opened(path) as f:
+    size = f.seek(0,2)
+
+    # Walk the top-level boxes, reading only moov
+    moov = None
+    mdat = 0
+    pos = 0
+    while pos+8 <= size:
+      f.seek(pos)
+      bsize,btype = struct.unpack('>I4s',f.read(8))
+      hsize = 8
+      if bsize == 1:
+        bsize = struct.unpack('>Q',f.read(8))[0]
+        hsize = 16
+      elif bsize == 0:
+        bsize = size-pos
+      if bsize < hsize:
+        raise Exception('bad {} box'.format(btype.decode('latin-1')))
+      if pos+bsize > size:
+        raise Exception('truncated, the {} box runs {:,} bytes past the end'.format(btype.decode('latin-1'),pos+bsize-size))
+      if btype == b'moov':
+        f.seek(pos+hsize)
+        moov = f.read(bsize-hsize)
+      if btype == b'mdat':
+        mdat = mdat + bsize-hsize
+      pos = pos+bsize
+  if moov == None:
+    raise Exception('the encoder did not finish the file (no moov box)')
+
+  # Movie duration, after any edit list
+  boxes = mp4_boxes(moov)
+  if b'mvhd' not in boxes:
+    raise Exception('no mvhd box')
+  m = moov[boxes[b'mvhd'][0]:]
+  if m[0] == 1:
+    timescale,duration = struct.unpack('>IQ',m[20:32])
+  else:
+    timescale,duration = struct.unpack('>II',m[12:20])
+
+  # Frame count and sample data size of the audio track
+  mdia = mp4_track(moov)
+  if mdia != None:
+    stbl = mp4_boxes(moov,*mp4_boxes(moov,*mdia[b'minf'])[b'stbl'])
+    s = stbl[b'stsd'][0]+8
+    codec = moov[s+4:s+8].decode('latin-1')
+    s = stbl[b'stts'][0]
+    count = struct.unpack('>I',moov[s+4:s+8])[0]
+    frames = sum([struct.unpack('>I',moov[s+8+8*i:s+12+8*i])[0] for i in range(count)])
+    s = stbl[b'stsz'][0]
+    sample_size,count = struct.unpack('>II',moov[s+4:s+12])
+    if sample_size == 0:
+      sizes = struct.unpack('>{}I'.format(count),moov[s+12:s+12+4*count])
+    else:
+      sizes = (sample_size,)*count
+    data = sum(sizes)
+    if data > mdat:
+      raise Exception('truncated, {:,} of {:,} bytes of audio'.format(mdat,data))
+    if frames == 0:
+      raise Exception('no audio frames')
+
+    # Every chunk of samples has to lie within the file
+    s = stbl[b'stsc'][0]
+    n = struct.unpack('>I',moov[s+4:s+8])[0]
+    stsc = [struct.unpack('>II',moov[s+8+12*i:s+16+12*i]) for i in range(n)]
+    if b'stco' in stbl:
+      s = stbl[b'stco'][0]
+      n = struct.unpack('>I',moov[s+4:s+8])[0]
+      offsets = struct.unpack('>{}I'.format(n),moov[s+8:s+8+4*n])
+    else:
+      s = stbl[b'co64'][0]
+      n = struct.unpack('>I',moov[s+4:s+8])[0]
+      offsets = struct.unpack('>{}Q'.format(n),moov[s+8:s+8+8*n])
+    sample = 0
+    k = 0
+    for i,offset in enumerate(offsets):
+      while k+1 < len(stsc) and stsc[k+1][0] <= i+1:
+        k = k+1
+      end = offset + sum(sizes[sample:sample+stsc[k][1]])
+      if end > size:
+        raise Exception('truncated, chunk {} runs {:,} bytes past the end'.format(i+1,end-size))
+      sample = sample+stsc[k][1]
+    if sample < count:
+      raise Exception('{} of {} samples are in chunks'.format(sample,count))
+    return {'duration':duration/timescale,'frames':frames,'bytes':data,'codec':codec}
+  raise Exception('no audio track')
+
+# Copy CRCs of the tracks in a rip log (EAC "Copy CRC", XLD "CRC32 hash"),
+# in order, and whether they were taken over all samples.  EAC says
+# "Null samples used in CRC calculations : No" when they were not.
+null_samples_settings = ('Null samples used in CRC calculations','Use null samples for CRC calculations')
+def log_crcs(f):
+  with open(f,'rb') as fh:
+    raw = fh.read()
+  text = raw.decode('utf-16') if raw[:2] in (b'\xff\xfe',b'\xfe\xff') else raw.decode('utf-8',errors='replace')
+  crcs = []
+  null_samples = True
+  for line in text.splitlines():
+    words = line.split()
+    if line.strip().startswith('Copy CRC') and len(words) == 3:
+      crcs.extend([words[2].upper()])
+    elif line.strip().startswith('CRC32 hash') and line.split(':')[0].strip() == 'CRC32 hash':
+      crcs.extend([line.split(':')[1].strip().upper()])
+    elif line.split(':')[0].strip() in null_samples_settings and line.split(':')[-1].strip() == 'No':
+      null_samples = False
+  return crcs,null_samples
+
+# Check one file against its expected duration in seconds (None to only
+# check that it is whole).  Returns its duration and frame count, and the
+# problem with it, if any.
+def check(path,expected=None,tolerance=tolerance):
+  result = {'path':path,'expected':expected,'duration':None,'frames':None,'error':None}
+  try:
+    if path[-4:].lower() == '.m4a':
+      result.update(m4a_info(path))
+    else:
+      result.update(mp3_info(path))
+  except Exception as e:
+    result['error'] = str(e)
+    return result
+  if expected != None and abs(result['duration']-expected) > tolerance:
+    result['error'] = 'duration {:.2f}s, expected {:.2f}s'.format(result['duration'],expected)
+  return result
+
+# Check (path, expected duration) pairs in parallel, print the bad ones,
+# and return them
+def verify(items,jobs=1,tolerance=tolerance):
+  with ThreadPoolExecutor(max_workers=max(1,jobs)) as pool:
+    results = list(pool.map(lambda x: check(x[0],x[1],tolerance),items))
+  bad = [x for x in results if x['error'] != None]
+  for x in bad:
+    print('{}BAD: {}: {}{}'.format(bcolors.FAIL,x['path'],x['error'],bcolors.ENDC))
+  print('Verified {} file(s), {} bad.'.format(len(results),len(bad)))
+  return bad
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Check encoded MP3 and M4A files from their headers.')
+  parser.add_argument('files',metavar='file',nargs='+',
+                      help='MP3 or M4A files to check.')
+  parser.add_argument('-d','--duration',metavar='SECONDS',type=float,dest='duration',
+                      help='Expected duration of every file.')
+  parser.add_argument('-t','--tolerance',metavar='SECONDS',type=float,dest='tolerance',default=tolerance,
+                      help='Allowed difference from the expected duration. (Default: {})'.format(tolerance))
+  parser.add_argument('-j','--jobs',metavar='N',type=int,dest='jobs',default=len(os.sched_getaffinity(0)),
+                      help='Number of files to check at once. (Default: number of available CPUs)')
+  args=parser.parse_args()
+  with ThreadPoolExecutor(max_workers=max(1,args.jobs)) as pool:
+    results = list(pool.map(lambda x: check(x,args.duration,args.tolerance),args.files))
+  for x in results:
+    if x['error'] != None:
+      print('{}{}: {}{}'.format(bcolors.FAIL,x['path'],x['error'],bcolors.ENDC))
+    else:
+      print('{}: {} ({:.3f}s), {} frames'.format(x['path'],datetime.timedelta(seconds=round(x['duration'])),
+            x['duration'],x['frames'] if x['frames'] != None else 'unknown'))
+  quit(4 if len([x for x in results if x['error'] != None]) > 0 else 0)
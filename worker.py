@@ -0,0 +1,402 @@
+#!/bin/env python3
+
+# worker.py
+#
+# A long-lived worker that runs the audio scripts (music.py, hos.py,
+# organize.py, csv2json.py, marc.py) for many jobs from one warm process.
+# The interpreter, the modules the scripts use (mutagen included) and the
+# scripts themselves are loaded once; each job then runs in a forked copy
+# of the worker, which calls the script's main() with the job's arguments
+# (csv2json.py and marc.py, which have no main(), are run as __main__).
+#
+# Jobs come in over a Unix socket, or through a spool directory:
+#
+#   worker.py serve -s SOCKET -d SPOOL      # start the worker
+#   worker.py run -s SOCKET music.py -r ... # run a job, output here
+#   worker.py queue -d SPOOL music.py ...   # drop a job in the spool
+#
+# A job sent over the socket writes to the caller's own stdout/stderr (the
+# file descriptors are passed along), and the caller gets the job's exit
+# status.  A spooled job writes to a log in SPOOL/log, and its result is
+# left in SPOOL/done.
+#
+# From Python, import worker and use submit(), or submit_music(),
+# submit_hos() and submit_organize(), which build the command line for
+# one script.  Each returns the job's exit status, wall and CPU time.
+# The scripts can also be used in-process, without a worker:
+#
+#   plan = music.plan_album(['-c','aac','album.zip'])  # or hos.plan_program()
+#   music.show_plan(plan)                              # what -t shows
+#   music.run_plan(plan)                               # what -r does
+#   organize.organize(['-r','-d','file.mp3','/music'])
+#
+# The libfdk_aac version that music.py and hos.py record in AAC files is
+# looked up once when the worker starts and handed to every job in
+# LIBFDK_AAC_VERSION.
+
+import argparse
+import os
+import sys
+import json
+import time
+import array
+import signal
+import socket
+import select
+import builtins
+import datetime
+import tempfile
+import traceback
+from collections import deque
+from pathlib import Path
+
+# Modules the scripts use, imported once here so that every job starts
+# with them already loaded
+import re
+import math
+import mmap
+import errno
+import fcntl
+import shutil
+import struct
+import hashlib
+import zipfile
+import threading
+import subprocess
+import ctypes.util
+import mutagen
+import mutagen.id3
+import mutagen.mp3
+import mutagen.mp4
+import mutagen.flac
+import concurrent.futures
+import importlib
+import verify
+
+# Define terminal colors
+class bcolors:
+  HEADER = '\033[95m'
+  OKBLUE = '\033[94m'
+  OKGREEN = '\033[92m'
+  WARNING = '\033[93m'
+  FAIL = '\033[91m'
+  ENDC = '\033[0m'
+  BOLD = '\033[1m'
+  UNDERLINE = '\033[4m'
+
+# The scripts the worker runs; they live next to this one
+scripts = os.path.dirname(os.path.realpath(__file__))
+script_names = ('music.py','hos.py','organize.py','csv2json.py','marc.py')
+main_names = ('music.py','hos.py','organize.py')
+if scripts not in sys.path:
+  sys.path.insert(0,scripts)
+
+default_socket = os.path.join(os.environ.get('XDG_RUNTIME_DIR') or tempfile.gettempdir(),
+                              'audio-scripts-{}.sock'.format(os.getuid()))
+
+# Send a job to a worker over its socket and wait for it to finish.  The
+# job's output goes to the given file descriptors (by default, ours).
+# Returns the job's exit status, wall time and CPU time.
+def submit(script,args=[],cwd='.',socket_path=default_socket,stdout=1,stderr=2):
+  job = {'script':script,'args':[str(x) for x in args],'cwd':os.path.realpath(cwd)}
+  with socket.socket(socket.AF_UNIX,socket.SOCK_STREAM) as s:
+    s.connect(socket_path)
+    s.sendmsg([(json.dumps(job)+'\n').encode()],
+               [(socket.SOL_SOCKET,socket.SCM_RIGHTS,array.array('i',[stdout,stderr]))])
+    reply = b''
+    while not reply.endswith(b'\n'):
+      buf = s.recv(4096)
+      if not buf:
+        raise Exception('The worker at {} went away while running {}.'.format(socket_path,script))
+      reply = reply + buf
+  return json.loads(reply)
+
+# Submit music.py for an album directory or archive, with -t (show the
+# plan) or -r (run it)
+def submit_music(album,*opts,run=True,**kw):
+  return submit('music.py',list(opts)+['-r' if run else '-t',album],**kw)
+
+# Submit hos.py for a HoS program directory or archive, with -t or -r
+def submit_hos(program,*opts,run=True,**kw):
+  return submit('hos.py',list(opts)+['-r' if run else '-t',program],**kw)
+
+# Submit organize.py for a set of files and a destination
+def submit_organize(files,destination,*opts,**kw):
+  return submit('organize.py',list(opts)+list(files)+[destination],**kw)
+
+# Find the libfdk_aac version behind ffmpeg, the way music.py and hos.py
+# do, so that the worker does it once instead of in every AAC job.
+# Returns '' when it cannot be found; the jobs then look for themselves.
+def libfdk_aac_version():
+  try:
+    ffmpeg_path=subprocess.run(['which','ffmpeg'],capture_output=True,text=True).stdout.strip()
+    ldd_output=[x.strip() for x in subprocess.run(['ldd',ffmpeg_path],capture_output=True,text=True).stdout.split('\n')]
+  except OSError:
+    return ''
+  for x in ldd_output:
+    a=x.split('=>')
+    if 'libfdk-aac.so' in a[0] and len(a) > 1:
+      libfdk_path=re.split(r'(.*/)(.*)',a[1].strip())[1]
+      try:
+        with open('{}/pkgconfig/fdk-aac.pc'.format(libfdk_path),'r') as pc:
+          for line in pc:
+            if 'Version:' in line:
+              return line.split()[1]
+      except OSError:
+        return ''
+  return ''
+
+# Loaded scripts, loaded again whenever a script changes on disk: the
+# imported module of one with a main(), the compiled code of the others
+loaded = {}
+def load(script):
+  path = os.path.join(scripts,script)
+  mtime = os.stat(path).st_mtime_ns
+  if script not in loaded.keys() or loaded[script][0] != mtime:
+    if script in main_names and script in loaded.keys():
+      program = importlib.reload(loaded[script][1])
+    elif script in main_names:
+      program = importlib.import_module(script[:-3])
+    else:
+      with open(path,'r') as f:
+        program = compile(f.read(),path,'exec')
+    loaded.update({script:(mtime,program)})
+  return loaded[script][1]
+
+# Run a job in a forked copy of the worker.  Returns the child's pid.
+def start(job,fds=None,log=None):
+  if job['script'] not in script_names:
+    raise Exception('{} is not one of {}.'.format(job['script'],', '.join(script_names)))
+  program = load(job['script'])
+  sys.stdout.flush()
+  sys.stderr.flush()
+  pid = os.fork()
+  if pid != 0:
+    return pid
+
+  # In the child: take over the job's output, working directory and
+  # arguments, then run the script
+  status = 1
+  try:
+    signal.signal(signal.SIGTERM,signal.SIG_DFL)
+    signal.signal(signal.SIGINT,signal.default_int_handler)
+    if fds == None and log != None:
+      fd = os.open(log,os.O_WRONLY|os.O_CREAT|os.O_APPEND,0o644)
+      fds = [fd,fd]
+    if fds != None:
+      os.dup2(fds[0],1)
+      os.dup2(fds[1],2)
+    os.chdir(job['cwd'])
+    path = os.path.join(scripts,job['script'])
+    sys.argv = [path]+job['args']
+    sys.path[0] = scripts
+    try:
+      if job['script'] in main_names:
+        program.parser.prog = job['script']
+        program.main(job['args'])
+      else:
+        exec(program,{'__name__':'__main__','__file__':path,'__builtins__':builtins})
+      status = 0
+    except SystemExit as e:
+      if e.code == None:
+        status = 0
+      elif isinstance(e.code,int):
+        status = e.code
+      else:
+        print(e.code,file=sys.stderr)
+        status = 1
+  except BaseException:
+    traceback.print_exc()
+  finally:
+    try:
+      sys.stdout.flush()
+      sys.stderr.flush()
+    finally:
+      os._exit(status)
+
+# Receive a job over an accepted connection, along with the caller's
+# stdout/stderr
+def receive(conn):
+  conn.settimeout(10)
+  data = b''
+  fds = array.array('i')
+  while not data.endswith(b'\n'):
+    msg,anc,flags,addr = conn.recvmsg(65536,socket.CMSG_SPACE(2*fds.itemsize))
+    if not msg:
+      raise Exception('Connection closed before a job was sent.')
+    data = data + msg
+    for level,kind,payload in anc:
+      if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+        fds.frombytes(payload[:len(payload)-(len(payload) % fds.itemsize)])
+  conn.settimeout(None)
+  return json.loads(data),list(fds) or None
+
+# Serve jobs from the socket and/or the spool directory, up to --jobs at
+# once.  Everything happens on the main thread (forking from a threaded
+# process is asking for trouble); children are reaped as they exit.
+def serve(socket_path,spool,jobs):
+  listener = None
+  if socket_path != None:
+    if Path(socket_path).is_socket():
+      Path(socket_path).unlink()
+    listener = socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+    listener.bind(socket_path)
+    os.chmod(socket_path,0o600)
+    listener.listen(64)
+    print('Listening on {}'.format(socket_path))
+  if spool != None:
+    for d in ('new','run','done','log'):
+      os.makedirs(os.path.join(spool,d),exist_ok=True)
+    print('Watching {}'.format(os.path.join(spool,'new')))
+  print('Running up to {} job(s) at once.'.format(jobs))
+  for script in script_names:
+    load(script)
+  if not os.environ.get('LIBFDK_AAC_VERSION'):
+    version = libfdk_aac_version()
+    if version != '':
+      os.environ['LIBFDK_AAC_VERSION'] = version
+      print('Using libfdk_aac {}'.format(version))
+
+  waiting = deque()
+  running = {}
+  try:
+    while True:
+      # Take new jobs
+      watch = [listener] if listener != None else []
+      watch.extend([x['conn'] for x in running.values() if x['conn'] != None])
+      readable,_,_ = select.select(watch,[],[],0.5)
+      for r in readable:
+        if r is listener:
+          conn,_ = listener.accept()
+          try:
+            job,fds = receive(conn)
+            waiting.append({'job':job,'fds':fds,'conn':conn,'name':None})
+          except Exception as e:
+            print('{}ERROR: Bad job request: {}{}'.format(bcolors.FAIL,e,bcolors.ENDC))
+            conn.close()
+        else:
+          # A caller that hangs up takes its job with it
+          for pid,x in running.items():
+            if x['conn'] is r and not r.recv(1):
+              os.kill(pid,signal.SIGTERM)
+              x['conn'].close()
+              x['conn'] = None
+      if spool != None and len(waiting) == 0:
+        for name in sorted(os.listdir(os.path.join(spool,'new'))):
+          if name[-5:] != '.json':
+            continue
+          try:
+            os.rename(os.path.join(spool,'new',name),os.path.join(spool,'run',name))
+            with open(os.path.join(spool,'run',name),'r') as f:
+              job = json.load(f)
+            waiting.append({'job':job,'fds':None,'conn':None,'name':name})
+          except (OSError,ValueError) as e:
+            print('{}ERROR: Bad spool job {}: {}{}'.format(bcolors.FAIL,name,e,bcolors.ENDC))
+
+      # Start what fits
+      while waiting and len(running) < jobs:
+        x = waiting.popleft()
+        log = None
+        if x['name'] != None:
+          log = x['job'].get('log') or os.path.join(spool,'log',x['name'][:-5]+'.log')
+        try:
+          pid = start(x['job'],x['fds'],log)
+        except Exception as e:
+          print('{}ERROR: {}{}'.format(bcolors.FAIL,e,bcolors.ENDC))
+          x.update({'start':time.monotonic()})
+          finish(x,spool,127,0)
+          continue
+        finally:
+          for fd in x['fds'] or []:
+            os.close(fd)
+        x.update({'start':time.monotonic()})
+        running.update({pid:x})
+        print('Started {} {} ({})'.format(x['job']['script'],' '.join(x['job']['args']),pid))
+
+      # Reap what finished
+      while running:
+        pid,status,usage = os.wait4(-1,os.WNOHANG)
+        if pid == 0:
+          break
+        x = running.pop(pid)
+        status = os.WEXITSTATUS(status) if os.WIFEXITED(status) else 128+os.WTERMSIG(status)
+        finish(x,spool,status,usage.ru_utime+usage.ru_stime)
+  except KeyboardInterrupt:
+    print(f"{bcolors.FAIL}\n** Trapped CTRL-C{bcolors.ENDC}")
+  finally:
+    if listener != None:
+      listener.close()
+      Path(socket_path).unlink(missing_ok=True)
+
+# Report a finished job to its caller, or to the spool
+def finish(x,spool,status,cpu):
+  result = {'status':status,'wall':round(time.monotonic()-x['start'],3),'cpu':round(cpu,3)}
+  color = bcolors.OKGREEN if status == 0 else bcolors.FAIL
+  print('{}Finished {} {}: {}{}'.format(color,x['job']['script'],' '.join(x['job']['args']),status,bcolors.ENDC))
+  if x['conn'] != None:
+    try:
+      x['conn'].sendall((json.dumps(result)+'\n').encode())
+    except OSError:
+      pass
+    x['conn'].close()
+  if x['name'] != None:
+    x['job'].update({'result':result})
+    temp = os.path.join(spool,'done','.'+x['name'])
+    with open(temp,'w') as f:
+      json.dump(x['job'],f,indent=2)
+    os.replace(temp,os.path.join(spool,'done',x['name']))
+    Path(spool,'run',x['name']).unlink(missing_ok=True)
+
+if __name__ == '__main__':
+
+  # Parse arguments
+  parser = argparse.ArgumentParser(description='Run the audio scripts from one warm process.')
+  sub = parser.add_subparsers(dest='command',required=True)
+  p = sub.add_parser('serve',help='Start a worker.')
+  p.add_argument('-s','--socket',metavar='SOCKET',dest='socket',
+                 help='Unix socket to take jobs on. (Default: {}, unless only --spool is given)'.format(default_socket))
+  p.add_argument('-d','--spool',metavar='DIR',dest='spool',
+                 help='Spool directory to take jobs from.')
+  p.add_argument('-j','--jobs',metavar='N',type=int,dest='jobs',default=len(os.sched_getaffinity(0)),
+                 help='Number of jobs to run at once. (Default: number of available CPUs)')
+  p = sub.add_parser('run',help='Run a job on a worker and wait for it.')
+  p.add_argument('-s','--socket',metavar='SOCKET',dest='socket',default=default_socket,
+                 help='Socket of the worker. (Default: {})'.format(default_socket))
+  p.add_argument('-C','--directory',metavar='DIR',dest='cwd',default='.',
+                 help='Directory to run the job in. (Default: the current directory)')
+  p.add_argument('script',choices=script_names,help='Script to run.')
+  p.add_argument('args',nargs=argparse.REMAINDER,help='Arguments for the script.')
+  p = sub.add_parser('queue',help='Drop a job into a spool directory.')
+  p.add_argument('-d','--spool',metavar='DIR',dest='spool',required=True,
+                 help='Spool directory of the worker.')
+  p.add_argument('-C','--directory',metavar='DIR',dest='cwd',default='.',
+                 help='Directory to run the job in. (Default: the current directory)')
+  p.add_argument('-l','--log',metavar='FILE',dest='log',
+                 help='Log file for the job. (Default: one in the spool directory)')
+  p.add_argument('script',choices=script_names,help='Script to run.')
+  p.add_argument('args',nargs=argparse.REMAINDER,help='Arguments for the script.')
+  args=parser.parse_args()
+
+  if args.command == 'serve':
+    if args.jobs < 1:
+      parser.error('--jobs must be at least 1.')
+    if args.socket == None and args.spool == None:
+      args.socket = default_socket
+    serve(args.socket,args.spool,args.jobs)
+
+  elif args.command == 'run':
+    sys.stdout.flush()
+    result = submit(args.script,args.args,args.cwd,args.socket)
+    sys.exit(result['status'])
+
+  elif args.command == 'queue':
+    job = {'script':args.script,'args':args.args,'cwd':os.path.realpath(args.cwd)}
+    if args.log != None:
+      job.update({'log':os.path.realpath(args.log)})
+    os.makedirs(os.path.join(args.spool,'new'),exist_ok=True)
+    name = '{}-{}-{}.json'.format(datetime.datetime.now().strftime('%Y%m%d%H%M%S'),os.getpid(),args.script[:-3])
+    temp = os.path.join(args.spool,'new','.'+name)
+    with open(temp,'w') as f:
+      json.dump(job,f,indent=2)
+    os.replace(temp,os.path.join(args.spool,'new',name))
+    print(name)